@@ -0,0 +1,76 @@
+"""
+Check the Polars backend of create_all_pomi gives exactly the same DataFrame as the pandas backend on synthetic data,
+and time both.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.check_backend_parity --practices 6500 --months 12
+"""
+import argparse
+import sys
+import time
+import pandas as pd
+from pipeline.data import synthetic
+from pipeline.utils import params
+from pipeline.processing import mapping
+from pipeline import pipeline_wrapper
+
+def create_all_pomi_inputs(report_month: str, practices: int, months: int, field_keys: int) -> tuple:
+    """
+    Synthetic create_all_pomi arguments for the report period of report_month
+    """
+    params.set_report_month(report_month)
+    rpsd = params.get_report_period_start_date()
+    rped = params.get_report_period_end_date()
+
+    tables = synthetic.create_synthetic_tables(report_month, practices, months, field_keys)
+    data = synthetic.create_synthetic_extract(tables, rpsd, rped)
+    mapping_df = mapping.create_mapping_df(
+        data["open_active_df"],
+        data["sub_icb_mapping_df"],
+        data["icb_mapping_df"],
+        data["region_mapping_df"]
+        )
+
+    return (
+        data["prim_pomi_df"],
+        data["gp_dim_df"],
+        data["exclude_list_df"],
+        rpsd,
+        rped,
+        data["prim_pomi_inf_df"],
+        data["inf_exclude_list_df"],
+        data["prim_pomi_field_df"],
+        mapping_df
+        )
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Compare the pandas and Polars create_all_pomi backends")
+    parser.add_argument("--report-month", default="2023-12-01")
+    parser.add_argument("--practices", type=int, default=6500)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--field-keys", type=int, default=141)
+    args = parser.parse_args()
+
+    inputs = create_all_pomi_inputs(args.report_month, args.practices, args.months, args.field_keys)
+
+    outputs = {}
+    for backend in ["pandas", "polars"]:
+        create_all_pomi = pipeline_wrapper.get_aggregate_backend({"aggregate_backend": backend})[1]
+        start = time.perf_counter()
+        outputs[backend] = create_all_pomi(*inputs)
+        print(f"{backend}: {round(time.perf_counter() - start, 3)}s, {outputs[backend].shape}")
+
+    try:
+        pd.testing.assert_frame_equal(outputs["pandas"], outputs["polars"])
+    except AssertionError as e:
+        print(f"Backends differ: {e}")
+        sys.exit(1)
+
+    print("Backends match")
+
+
+if __name__ == "__main__":
+    main()
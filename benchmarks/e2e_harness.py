@@ -0,0 +1,283 @@
+"""
+Run pipeline_wrapper.run end to end against a local SQLite stand-in for the POMI and mapping SQL servers, loaded with
+synthetic data, and record the run time and a checksum of every output.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.e2e_harness --practices 6500 --work-dir /tmp/pomi_e2e --expected benchmarks/results/e2e_v1.json
+
+With --backfill-start the months from then to the report month are backfilled instead, so e.g. a backfill with
+--set aggregate_by_month=true can be checked against the results of one without.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import time
+import zipfile
+import pandas as pd
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from pipeline.data import synthetic
+from pipeline.utils import params
+from pipeline import pipeline_wrapper
+
+## Tables are created in attached databases named after their SQL Server schema, so the queries in input.py run as
+## written. SQLite has no three part names, so [PRIM_POMI].[ic].[...] is rewritten to [ic].[...]
+schemas = {
+    "ic": ["PRIM_POMI_GP_DIM", "PRIM_POMI_FACT", "PRIM_POMI_FACT_INF", "PRIM_POMI_FIELD_DIM"],
+    "dbo": ["ONS_CHD_GEO_EQUIVALENTS"],
+    }
+database_prefix = re.compile(r"\[PRIM_POMI\]\.(?=\[ic\]\.)")
+
+output_folders = ["PUBLICATION", "CHOICES", "BENEFITS", "PBI", "TREND MONITOR"]
+
+def get_schema_path(database_path: str, schema: str) -> str:
+
+    return f"{os.path.splitext(database_path)[0]}_{schema}.db"
+
+
+def attach_schemas(dbapi_connection, connection_record) -> None:
+    """
+    Attach the schema databases to every new SQLite connection
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    database_path = dbapi_connection.execute("PRAGMA database_list").fetchone()[2]
+    for schema in schemas:
+        dbapi_connection.execute(f"ATTACH DATABASE '{get_schema_path(database_path, schema)}' AS {schema}")
+
+
+def rewrite_sql_server_names(conn, cursor, statement, parameters, context, executemany):
+    """
+    Drop the database part of three part table names before the statement reaches SQLite
+    """
+    if conn.dialect.name == "sqlite":
+        statement = database_prefix.sub("", statement)
+
+    return statement, parameters
+
+
+def register_sqlite_stand_in() -> None:
+    """
+    Apply the stand-in hooks to every engine, including the ones pipeline_wrapper creates from the config
+    """
+    if not event.contains(Engine, "connect", attach_schemas):
+        event.listen(Engine, "connect", attach_schemas)
+        event.listen(Engine, "before_cursor_execute", rewrite_sql_server_names, retval=True)
+
+
+def create_stand_in_database(tables: dict, database_path: str) -> None:
+    """
+    Write the synthetic tables to the main SQLite database and one database per schema
+    """
+    for path in [database_path] + [get_schema_path(database_path, schema) for schema in schemas]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    sqlite3.connect(database_path).close()
+    for schema, table_names in schemas.items():
+        with sqlite3.connect(get_schema_path(database_path, schema)) as connection:
+            for table_name in table_names:
+                tables[table_name].to_sql(table_name, connection, index=False, chunksize=100000)
+                if "Report_End" in tables[table_name].columns:
+                    connection.execute(f"CREATE INDEX idx_{table_name}_report_end ON {table_name} (Report_End)")
+
+
+def create_input_files(tables: dict, root: str) -> None:
+    """
+    Create the INPUTS and OUTPUTS folders with the exclude lists, trend monitor template and participation files
+    """
+    input_folder = os.path.join(root, params.params["DATA_FOLDER"])
+    os.makedirs(input_folder, exist_ok=True)
+    for folder in output_folders:
+        os.makedirs(os.path.join(root, "OUTPUTS", folder), exist_ok=True)
+
+    tables["exclude_list"].to_csv(os.path.join(input_folder, "Fact Table Exclude List.csv"), index=False, header=False)
+    tables["inf_exclude_list"].to_csv(os.path.join(input_folder, "Fact Table Exclude List INF.csv"), index=False, header=False)
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    shutil.copy(
+        os.path.join(repo_root, "public_metadata", "Trend_Monitor_Template.xlsx"),
+        os.path.join(input_folder, "Trend_Monitor_Template.xlsx")
+        )
+
+    practices = tables["PRIM_POMI_GP_DIM"]["GP_Code"].drop_duplicates().sort_values()
+    practices.rename("PRACTICE_CODE").to_csv(os.path.join(input_folder, "GPWT_PARTICIPATION_010123.csv"), index=False)
+
+    ## The QS status file has nine lines of report header before the table. Every tenth practice isn't approved.
+    status = pd.DataFrame({
+        "Service\nProvider Id": practices.values,
+        "Status": ["Rejected" if i % 10 == 0 else "Approved" for i in range(len(practices))],
+        "Status Date": "01/04/2022",
+        })
+    with open(os.path.join(input_folder, "QS Part Status-GPWC-2022-2023.csv"), "w", newline="") as f:
+        f.write("Report Run Date:\n" * 9)
+        status.to_csv(f, index=False)
+
+
+def get_file_checksum(path: str) -> str:
+    """
+    Checksum of an output's contents. Zip and xlsx files hold write timestamps, so their members or cell values are
+    hashed instead of the file bytes.
+    """
+    digest = hashlib.sha256()
+
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for name in sorted(archive.namelist()):
+                digest.update(name.encode())
+                digest.update(archive.read(name))
+    elif path.endswith(".xlsx"):
+        import openpyxl
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        for sheet in workbook.worksheets:
+            digest.update(sheet.title.encode())
+            for row in sheet.iter_rows(values_only=True):
+                digest.update(repr(row).encode())
+    else:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def get_output_checksums(root: str) -> dict:
+
+    checksums = {}
+    for folder in output_folders:
+        folder_path = os.path.join(root, "OUTPUTS", folder)
+        for filename in sorted(os.listdir(folder_path)):
+            checksums[f"{folder}/{filename}"] = get_file_checksum(os.path.join(folder_path, filename))
+
+    return checksums
+
+
+def run_harness(
+    work_dir: str,
+    report_month: str,
+    practices: int,
+    months: int,
+    field_keys: int,
+    max_workers: int,
+    overrides: dict = None,
+    backfill_start: str = None
+    ) -> dict:
+    """
+    Build the stand-in database and input files in work_dir and run the full pipeline against them, or backfill
+    from backfill_start to report_month if given
+
+    Returns:
+        dict: Timings of the setup and pipeline run, and checksums of each output file
+    """
+    root = os.path.abspath(work_dir)
+    if os.path.exists(os.path.join(root, "OUTPUTS")):
+        shutil.rmtree(os.path.join(root, "OUTPUTS"))
+    database_path = os.path.join(root, "pomi_stand_in.db")
+
+    start = time.perf_counter()
+    print(f"Generating {practices} practices x {months} months x {field_keys} field keys")
+    tables = synthetic.create_synthetic_tables(report_month, practices, months, field_keys)
+    os.makedirs(root, exist_ok=True)
+    create_stand_in_database(tables, database_path)
+    create_input_files(tables, root)
+    setup_seconds = time.perf_counter() - start
+    del tables
+
+    register_sqlite_stand_in()
+    connection_string = f"sqlite:///{database_path}"
+    config = {
+        "root_directory": root,
+        "report_run_date": report_month,
+        "pomi_connection_string": connection_string,
+        "mapping_connection_string": connection_string,
+        "max_workers": max_workers,
+        "create_xlsb": False,
+        "open_output_folder": False,
+        **(overrides or {}),
+        }
+    params.params["ROOT_DIR"] = root
+    params.set_report_month(report_month)
+
+    start = time.perf_counter()
+    if backfill_start:
+        pipeline_wrapper.run_backfill(config, backfill_start, report_month)
+    else:
+        pipeline_wrapper.run(config)
+    run_seconds = time.perf_counter() - start
+
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "report_month": report_month,
+        "practices": practices,
+        "months": months,
+        "field_keys": field_keys,
+        "setup_seconds": round(setup_seconds, 3),
+        "run_seconds": round(run_seconds, 3),
+        "config_overrides": overrides or {},
+        "backfill_start": backfill_start,
+        "run_report": os.path.join(root, "OUTPUTS", "RUN REPORT", f"run_report_{params.get_export_dates()}.json"),
+        "checksums": get_output_checksums(root),
+        }
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Run the POMI pipeline end to end against a local SQLite stand-in")
+    parser.add_argument("--work-dir", default=os.path.join("benchmarks", "e2e"))
+    parser.add_argument("--report-month", default="2023-12-01")
+    parser.add_argument("--practices", type=int, default=6500)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--field-keys", type=int, default=141)
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override a config.json setting for the run, e.g. --set low_memory=true. Values are read as JSON."
+        )
+    parser.add_argument("--backfill-start", default=None, help="Backfill the report months from this one (YYYY-MM-DD) to --report-month")
+    parser.add_argument("--output", default=None, help="Where to write the results, <work-dir>/e2e_results.json by default")
+    parser.add_argument("--expected", default=None, help="Results from a previous run whose checksums should match")
+    args = parser.parse_args()
+
+    overrides = {}
+    for setting in args.set:
+        key, value = setting.split("=", 1)
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+
+    results = run_harness(args.work_dir, args.report_month, args.practices, args.months, args.field_keys, args.max_workers, overrides, args.backfill_start)
+
+    output_path = args.output or os.path.join(args.work_dir, "e2e_results.json")
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Pipeline ran in {results['run_seconds']}s, results written to {output_path}")
+
+    if args.expected:
+        with open(args.expected) as f:
+            expected = json.load(f)["checksums"]
+
+        changed = sorted(
+            name for name in set(expected) | set(results["checksums"])
+            if expected.get(name) != results["checksums"].get(name)
+            )
+        for name in changed:
+            print(f"CHANGED {name}")
+
+        if changed:
+            sys.exit(1)
+        print("All output checksums match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Time the hot POMI functions on synthetic data at multiples of national scale, store the results as JSON and flag
+regressions against the results of a previous version.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.run_benchmarks --scales 1,5,20 --label v2 --baseline benchmarks/results/v1.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import warnings
+import pandas as pd
+from pipeline.data import synthetic
+from pipeline.utils import params
+from pipeline.processing import aggregate, create_csv, create_trend_monitor, dq_rules, mapping
+
+def get_label() -> str:
+    """
+    Default results label, the short hash of the current git commit
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+
+
+def time_function(function, args: tuple, repeat: int) -> dict:
+    """
+    Call function repeat times and return the fastest and median wall time in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = function(*args)
+        timings.append(time.perf_counter() - start)
+
+    return {"min": round(min(timings), 4), "median": round(statistics.median(timings), 4)}, output
+
+
+def benchmark_scale(practices: int, months: int, field_keys: int, repeat: int, report_month: str) -> dict:
+    """
+    Generate synthetic data at one size and time each hot function on it, feeding each stage the output of the one
+    before as the pipeline does
+    """
+    params.set_report_month(report_month)
+    rpsd = params.get_report_period_start_date()
+    rped = params.get_report_period_end_date()
+
+    print(f"Generating {practices} practices x {months} months x {field_keys} field keys")
+    tables = synthetic.create_synthetic_tables(report_month, practices, months, field_keys)
+    data = synthetic.create_synthetic_extract(tables, rpsd, rped)
+    del tables
+
+    mapping_df = mapping.create_mapping_df(data["open_active_df"], data["sub_icb_mapping_df"], data["icb_mapping_df"], data["region_mapping_df"])
+    timings = {}
+
+    def run(name, function, *args):
+        print(f"  {name}")
+        timings[name], output = time_function(function, args, repeat)
+        return output
+
+    all_pomi_df = run(
+        "create_all_pomi",
+        aggregate.create_all_pomi,
+        data["prim_pomi_df"], data["gp_dim_df"], data["exclude_list_df"], rpsd, rped,
+        data["prim_pomi_inf_df"], data["inf_exclude_list_df"], data["prim_pomi_field_df"], mapping_df
+        )
+    all_pomi_recoded_df = run("create_month_summary_base_data", aggregate.create_month_summary_base_data, all_pomi_df)
+    all_pomi_adjusted_df = run("create_base_data", aggregate.create_base_data, all_pomi_recoded_df)
+
+    run("create_pcd_output", create_csv.create_pcd_output, all_pomi_adjusted_df)
+    run("create_choices_output", create_csv.create_choices_output, all_pomi_adjusted_df)
+    run("create_benefits_dataset", create_csv.create_benefits_dataset, all_pomi_recoded_df)
+    run("create_pbi_output", create_csv.create_pbi_output, all_pomi_adjusted_df)
+
+    run("evaluate_dq_rules", dq_rules.evaluate_dq_rules, all_pomi_adjusted_df)
+    run("create_practices_list_change", create_trend_monitor.create_practices_list_change, all_pomi_adjusted_df)
+    run("create_online_services_enabled_status", create_trend_monitor.create_online_services_enabled_status, all_pomi_adjusted_df)
+    run("create_total_transactions", create_trend_monitor.create_total_transactions, all_pomi_adjusted_df)
+    run("create_month_by_month_comparison", create_trend_monitor.create_month_by_month_comparison, all_pomi_adjusted_df)
+
+    return {
+        "practices": practices,
+        "months": months,
+        "field_keys": field_keys,
+        "fact_rows": len(data["prim_pomi_df"]) + len(data["prim_pomi_inf_df"]),
+        "all_pomi_shape": list(all_pomi_df.shape),
+        "timings": timings,
+        }
+
+
+def find_regressions(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Compare fastest timings at each scale with the baseline
+
+    Returns:
+        list: (scale, function, baseline seconds, current seconds) for every function slower than threshold allows
+    """
+    regressions = []
+    for scale, result in results["scales"].items():
+        baseline_timings = baseline.get("scales", {}).get(scale, {}).get("timings", {})
+        for name, timing in result["timings"].items():
+            if name in baseline_timings and timing["min"] > baseline_timings[name]["min"] * (1 + threshold):
+                regressions.append((scale, name, baseline_timings[name]["min"], timing["min"]))
+
+    return regressions
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Benchmark the POMI pipeline on synthetic data")
+    parser.add_argument("--scales", default="1,5,20", help="Comma separated multiples of --practices")
+    parser.add_argument("--practices", type=int, default=6500, help="Practices at 1x, national scale by default")
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--field-keys", type=int, default=141)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each function, the fastest is compared")
+    parser.add_argument("--report-month", default="2023-12-01")
+    parser.add_argument("--label", default=None, help="Name of the results file, the git commit by default")
+    parser.add_argument("--output-dir", default=os.path.join("benchmarks", "results"))
+    parser.add_argument("--baseline", default=None, help="Results file from a previous version to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown before flagging, 0.2 = 20%%")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    label = args.label or get_label()
+
+    results = {
+        "label": label,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "scales": {}
+        }
+
+    for scale in args.scales.split(","):
+        print(f"Benchmarking {scale}x")
+        results["scales"][f"{scale}x"] = benchmark_scale(
+            int(float(scale) * args.practices), args.months, args.field_keys, args.repeat, args.report_month
+            )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, f"{label}.json")
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results written to {output_path}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = find_regressions(results, baseline, args.threshold)
+        for scale, name, before, after in regressions:
+            print(f"REGRESSION {scale} {name}: {before}s -> {after}s")
+
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {baseline['label']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Exercise the local POMI service against the SQLite stand-in used by the end to end harness. The service is started
+in this process on a free port and sent a full run, a Choices only run from the warm data, and a Choices only run
+after a row is dropped from the exclude list, printing the time each request took.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.service_check --practices 6500 --work-dir /tmp/pomi_service --expected <e2e results>.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import urllib.request
+from benchmarks import e2e_harness
+from pipeline import service
+from pipeline.data import synthetic
+from pipeline.utils import params
+
+def post(url: str, body: dict) -> dict:
+
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description="Run requests against the local POMI service backed by a SQLite stand-in")
+    parser.add_argument("--work-dir", default=os.path.join("benchmarks", "service"))
+    parser.add_argument("--report-month", default="2023-12-01")
+    parser.add_argument("--practices", type=int, default=6500)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--field-keys", type=int, default=141)
+    parser.add_argument("--expected", default=None, help="e2e_harness results whose checksums the full run should match")
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.work_dir)
+    if os.path.exists(os.path.join(root, "OUTPUTS")):
+        shutil.rmtree(os.path.join(root, "OUTPUTS"))
+    database_path = os.path.join(root, "pomi_stand_in.db")
+
+    tables = synthetic.create_synthetic_tables(args.report_month, args.practices, args.months, args.field_keys)
+    os.makedirs(root, exist_ok=True)
+    e2e_harness.create_stand_in_database(tables, database_path)
+    params.params["ROOT_DIR"] = root
+    e2e_harness.create_input_files(tables, root)
+    del tables
+
+    e2e_harness.register_sqlite_stand_in()
+    connection_string = f"sqlite:///{database_path}"
+    server = service.create_server(
+        {
+            "root_directory": root,
+            "report_run_date": args.report_month,
+            "pomi_connection_string": connection_string,
+            "mapping_connection_string": connection_string,
+            "create_xlsb": False,
+            "write_base_data": False,
+        },
+        port=0
+        )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        results = [("full run", post(f"{url}/run", {}))]
+        checksums = e2e_harness.get_output_checksums(root)
+        results.append(("choices, warm", post(f"{url}/run", {"outputs": "choices"})))
+
+        exclude_list_path = os.path.join(root, params.params["DATA_FOLDER"], "Fact Table Exclude List.csv")
+        with open(exclude_list_path) as f:
+            rows = f.readlines()
+        with open(exclude_list_path, "w") as f:
+            f.writelines(rows[:-1])
+        results.append(("choices, exclude list changed", post(f"{url}/run", {"outputs": "choices"})))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    for name, result in results:
+        print(f"{name}: {result['seconds']}s, extracted {result['extracted']}, base data rebuilt {result['base_data_rebuilt']}")
+
+    if args.expected:
+        with open(args.expected) as f:
+            expected = json.load(f)["checksums"]
+
+        changed = sorted(name for name in set(expected) | set(checksums) if expected.get(name) != checksums.get(name))
+        for name in changed:
+            print(f"CHANGED {name}")
+
+        if changed:
+            sys.exit(1)
+        print("All output checksums of the full run match")
+
+
+if __name__ == "__main__":
+    main()
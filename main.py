@@ -1,12 +1,166 @@
-from pipeline.data import input
-from pipeline import pipeline_wrapper
+from pipeline.utils import params
+import argparse
+import os
+
+def add_run_arguments(parser: argparse.ArgumentParser, subcommand: bool = False) -> None:
+    """
+    Add --config and --outputs to parser. A subcommand's copies have no defaults, so they only override values given
+    before the subcommand when they're given themselves.
+    """
+    parser.add_argument(
+        "--config",
+        default=argparse.SUPPRESS if subcommand else os.path.join(".", "config.json"),
+        help="Config file to run with (default .\\config.json)"
+        )
+    parser.add_argument(
+        "--outputs",
+        default=argparse.SUPPRESS if subcommand else None,
+        help="Comma separated outputs to build, from pcd, choices, benefits, pbi, trend_monitor and base_data (default all)"
+        )
 
-def main() -> None:
 
+def load_config(args: argparse.Namespace) -> dict:
+    """
+    Load the config file named on the command line, with any outputs selected on the command line, and set params
+    from it
+    """
     print("Loading config file")
-    config = input.load_json_config_file(".\\config.json")
+    config = params.load_json_config_file(args.config)
+    if getattr(args, "outputs", None):
+        config["outputs"] = args.outputs
+
+    params.configure(config)
+
+    return config
+
+
+def run(args: argparse.Namespace) -> None:
+
+    from pipeline import pipeline_wrapper
+    pipeline_wrapper.run(load_config(args), resume=args.resume)
+
+
+def backfill(args: argparse.Namespace) -> None:
+
+    from pipeline import pipeline_wrapper
+    pipeline_wrapper.run_backfill(load_config(args), args.start_month, args.end_month)
+
+
+def query(args: argparse.Namespace) -> None:
+
+    from pipeline import query
+    if args.base_data_folder is None:
+        load_config(args)
+
+    query.print_result(query.query_base_data(args.sql, args.base_data_folder), args.output)
+
+
+def assemble(args: argparse.Namespace) -> None:
+
+    from pipeline.output import partition_export
+    load_config(args)
+
+    print(f"Written to {partition_export.assemble_partitions(args.dataset, args.output, args.month)}")
+
+
+def flatten_pbi(args: argparse.Namespace) -> None:
+
+    from pipeline.output import csv_export
+    load_config(args)
+
+    print(f"Written to {csv_export.write_flat_pbi_output(args.output, args.filename)}")
+
+
+def scenario(args: argparse.Namespace) -> None:
+
+    from pipeline import query, scenario
+    query.print_result(scenario.run_scenarios(load_config(args), scenario.read_scenarios(args.folders)), args.output)
+
+
+def serve(args: argparse.Namespace) -> None:
+
+    from pipeline import service
+    service.serve(load_config(args), args.host, args.port)
+
+
+def main() -> None:
+
+    from pipeline.query import add_arguments as add_query_arguments
+
+    parser = argparse.ArgumentParser(description="Run the POMI publication pipeline")
+    add_run_arguments(parser)
+    parser.add_argument(
+        "--backfill",
+        nargs=2,
+        metavar=("START_MONTH", "END_MONTH"),
+        help="Rebuild every report month from START_MONTH to END_MONTH (YYYY-MM-DD) from a single extraction"
+        )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the last run for the report month from its cached stages instead of extracting again"
+        )
+    ## Options repeated on the subcommands default to argparse.SUPPRESS so they don't replace values given before the
+    ## subcommand, e.g. main.py --config X.json --resume run
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="Run the publication for the report month in the config (default)")
+    add_run_arguments(run_parser, subcommand=True)
+    run_parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=argparse.SUPPRESS,
+        help="Resume the last run for the report month from its cached stages instead of extracting again"
+        )
+    run_parser.set_defaults(function=run)
+
+    backfill_parser = subparsers.add_parser("backfill", help="Rebuild a range of report months from a single extraction")
+    add_run_arguments(backfill_parser, subcommand=True)
+    backfill_parser.add_argument("start_month", help="First report run date (YYYY-MM-DD)")
+    backfill_parser.add_argument("end_month", help="Last report run date (YYYY-MM-DD)")
+    backfill_parser.set_defaults(function=backfill)
+
+    query_parser = subparsers.add_parser("query", help="Query the base data saved by earlier runs with SQL")
+    query_parser.add_argument("--config", default=argparse.SUPPRESS, help="Config file with the root directory")
+    add_query_arguments(query_parser)
+    query_parser.set_defaults(function=query)
+
+    assemble_parser = subparsers.add_parser("assemble", help="Join a run's month partitions back into a single csv")
+    assemble_parser.add_argument("--config", default=argparse.SUPPRESS, help="Config file with the root directory")
+    assemble_parser.add_argument("dataset", choices=["pbi", "pcd"])
+    assemble_parser.add_argument("output", help="csv file to write")
+    assemble_parser.add_argument("--month", default=None, help="Report month of the run (YYYY-MM), the latest run by default")
+    assemble_parser.set_defaults(function=assemble)
+
+    flatten_parser = subparsers.add_parser("flatten-pbi", help="Join a run's PBI star schema tables back into the flat PBI csv")
+    flatten_parser.add_argument("--config", default=argparse.SUPPRESS, help="Config file with the root directory")
+    flatten_parser.add_argument("output", help="csv file to write")
+    flatten_parser.add_argument("--filename", default="WORK_POMI_ALL_OUT.csv", help="PBI file the star schema tables are named after (default WORK_POMI_ALL_OUT.csv)")
+    flatten_parser.set_defaults(function=flatten_pbi)
+
+    scenario_parser = subparsers.add_parser("scenario", help="Compare the headline totals under candidate exclude lists with the last run")
+    scenario_parser.add_argument("--config", default=argparse.SUPPRESS, help="Config file to run with (default .\\config.json)")
+    scenario_parser.add_argument("folders", nargs="+", help="Folders each holding a candidate Fact Table Exclude List.csv and/or Fact Table Exclude List INF.csv")
+    scenario_parser.add_argument("--output", default=None, help="Write the differences to this csv instead of printing them")
+    scenario_parser.set_defaults(function=scenario)
+
+    serve_parser = subparsers.add_parser("serve", help="Keep the extracted and base data in memory and regenerate outputs on request")
+    serve_parser.add_argument("--config", default=argparse.SUPPRESS, help="Config file to run with (default .\\config.json)")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default 127.0.0.1)")
+    serve_parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default 8765)")
+    serve_parser.set_defaults(function=serve)
+
+    args = parser.parse_args()
 
-    pipeline_wrapper.run(config)
+    ## Without a subcommand the earlier --backfill and --resume flags still work
+    if args.command is None:
+        if args.backfill:
+            args.start_month, args.end_month = args.backfill
+            backfill(args)
+        else:
+            run(args)
+    else:
+        args.function(args)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
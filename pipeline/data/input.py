@@ -1,22 +1,27 @@
-import pyodbc as dbc
 import json
-import sqlalchemy
-from sqlalchemy.engine import URL
-from sqlalchemy import text as sql_text
 import pandas as pd
 from pathlib import Path
 from pipeline.utils import params
 import glob
 import os
+import functools
 
 def create_sql_connection(connection_details: str):
     """
     Create connection to sql servers to load data in
     Args: 
-        connection_details (str): Details of the database to connect to 
+        connection_details (str): ODBC connection string of the database to connect to, or a SQLAlchemy URL
     Returns:
         connection variable
     """
+    ## sqlalchemy is only imported when something is extracted, not by runs that only read files
+    import sqlalchemy
+    from sqlalchemy.engine import URL
+
+    ## A full SQLAlchemy URL, e.g. sqlite:///pomi.db for a local stand-in database, is used as it is
+    if "://" in connection_details:
+        return sqlalchemy.create_engine(connection_details)
+
     connection_url = URL.create(
         "mssql+pyodbc", query={"odbc_connect": connection_details}
     )
@@ -29,16 +34,22 @@ def load_json_config_file(path):
     return file
 
 
-def get_pomi_sql_strings(rpsd: str, rped: str) -> pd.DataFrame:
+def get_pomi_sql_strings(rpsd: str, rped: str, field_keys: list = None) -> pd.DataFrame:
     """
     Create strings to import POMI data from sql. Columns imported and filters can be changed here
      
     Args:
         rpsd (str): report period start date in the format YYYY-MM-DD
         rped (str): report period end date in the format YYYY-MM-DD
+        field_keys (list): Field_Key values to import from the fact tables and FIELD_DIM, see column_plan. All of
+            them by default
     Returns:
          pd.DataFrame: five strings for each of the inputs from sql to be used to import data
     """
+    field_key_filter = ""
+    if field_keys is not None:
+        field_key_filter = "Field_Key IN ({})".format(", ".join(str(int(key)) for key in field_keys))
+
     gp_dim_sql_str = """
     SELECT 
     GP_Key, 
@@ -55,18 +66,21 @@ def get_pomi_sql_strings(rpsd: str, rped: str) -> pd.DataFrame:
     SELECT * 
     FROM ic.PRIM_POMI_FACT
     WHERE Report_End between '{}' and '{}'
-    """.format(rpsd, rped)
+    {}
+    """.format(rpsd, rped, "AND " + field_key_filter if field_key_filter else "")
 
     prim_pomi_inf_sql_str = """
     SELECT * 
     FROM ic.PRIM_POMI_FACT_INF
     WHERE Report_End between '{}' and '{}'
-    """.format(rpsd, rped)
+    {}
+    """.format(rpsd, rped, "AND " + field_key_filter if field_key_filter else "")
 
     prim_pomi_field_sql_str = """
     SELECT *
     FROM ic.PRIM_POMI_FIELD_DIM
-    """
+    {}
+    """.format("WHERE " + field_key_filter if field_key_filter else "")
 
     gpes_sites_sql_str = """
     SELECT *
@@ -154,38 +168,64 @@ def get_mapping_sql_query_strings(rpsd: str, rped: str) -> str:
     return open_active_sql_str, sub_icb_mapping_sql_str, icb_mapping_sql_str, region_mapping_sql_str
 
 
-def get_sql_data(sql_str: str, connection: str) -> pd.DataFrame:
+def get_sql_data(sql_str: str, connection: str, chunksize: int = None) -> pd.DataFrame:
     """
-    Read in SQL data based on SQL str using specified connection
+    Read in SQL data based on SQL str using specified connection. With a chunksize the rows are fetched and
+    converted a chunk at a time, which avoids holding every row as python objects at once.
     """
-    return pd.read_sql(sql=sql_text(sql_str), con=connection.connect())
+    from sqlalchemy import text as sql_text
+
+    if chunksize is None:
+        return pd.read_sql(sql=sql_text(sql_str), con=connection.connect())
+
+    chunks = pd.read_sql(sql=sql_text(sql_str), con=connection.connect(), chunksize=chunksize)
+    return pd.concat(chunks, ignore_index=True)
 
 
-def get_exclude_list() -> pd.DataFrame:
+def parse_date_keys(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Read the exclude list in from the repo
+    Convert the Report_End and SYS_Timestamp columns of an extract to datetime64, so the report period filters, the
+    exclude list joins and the month comparisons work on dates rather than strings
     """
-    filepath = Path(params.params["ROOT_DIR"]) / params.params["DATA_FOLDER"] / "Fact Table Exclude List.csv"
+    for col in ['Report_End','SYS_Timestamp']:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col])
 
-    #HA added index_col=False param below
-    exclude_list = pd.read_csv(filepath, names=['SYS_Timestamp','Supplier'], index_col=False)
+    return df
+
+
+def parse_exclude_list(exclude_list: pd.DataFrame) -> pd.DataFrame:
+    """
+    Parse the SAS formatted timestamps of an exclude list, e.g. 05JAN2023:10:30:00, to datetime64
+    """
     exclude_list['SYS_Timestamp'] = pd.to_datetime(exclude_list['SYS_Timestamp'], format=('%d%b%Y:%H:%M:%S'))
-    exclude_list['SYS_Timestamp'] = pd.to_datetime(exclude_list['SYS_Timestamp']).dt.strftime('%Y-%m-%d %H:%M:%S')
 
     return exclude_list
 
 
-def get_inf_exclude_list() -> pd.DataFrame:
+def get_exclude_list(folder: str = None) -> pd.DataFrame:
     """
-    Read the informatica exclude list in from the repo
+    Read the exclude list in from the repo, or from another folder holding a candidate list
     """
-    filepath = Path(params.params["ROOT_DIR"]) / params.params["DATA_FOLDER"] / "Fact Table Exclude List INF.csv"
+    folder = folder or Path(params.params["ROOT_DIR"]) / params.params["DATA_FOLDER"]
+    filepath = Path(folder) / "Fact Table Exclude List.csv"
+
+    #HA added index_col=False param below
+    exclude_list = pd.read_csv(filepath, names=['SYS_Timestamp','Supplier'], index_col=False)
+
+    return parse_exclude_list(exclude_list)
+
+
+def get_inf_exclude_list(folder: str = None) -> pd.DataFrame:
+    """
+    Read the informatica exclude list in from the repo, or from another folder holding a candidate list
+    """
+    folder = folder or Path(params.params["ROOT_DIR"]) / params.params["DATA_FOLDER"]
+    filepath = Path(folder) / "Fact Table Exclude List INF.csv"
     
     inf_exclude_list = pd.read_csv(filepath, names=['SYS_Timestamp','Supplier'])
-    inf_exclude_list['SYS_Timestamp'] = pd.to_datetime(inf_exclude_list['SYS_Timestamp'], format=('%d%b%Y:%H:%M:%S'))
-    inf_exclude_list['SYS_Timestamp'] = pd.to_datetime(inf_exclude_list['SYS_Timestamp']).dt.strftime('%Y-%m-%d %H:%M:%S')
 
-    return inf_exclude_list
+    return parse_exclude_list(inf_exclude_list)
 
 def get_trend_monitor_template_path(): 
     """
@@ -193,19 +233,34 @@ def get_trend_monitor_template_path():
     """
     return Path(params.params["ROOT_DIR"]) / params.params["DATA_FOLDER"] / "Trend_Monitor_Template.xlsx"
 
+@functools.lru_cache(maxsize=None)
+def read_participation_file(path: str, modified: float, skiprows: int = 0) -> pd.DataFrame:
+    """
+    Read a participation or QS status csv. Cached on path and modified time so the file is only parsed again when it
+    changes on disk. The returned DataFrame is shared between callers and should not be changed in place.
+    """
+    return pd.read_csv(path, skiprows=skiprows)
+
+
 def get_practicipation_dataframes(root):
     """
+    Get the latest GPWT participation file and QS part status file from the inputs folder
+
+    Args:
+        root (str): Root directory containing the Inputs folder
+    Returns:
+        pd.DataFrame: Participation file and QS part status file
     """
-    pattern = os.path.join(f"{root}\\Inputs\\", "GPWT_PARTICIPATION*.csv")
+    pattern = os.path.join(root, params.params["DATA_FOLDER"], "GPWT_PARTICIPATION*.csv")
     csv_files = glob.glob(pattern)
     part_csv = csv_files[-1]
     print(f"Using the {part_csv} file")
-    prac_df = pd.read_csv(part_csv)
+    prac_df = read_participation_file(part_csv, os.path.getmtime(part_csv))
 
-    pattern = os.path.join(f"{root}\\Inputs\\", "QS Part Status*.csv")
+    pattern = os.path.join(root, params.params["DATA_FOLDER"], "QS Part Status*.csv")
     csv_files = glob.glob(pattern)
     status_csv = csv_files[-1]
     print(f"Using the {status_csv} file")
-    status_df = pd.read_csv(status_csv, skiprows=9)
+    status_df = read_participation_file(status_csv, os.path.getmtime(status_csv), skiprows=9)
 
-    return prac_df, status_df
\ No newline at end of file
+    return prac_df, status_df
@@ -0,0 +1,339 @@
+import pandas as pd
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from pipeline.data import input
+
+## Field keys reported as a status, 2 = enabled, 1 = not enabled
+flag_field_keys = [21, 22, 23, 24, 25, 26, 27, 61, 126, 127, 130]
+
+suppliers = [
+    ("EMIS", 0.55),
+    ("TPP", 0.40),
+    ("VISION", 0.05),
+    ]
+
+regions = [
+    ("Y56", "E40000003", "LONDON COMMISSIONING REGION"),
+    ("Y58", "E40000006", "SOUTH WEST COMMISSIONING REGION"),
+    ("Y59", "E40000005", "SOUTH EAST COMMISSIONING REGION"),
+    ("Y60", "E40000011", "MIDLANDS COMMISSIONING REGION"),
+    ("Y61", "E40000007", "EAST OF ENGLAND COMMISSIONING REGION"),
+    ("Y62", "E40000010", "NORTH WEST COMMISSIONING REGION"),
+    ("Y63", "E40000012", "NORTH EAST AND YORKSHIRE COMMISSIONING REGION"),
+    ]
+
+def get_report_ends(report_month: str, months: int) -> list:
+    """
+    Month end dates, oldest first, for the months up to and including report_month
+    """
+    report_month = pd.to_datetime(report_month).date()
+
+    return [
+        str(report_month + relativedelta(months=-i) + relativedelta(day=31))
+        for i in reversed(range(months))
+        ]
+
+
+def get_sys_timestamp(report_end: str, supplier_number: int, hour: int = 0) -> str:
+    """
+    Load timestamp for a supplier's submission, a few days after the month end
+    """
+    loaded = pd.to_datetime(report_end) + pd.Timedelta(days=5 + supplier_number, hours=hour)
+
+    return loaded.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def create_geography(practices: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Assign each practice to a Sub ICB, ICB and region, roughly 60 practices per Sub ICB and 2.5 Sub ICBs per ICB
+    """
+    sub_icbs = max(1, practices // 60)
+    icbs = max(1, int(sub_icbs / 2.5))
+
+    sub_icb = rng.integers(0, sub_icbs, practices)
+    icb = sub_icb % icbs
+    region = icb % len(regions)
+
+    return pd.DataFrame({
+        "PRACTICE_CODE": [f"{chr(65 + i % 26)}{81000 + i}" for i in range(practices)],
+        "PRACTICE_NAME": [f"SYNTHETIC PRACTICE {i}" for i in range(practices)],
+        "SUB_ICB_CODE": [f"{sub:02d}X" for sub in sub_icb],
+        "ICB_CODE": [f"Q{icb_number:02d}" for icb_number in icb],
+        "REGION_CODE": [regions[r][0] for r in region],
+        })
+
+
+def create_ons_chd_geo_equivalents(geography: pd.DataFrame) -> pd.DataFrame:
+    """
+    Build the ONS code history table holding the E38 Sub ICB, E54 ICB and E40 region codes
+    """
+    sub_icbs = geography["SUB_ICB_CODE"].drop_duplicates().sort_values()
+    icbs = geography["ICB_CODE"].drop_duplicates().sort_values()
+
+    chd = pd.concat([
+        pd.DataFrame({
+            "DH_GEOGRAPHY_CODE": sub_icbs.values,
+            "GEOGRAPHY_CODE": [f"E38{i:06d}" for i in range(len(sub_icbs))],
+            "GEOGRAPHY_NAME": [f"NHS SYNTHETIC SUB ICB LOCATION {code}" for code in sub_icbs],
+            "DH_GEOGRAPHY_NAME": [f"NHS SYNTHETIC SUB ICB LOCATION {code}" for code in sub_icbs],
+            "ENTITY_CODE": "E38",
+            }),
+        pd.DataFrame({
+            "DH_GEOGRAPHY_CODE": icbs.values,
+            "GEOGRAPHY_CODE": [f"E54{i:06d}" for i in range(len(icbs))],
+            "GEOGRAPHY_NAME": [f"NHS Synthetic Integrated Care Board {code}" for code in icbs],
+            "DH_GEOGRAPHY_NAME": [f"NHS SYNTHETIC INTEGRATED CARE BOARD {code}" for code in icbs],
+            "ENTITY_CODE": "E54",
+            }),
+        pd.DataFrame({
+            "DH_GEOGRAPHY_CODE": [r[0] for r in regions],
+            "GEOGRAPHY_CODE": [r[1] for r in regions],
+            "GEOGRAPHY_NAME": [r[2].title() for r in regions],
+            "DH_GEOGRAPHY_NAME": [r[2] for r in regions],
+            "ENTITY_CODE": "E40",
+            }),
+        ], ignore_index=True)
+
+    chd["DATE_OF_OPERATION"] = "2020-04-01"
+    chd["DATE_OF_TERMINATION"] = None
+
+    return chd
+
+
+def create_gp_dim(geography: pd.DataFrame, report_ends: list, inf_practices: np.ndarray, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Build PRIM_POMI_GP_DIM with one GP_Key per practice per month, plus a second GP_Key for the practices that also
+    submit through Informatica so they appear as duplicate suppliers
+    """
+    practices = len(geography)
+    supplier_number = rng.choice(len(suppliers), practices, p=[s[1] for s in suppliers])
+    list_size = rng.integers(1500, 25000, practices)
+
+    months = []
+    for month, report_end in enumerate(report_ends):
+        ## A small number of practices open or close each month
+        active = rng.random(practices) > 0.005
+        gp_dim = geography.loc[active].copy()
+        gp_dim["Supplier"] = [suppliers[s][0] for s in supplier_number[active]]
+        gp_dim["Supplier_Number"] = supplier_number[active]
+        gp_dim["Total_Patients"] = (list_size[active] * (1 + 0.002 * month)).astype(int)
+        gp_dim["Supplier_Version"] = [f"{s[:1]}V{month % 3 + 1}" for s in gp_dim["Supplier"]]
+        gp_dim["Report_End"] = report_end
+        gp_dim["Source"] = "FACT"
+
+        inf = gp_dim.loc[gp_dim.index.isin(inf_practices)].copy()
+        inf["Source"] = "FACT_INF"
+        months.append(pd.concat([gp_dim, inf]))
+
+    gp_dim = pd.concat(months, ignore_index=True)
+    gp_dim.insert(0, "GP_Key", np.arange(1, len(gp_dim) + 1))
+
+    return gp_dim.rename(columns={
+        "PRACTICE_CODE": "GP_Code",
+        "PRACTICE_NAME": "GP_Name",
+        "REGION_CODE": "Region_Code",
+        "ICB_CODE": "SubRegion_Code",
+        "SUB_ICB_CODE": "CCG_Code",
+        }).assign(
+            Region_Name=lambda df: df["Region_Code"].map({r[0]: r[2] for r in regions}),
+            STP_Name=lambda df: "NHS SYNTHETIC INTEGRATED CARE BOARD " + df["SubRegion_Code"],
+            CCG_Name=lambda df: "NHS SYNTHETIC SUB ICB LOCATION " + df["CCG_Code"],
+        )
+
+
+def create_field_values(field_keys: np.ndarray, list_size: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """
+    Generate plausible values for each field key given the practice list size
+    """
+    values = np.empty(len(field_keys))
+
+    is_flag = np.isin(field_keys, flag_field_keys)
+    values[is_flag] = rng.choice([1, 2], is_flag.sum(), p=[0.1, 0.9])
+
+    ## Patients enabled, occasionally more than the list size so the DQ checks have exceptions to find
+    is_enabled = np.isin(field_keys, [30, 32, 34, 62])
+    values[is_enabled] = np.round(list_size[is_enabled] * rng.beta(4, 6, is_enabled.sum()) * rng.choice([1, 2.5], is_enabled.sum(), p=[0.999, 0.001]))
+
+    is_total = field_keys == 47
+    values[is_total] = rng.poisson(list_size[is_total] * 0.6 * rng.choice([1, 0.01], is_total.sum(), p=[0.998, 0.002]))
+
+    is_count = ~(is_flag | is_enabled | is_total)
+    values[is_count] = rng.poisson(list_size[is_count] * 0.02)
+
+    return values
+
+
+def create_fact(gp_dim: pd.DataFrame, field_keys: list, source: str, coverage: float, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Build a long fact table with one row per GP_Key and field key, for the GP_Keys submitted through source
+    """
+    gp_dim = gp_dim.loc[gp_dim["Source"] == source]
+    field_keys = np.asarray(field_keys)
+
+    gp_index = np.repeat(np.arange(len(gp_dim)), len(field_keys))
+    field_key = np.tile(field_keys, len(gp_dim))
+
+    ## Not every practice reports every field key
+    reported = rng.random(len(gp_index)) < coverage
+    gp_index = gp_index[reported]
+    field_key = field_key[reported]
+
+    ## Each supplier loads each month once, so look the timestamps up rather than formatting one per row
+    loads = gp_dim[["Report_End", "Supplier_Number"]].drop_duplicates()
+    loads["SYS_Timestamp"] = [
+        get_sys_timestamp(r, s, 12 if source == "FACT_INF" else 0)
+        for r, s in zip(loads["Report_End"], loads["Supplier_Number"])
+        ]
+    sys_timestamp = gp_dim.merge(loads, how="left", on=["Report_End", "Supplier_Number"])["SYS_Timestamp"].values
+
+    return pd.DataFrame({
+        "GP_Key": gp_dim["GP_Key"].values[gp_index],
+        "Report_End": gp_dim["Report_End"].values[gp_index],
+        "SYS_Timestamp": sys_timestamp[gp_index],
+        "Field_Key": field_key,
+        "Field_Value": create_field_values(field_key, gp_dim["Total_Patients"].values[gp_index], rng),
+        })
+
+
+def add_excluded_load(fact: pd.DataFrame, gp_dim: pd.DataFrame, report_end: str, supplier: str, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Add a bad earlier load for one supplier and month, which the exclude list removes
+    """
+    supplier_keys = gp_dim.loc[(gp_dim["Supplier"] == supplier) & (gp_dim["Report_End"] == report_end), "GP_Key"]
+    bad_load = fact.loc[fact["GP_Key"].isin(supplier_keys)].copy()
+
+    supplier_number = [s[0] for s in suppliers].index(supplier)
+    bad_load["SYS_Timestamp"] = get_sys_timestamp(report_end, supplier_number, hour=-2)
+    bad_load["Field_Value"] = bad_load["Field_Value"] * rng.uniform(0, 3, len(bad_load)).round()
+
+    return pd.concat([fact, bad_load], ignore_index=True)
+
+
+def to_exclude_list_format(sys_timestamp: str) -> str:
+    """
+    Exclude lists hold timestamps in the SAS datetime format, e.g. 05JAN2023:00:00:00
+    """
+    return pd.to_datetime(sys_timestamp).strftime("%d%b%Y:%H:%M:%S").upper()
+
+
+def create_synthetic_tables(
+        report_month: str = "2023-12-01",
+        practices: int = 6500,
+        months: int = 12,
+        field_keys: int = 141,
+        inf_share: float = 0.02,
+        coverage: float = 0.95,
+        seed: int = 0
+        ) -> dict:
+    """
+    Generate the POMI source tables as they are held on the SQL servers, plus the two exclude lists.
+    At the defaults this is national scale: ~6,500 practices x 12 months x 141 field keys, ~11 million fact rows.
+
+    Args:
+        report_month (str): Report run date in the format YYYY-MM-DD, the latest month generated
+        practices (int): Number of practices
+        months (int): Number of months up to and including report_month
+        field_keys (int): Number of field keys, numbered from 1
+        inf_share (float): Share of practices that also submit through Informatica, creating duplicate suppliers
+        coverage (float): Share of practice and field key combinations that are reported
+        seed (int): Random seed, the same arguments and seed always give the same tables
+
+    Returns:
+        dict: DataFrames named after their SQL table, plus exclude_list and inf_exclude_list in the csv layout
+    """
+    rng = np.random.default_rng(seed)
+    report_ends = get_report_ends(report_month, months)
+    field_key_list = list(range(1, field_keys + 1))
+
+    geography = create_geography(practices, rng)
+    inf_practices = rng.choice(practices, max(1, int(practices * inf_share)), replace=False)
+    gp_dim = create_gp_dim(geography, report_ends, inf_practices, rng)
+
+    fact = create_fact(gp_dim, field_key_list, "FACT", coverage, rng)
+    fact_inf = create_fact(gp_dim, field_key_list, "FACT_INF", coverage, rng)
+
+    ## One bad supplier load in the middle of the period, removed by the exclude list
+    excluded_month = report_ends[len(report_ends) // 2]
+    fact = add_excluded_load(fact, gp_dim, excluded_month, "TPP", rng)
+    exclude_list = pd.DataFrame({
+        "SYS_Timestamp": [to_exclude_list_format(get_sys_timestamp(excluded_month, 1, hour=-2))],
+        "Supplier": ["TPP"],
+        })
+
+    ## One Informatica load is excluded completely
+    inf_excluded_timestamp = fact_inf["SYS_Timestamp"].iloc[0] if len(fact_inf) else get_sys_timestamp(report_ends[0], 0, 12)
+    inf_exclude_list = pd.DataFrame({
+        "SYS_Timestamp": [to_exclude_list_format(inf_excluded_timestamp)],
+        "Supplier": ["INFORMATICA"],
+        })
+
+    fact.insert(0, "FACT_Key", np.arange(1, len(fact) + 1))
+    fact_inf.insert(0, "FACT_Key", np.arange(len(fact) + 1, len(fact) + len(fact_inf) + 1))
+
+    field_dim = pd.DataFrame({
+        "Field_Key": field_key_list,
+        "Column_Key": [f"C{key:03d}" for key in field_key_list],
+        "Field_Name": [f"FIELD_{key}" for key in field_key_list],
+        "Is_Current": 1,
+        "Valid_From": "2017-01-01",
+        "Valid_End": None,
+        "SYS_Timestamp": "2017-01-01 00:00:00",
+        })
+
+    return {
+        "PRIM_POMI_GP_DIM": gp_dim.drop(columns=["Supplier_Number", "Source"]),
+        "PRIM_POMI_FACT": fact,
+        "PRIM_POMI_FACT_INF": fact_inf,
+        "PRIM_POMI_FIELD_DIM": field_dim,
+        "ONS_CHD_GEO_EQUIVALENTS": create_ons_chd_geo_equivalents(geography),
+        "exclude_list": exclude_list,
+        "inf_exclude_list": inf_exclude_list,
+        }
+
+
+def get_mapping_for_period(chd: pd.DataFrame, entity_code: str, prefix: str, name_column: str) -> pd.DataFrame:
+
+    mapping = chd.loc[chd["ENTITY_CODE"] == entity_code]
+
+    return pd.DataFrame({
+        f"{prefix}_CODE": mapping["DH_GEOGRAPHY_CODE"].values,
+        f"{prefix}_ONS_CODE": mapping["GEOGRAPHY_CODE"].values,
+        f"{prefix}_NAME": mapping[name_column].values,
+        })
+
+
+def create_synthetic_extract(tables: dict, rpsd: str, rped: str) -> dict:
+    """
+    Select from the synthetic tables the same columns and rows the SQL queries in input.py return, with the same
+    date parsing as the extraction, giving the data dict that pipeline_wrapper.build_base_data() expects
+    """
+    gp_dim = tables["PRIM_POMI_GP_DIM"]
+    in_period = (gp_dim["Report_End"] >= rpsd) & (gp_dim["Report_End"] <= rped)
+    chd = tables["ONS_CHD_GEO_EQUIVALENTS"]
+
+    def period(df):
+        return input.parse_date_keys(df.loc[(df["Report_End"] >= rpsd) & (df["Report_End"] <= rped)].reset_index(drop=True))
+
+    return {
+        "gp_dim_df": gp_dim.loc[in_period, ["GP_Key", "GP_Code", "Supplier", "GP_Name", "Total_Patients", "Supplier_Version"]]
+            .rename(columns={"GP_Code": "PRACTICE_CODE", "GP_Name": "PRACTICE_NAME"})
+            .reset_index(drop=True),
+        "prim_pomi_df": period(tables["PRIM_POMI_FACT"]),
+        "prim_pomi_inf_df": period(tables["PRIM_POMI_FACT_INF"]),
+        "prim_pomi_field_df": input.parse_date_keys(tables["PRIM_POMI_FIELD_DIM"].copy()),
+        "open_active_df": gp_dim.loc[in_period, ["GP_Code", "GP_Name", "Region_Code", "Region_Name", "SubRegion_Code", "STP_Name", "CCG_Code", "CCG_Name", "Report_End"]]
+            .rename(columns={
+                "GP_Code": "PRACTICE_CODE",
+                "GP_Name": "PRACTICE_NAME",
+                "Region_Code": "REGION_CODE",
+                "SubRegion_Code": "ICB_CODE",
+                "CCG_Code": "SUB_ICB_CODE",
+                })
+            .reset_index(drop=True)
+            .pipe(input.parse_date_keys),
+        "exclude_list_df": input.parse_exclude_list(tables["exclude_list"].copy()),
+        "inf_exclude_list_df": input.parse_exclude_list(tables["inf_exclude_list"].copy()),
+        "sub_icb_mapping_df": get_mapping_for_period(chd, "E38", "SUB_ICB", "GEOGRAPHY_NAME"),
+        "icb_mapping_df": get_mapping_for_period(chd, "E54", "ICB", "DH_GEOGRAPHY_NAME"),
+        "region_mapping_df": get_mapping_for_period(chd, "E40", "REGION", "DH_GEOGRAPHY_NAME"),
+        }
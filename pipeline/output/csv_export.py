@@ -1,42 +1,47 @@
 import pandas as pd
 from pipeline.utils import params
+from pipeline.processing import create_csv
 import datetime
 import os
+import time
 import zipfile
-import xlwings
-
-def create_xlsb_file(df, output_folder, data_start, data_end):
-    """Creates xlsb file and allows user to run again if errors occured.
-    """
-    try: 
-        xlsb_filepath = f"{output_folder}\\RESTRICTED_POMI_{data_start}_to_{data_end}.xlsb"
-        wb = xlwings.Book()
-        sht = wb.sheets[0]
-        
-        # Write column names to the first row
-        sht.range("A1").expand('right').value = df.columns.tolist()
-        
-        # Write DataFrame values starting from the second row
-        sht.range("A2").value = df.values
-        
-        wb.save(xlsb_filepath)
-        wb.close()
-        
-    except Exception as e:
-        print("An error occured: The process was interrupted. Please close any excel files that are open.", e)
-        while True:
-            answer = input("Do you want to try to run the xlsb process again? (Y/N)")
-            if answer.upper() == "Y":
-                try:
-                    create_xlsb_file(df, output_folder, data_end, data_end)
-                    break
-                except Exception as e:
-                    print("An error occured: The process was interrupted. Please close any excel files that are open.", e)
-            elif answer.upper() == "N":
-                print("Exiting xlsb process, continuing POMI process.")
-                break
-            else:
-                print("Invalid input. Please enter Y or N")
+
+def create_xlsb_file(df, output_folder, data_start, data_end, attempts: int = 3, wait_seconds: float = 10):
+    """Creates xlsb file, trying again a fixed number of times if errors occured.
+    It runs as an output stage, possibly on a worker thread, so it doesn't prompt. If every attempt fails the error
+    is raised and the stage fails, the csv and zip have already been written.
+    """
+    import xlwings
+
+    xlsb_filepath = os.path.join(output_folder, f"RESTRICTED_POMI_{data_start}_to_{data_end}.xlsb")
+
+    for attempt in range(1, attempts + 1):
+        try: 
+            # Output stages can run on worker threads, which need COM initialised before driving Excel
+            try:
+                import pythoncom
+                pythoncom.CoInitialize()
+            except ImportError:
+                pass
+
+            wb = xlwings.Book()
+            sht = wb.sheets[0]
+            
+            # Write column names to the first row
+            sht.range("A1").expand('right').value = df.columns.tolist()
+            
+            # Write DataFrame values starting from the second row
+            sht.range("A2").value = df.values
+            
+            wb.save(xlsb_filepath)
+            wb.close()
+            return
+
+        except Exception as e:
+            print(f"An error occured writing the xlsb file (attempt {attempt} of {attempts}). Please close any excel files that are open.", e)
+            if attempt == attempts:
+                raise
+            time.sleep(wait_seconds)
 
 
 def get_export_location(sub_folder: str) -> str:
@@ -48,36 +53,38 @@ def get_export_location(sub_folder: str) -> str:
         str: Filepath for all exports to go to 
     """
     root = params.params["ROOT_DIR"]
-    output_folder = f"{root}\\OUTPUTS\\{sub_folder}"
+    output_folder = os.path.join(root, "OUTPUTS", sub_folder)
 
     return output_folder
 
 
-def write_pcd_output(df: pd.DataFrame):
+def write_pcd_output(df: pd.DataFrame, create_xlsb: bool = True):
     """
     Writes the main POMI file to the output folder with the correct file name     
 
     Args:
         df (pd.DataFrame): The final pcd output after all processing has been applied
+        create_xlsb (bool): Also write the xlsb copy, which needs Excel installed
     """   
-    print("Warning! Excel will open while attempting to write a xlsb file. The excel will automatically close when the process is done.")
     output_folder = get_export_location("PUBLICATION")
 
     data_start = params.get_financial_year_export()
     data_end = params.get_export_dates()
     filename = f"POMI_{data_start}_to_{data_end}.csv"
 
-    output_path = f"{output_folder}\\{filename}"
+    output_path = os.path.join(output_folder, filename)
     df.to_csv(output_path, index=False)
 
     print("Zipping csv file")
     #zip file
-    with zipfile.ZipFile(f"{output_folder}\\POMI_{data_start}_to_{data_end}.zip","w") as zipMe:
+    with zipfile.ZipFile(os.path.join(output_folder, f"POMI_{data_start}_to_{data_end}.zip"),"w") as zipMe:
         zipMe.write(output_path, arcname=filename, compress_type=zipfile.ZIP_DEFLATED)
 
-    print("Making xlsb file")
-    #xlsb file
-    create_xlsb_file(df, output_folder, data_start, data_end)
+    if create_xlsb:
+        print("Making xlsb file")
+        print("Warning! Excel will open while attempting to write a xlsb file. The excel will automatically close when the process is done.")
+        #xlsb file
+        create_xlsb_file(df, output_folder, data_start, data_end)
 
 
 def write_choices_output(df: pd.DataFrame):
@@ -93,7 +100,7 @@ def write_choices_output(df: pd.DataFrame):
     data_end = params.get_export_dates()
     filename = f"CHOICES_POMI_SOURCE_{data_end}.csv"
 
-    output_path = f"{output_folder}\\{filename}"
+    output_path = os.path.join(output_folder, filename)
 
     df = df.sort_values(by=["practice_code"], ascending=True)
 
@@ -113,23 +120,96 @@ def write_benefits_output(df: pd.DataFrame):
     data_end = params.get_export_dates()
     filename = f"MONTH_SUMMARY_DATASET_{data_end}.csv"
 
-    output_path = f"{output_folder}\\{filename}"
+    output_path = os.path.join(output_folder, filename)
 
     df.to_csv(output_path, index=False)
 
 
-def write_pbi_output(df: pd.DataFrame):
+def write_pbi_output(df: pd.DataFrame, filename: str = "WORK_POMI_ALL_OUT.csv"):
     """
     Writes the PowerBI POMI file to the output folder with the correct file name     
 
     Args:
         df (pd.DataFrame): The final PBI POMI output after all processing has been applied
+        filename (str): Name of the file, backfill runs add the report month so months don't overwrite each other
     """   
 
     output_folder = get_export_location("PBI")
 
-    filename = f"WORK_POMI_ALL_OUT.csv"
+    output_path = os.path.join(output_folder, filename)
+
+    df.to_csv(output_path, index=False)
+
+pbi_layouts = ["flat", "star", "both"]
+
+def get_pbi_layout(config: dict = None) -> str:
+    """
+    Layout of the PBI output from "pbi_layout" in the config: "flat" for the single WORK_POMI_ALL_OUT table (the
+    default), "star" for the practice table and one table per geography level, or "both"
+    """
+    layout = (config or {}).get("pbi_layout") or "flat"
+    if layout not in pbi_layouts:
+        raise ValueError(f"Unknown pbi_layout {layout}, expected one of {', '.join(pbi_layouts)}")
+
+    return layout
 
-    output_path = f"{output_folder}\\{filename}"
 
-    df.to_csv(output_path, index=False)
\ No newline at end of file
+def get_pbi_star_schema_paths(filename: str = "WORK_POMI_ALL_OUT.csv", tables: list = None) -> dict:
+    """
+    Files of the PBI star schema tables in OUTPUTS\\PBI STAR, named after the PBI file they replace, e.g.
+    WORK_POMI_ALL_OUT_PRACTICE.csv
+
+    Returns:
+        dict: Filepaths keyed by table name
+    """
+    tables = tables or ["practice"] + [table for table, _, _ in create_csv.pbi_geography_levels]
+    stem = os.path.splitext(filename)[0]
+
+    return {table: os.path.join(get_export_location("PBI STAR"), f"{stem}_{table.upper()}.csv") for table in tables}
+
+
+def write_pbi_star_schema(tables: dict, filename: str = "WORK_POMI_ALL_OUT.csv") -> dict:
+    """
+    Writes the PowerBI POMI star schema, one csv per table
+
+    Args:
+        tables (dict): create_csv.create_pbi_star_schema() output
+        filename (str): Name of the flat PBI file the tables are named after
+    Returns:
+        dict: Filepaths keyed by table name
+    """
+    paths = get_pbi_star_schema_paths(filename, list(tables))
+    os.makedirs(get_export_location("PBI STAR"), exist_ok=True)
+
+    for table, df in tables.items():
+        df.to_csv(paths[table], index=False)
+
+    return paths
+
+
+def read_pbi_star_schema(filename: str = "WORK_POMI_ALL_OUT.csv") -> dict:
+    """
+    Read the PBI star schema tables written by write_pbi_star_schema(), with codes and names kept as text so the
+    tables join and write out as they were built
+    """
+    text_columns = [
+        'COUNTRY_CODE','RegionCode','RegionName','ICB_CODE','ICB_NAME','SUB_ICB_CODE','SUB_ICB_NAME','GPPracticeCode',
+        'GPPracticeName','Supplier','report_period_end'
+    ]
+
+    return {
+        table: pd.read_csv(path, dtype={col: str for col in text_columns})
+        for table, path in get_pbi_star_schema_paths(filename).items()
+    }
+
+
+def write_flat_pbi_output(output_path: str, filename: str = "WORK_POMI_ALL_OUT.csv") -> str:
+    """
+    Rebuild the flat PBI file from the star schema tables of a run written with "pbi_layout" set to star
+
+    Returns:
+        str: output_path
+    """
+    create_csv.flatten_pbi_star_schema(read_pbi_star_schema(filename)).to_csv(output_path, index=False)
+
+    return output_path
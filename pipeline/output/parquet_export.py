@@ -0,0 +1,171 @@
+import pandas as pd
+from pipeline.utils import params, rename_columns
+from pipeline.output import csv_export
+import os
+
+parquet_output_names = ["pbi", "pcd", "benefits"]
+
+## Rows per row group, each with its own min/max statistics so readers can skip months they don't need
+row_group_size = 100000
+
+def get_base_data_location(run_name: str = None) -> str:
+    """
+    Folder holding the base data of one run. Runs are stored as run=MMMYYYY folders so the query interface can read
+    every run at once and filter on the run column.
+
+    Args:
+        run_name (str): Report month of the run e.g. DEC2023, defaults to the current report month
+    Returns:
+        str: Filepath of the run's base data folder
+    """
+    run_name = run_name or params.get_export_dates()
+
+    return os.path.join(csv_export.get_export_location("BASE DATA"), f"run={run_name}")
+
+
+def write_base_data(df: pd.DataFrame, name: str) -> str:
+    """
+    Writes one base data table of the run as Parquet, replacing any earlier copy for the same month
+
+    Args:
+        df (pd.DataFrame): all_pomi_recoded_df or all_pomi_adjusted_df
+        name (str): "recoded" or "adjusted", the name of the file and of its view in pipeline.query
+    Returns:
+        str: Filepath of the written file
+    """
+    output_folder = get_base_data_location()
+    os.makedirs(output_folder, exist_ok=True)
+
+    output_path = os.path.join(output_folder, f"{name}.parquet")
+    tmp_path = f"{output_path}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+
+    return output_path
+
+
+def get_parquet_outputs(config: dict = None) -> list:
+    """
+    Datasets also exported as Parquet, from "parquet_outputs" in the config as a list or a comma separated string
+    of pbi, pcd and benefits. Empty means none.
+    """
+    outputs = (config or {}).get("parquet_outputs") or []
+    if isinstance(outputs, str):
+        outputs = [output.strip() for output in outputs.split(",") if output.strip()]
+
+    unknown = [output for output in outputs if output not in parquet_output_names]
+    if unknown:
+        raise ValueError(f"Unknown parquet_outputs {', '.join(unknown)}, expected some of {', '.join(parquet_output_names)}")
+
+    return [output for output in parquet_output_names if output in outputs]
+
+
+def get_pbi_measures() -> list:
+    """
+    PBI columns holding counts and flags, which are the renamed field keys, patient numbers and online bookings
+    """
+    return [
+        new for old, new in rename_columns.rename_pbi_output.items()
+        if old.startswith('FIELD_KEY_') or old in ['Total_Patients', 'online_book_cancel_count']
+    ]
+
+
+def check_pbi_schema(df: pd.DataFrame) -> None:
+    """
+    Check the PBI dataset against rename_columns.rename_pbi_output before it's written as Parquet. Every renamed
+    column has to be there, report_period_end has to be a date, and the measures and their national, regional,
+    ICB and Sub ICB versions have to be numeric, so a change the dashboard doesn't expect fails the export rather than
+    the refresh.
+    """
+    errors = []
+
+    missing = [col for col in rename_columns.rename_pbi_output.values() if col not in df.columns]
+    if missing:
+        errors.append(f"missing columns {', '.join(missing)}")
+
+    if 'report_period_end' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['report_period_end']):
+        errors.append(f"report_period_end is {df['report_period_end'].dtype}, not a date")
+
+    measures = get_pbi_measures()
+    measure_columns = [
+        col for col in df.columns
+        if col.endswith('_PRAC_COUNT') or any(col == measure or col.endswith(f"_{measure}") for measure in measures)
+    ]
+    not_numeric = [col for col in measure_columns if not pd.api.types.is_numeric_dtype(df[col])]
+    if not_numeric:
+        errors.append(f"non numeric measures {', '.join(not_numeric)}")
+
+    if errors:
+        raise ValueError(f"PBI dataset doesn't match its Parquet schema: {'; '.join(errors)}")
+
+
+def to_parquet_types(df: pd.DataFrame, date_formats: dict = None) -> pd.DataFrame:
+    """
+    Type a dataset for Parquet. Text columns become categoricals, stored dictionary encoded so each repeated name is
+    written once per row group, and dates formatted as text for the csv are parsed back into dates.
+
+    Args:
+        df (pd.DataFrame): Output dataset as written to csv
+        date_formats (dict): Format of each text date column, e.g. {'report_period_end': '%d-%b-%y'}
+    Returns:
+        pd.DataFrame: Typed copy of df
+    """
+    df = df.copy()
+
+    for col, date_format in (date_formats or {}).items():
+        df[col] = pd.to_datetime(df[col], format=date_format)
+
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].astype('category')
+
+    return df
+
+
+def write_parquet_output(df: pd.DataFrame, sub_folder: str, filename: str, date_formats: dict = None) -> str:
+    """
+    Write an output dataset as typed, dictionary encoded Parquet with statistics on each row group. Rows are ordered
+    by report_period_end so each row group covers as few months as possible.
+
+    Returns:
+        str: Filepath of the written file
+    """
+    df = to_parquet_types(df, date_formats)
+    if 'report_period_end' in df.columns:
+        df = df.sort_values(by='report_period_end', kind='mergesort')
+
+    output_folder = csv_export.get_export_location(sub_folder)
+    os.makedirs(output_folder, exist_ok=True)
+
+    output_path = os.path.join(output_folder, filename)
+    tmp_path = f"{output_path}.tmp"
+    df.to_parquet(tmp_path, index=False, compression="zstd", row_group_size=row_group_size, write_statistics=True)
+    os.replace(tmp_path, output_path)
+
+    return output_path
+
+
+def write_pbi_parquet(df: pd.DataFrame, filename: str = "WORK_POMI_ALL_OUT.parquet") -> str:
+    """
+    Writes the PowerBI POMI dataset as Parquet next to the csv, after checking its schema
+    """
+    check_pbi_schema(df)
+
+    return write_parquet_output(df, "PBI", filename)
+
+
+def write_pcd_parquet(df: pd.DataFrame) -> str:
+    """
+    Writes the main POMI publication dataset as Parquet next to the csv
+    """
+    filename = f"POMI_{params.get_financial_year_export()}_to_{params.get_export_dates()}.parquet"
+
+    return write_parquet_output(df, "PUBLICATION", filename, {'report_period_end': '%d-%b-%y'})
+
+
+def write_benefits_parquet(df: pd.DataFrame) -> str:
+    """
+    Writes the benefits POMI dataset as Parquet next to the csv
+    """
+    filename = f"MONTH_SUMMARY_DATASET_{params.get_export_dates()}.parquet"
+
+    return write_parquet_output(df, "BENEFITS", filename, {'report_period_end': '%d%b%Y'})
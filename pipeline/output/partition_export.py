@@ -0,0 +1,158 @@
+"""
+Month partitioned copies of the rolling outputs. Each month of a dataset is written as its own csv, named by the
+sha256 of its contents, under {root_directory}\\OUTPUTS\\PARTITIONS\\{dataset}\\{YYYY-MM}. A partition is only written
+if no earlier run produced exactly the same rows, and each run's manifest lists its partitions and which of them
+changed since the previous report month, so only those need publishing again. The full csv can be assembled from
+a manifest's partitions when it's needed.
+"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+import pandas as pd
+from pipeline.utils import params
+from pipeline.output import csv_export
+
+partitioned_output_names = ["pbi", "pcd"]
+
+def get_partitioned_outputs(config: dict = None) -> list:
+    """
+    Datasets also written as month partitions, from "partitioned_outputs" in the config as a list or a comma
+    separated string of pbi and pcd. Empty means none.
+    """
+    outputs = (config or {}).get("partitioned_outputs") or []
+    if isinstance(outputs, str):
+        outputs = [output.strip() for output in outputs.split(",") if output.strip()]
+
+    unknown = [output for output in outputs if output not in partitioned_output_names]
+    if unknown:
+        raise ValueError(f"Unknown partitioned_outputs {', '.join(unknown)}, expected some of {', '.join(partitioned_output_names)}")
+
+    return [output for output in partitioned_output_names if output in outputs]
+
+
+def get_partition_location(dataset: str) -> str:
+
+    return os.path.join(csv_export.get_export_location("PARTITIONS"), dataset.upper())
+
+
+def get_manifest_path(folder: str, run_month: str) -> str:
+    """
+    Manifest of one report month, run_month in the format YYYY-MM so manifests sort in run order
+    """
+    return os.path.join(folder, f"manifest_{run_month}.json")
+
+
+def load_manifest(folder: str, run_month: str = None, before: bool = False) -> dict:
+    """
+    Load the manifest of run_month, or with before=True the latest one before it. Without run_month the latest
+    manifest is loaded.
+
+    Returns:
+        dict: The manifest, empty if there isn't one
+    """
+    paths = sorted(glob.glob(os.path.join(folder, "manifest_*.json")))
+    if run_month is not None:
+        path = get_manifest_path(folder, run_month)
+        paths = [p for p in paths if p < path] if before else [p for p in paths if p == path]
+
+    if not paths:
+        return {}
+
+    with open(paths[-1]) as f:
+        return json.load(f)
+
+
+def write_file(data: bytes, path: str) -> None:
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def write_partitions(df: pd.DataFrame, dataset: str, month_column: str, date_format: str = None, sort_by: list = None) -> dict:
+    """
+    Split an output into month partitions, write the ones no earlier run has written, and record the run's manifest.
+
+    Args:
+        df (pd.DataFrame): Output dataset as written to csv
+        dataset (str): pbi or pcd, the name of the partition folder
+        month_column (str): Column holding the month of each row
+        date_format (str): Format of month_column if it's been formatted as text for the csv
+        sort_by (list): Columns to order each partition by, for outputs whose row order within a month depends on
+            the other months. By default rows keep the order of df.
+    Returns:
+        dict: The run's manifest
+    """
+    folder = get_partition_location(dataset)
+    run_month = params.params["report_month"].strftime("%Y-%m")
+    previous = load_manifest(folder, run_month, before=True).get("partitions", {})
+
+    dates = df[month_column] if date_format is None else pd.to_datetime(df[month_column], format=date_format)
+
+    partitions = {}
+    for month, rows in df.groupby(dates.dt.strftime("%Y-%m")):
+        if sort_by:
+            rows = rows.sort_values(by=sort_by, kind='mergesort')
+        data = rows.to_csv(index=False).encode()
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(month, f"{digest[:16]}.csv")
+
+        if not os.path.exists(os.path.join(folder, path)):
+            write_file(data, os.path.join(folder, path))
+        partitions[month] = {"file": path, "sha256": digest, "rows": len(rows)}
+
+    manifest = {
+        "run": params.get_export_dates(),
+        "partitions": partitions,
+        "changed": [month for month, partition in partitions.items() if previous.get(month, {}).get("sha256") != partition["sha256"]],
+        "removed": [month for month in previous if month not in partitions],
+    }
+    write_file(json.dumps(manifest, indent=2).encode(), get_manifest_path(folder, run_month))
+    print(f"{len(manifest['changed'])} of {len(partitions)} {dataset} month partitions changed")
+
+    return manifest
+
+
+def assemble_partitions(dataset: str, output_path: str, run_month: str = None) -> str:
+    """
+    Join a run's partitions back into a single csv, with the header once and the months in order. For pcd this is
+    the same file as the monolithic csv, for pbi it has the same rows ordered by month.
+
+    Args:
+        dataset (str): pbi or pcd
+        output_path (str): csv to write
+        run_month (str): Report month of the run in the format YYYY-MM, the latest run by default
+    Returns:
+        str: output_path
+    """
+    folder = get_partition_location(dataset)
+    manifest = load_manifest(folder, run_month)
+    if not manifest:
+        raise FileNotFoundError(f"No {dataset} partition manifest for {run_month or 'any run'} in {folder}")
+
+    with open(output_path, "wb") as out:
+        for i, partition in enumerate(manifest["partitions"].values()):
+            with open(os.path.join(folder, partition["file"]), "rb") as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(f, out)
+
+    return output_path
+
+
+def write_pbi_partitions(df: pd.DataFrame) -> dict:
+    """
+    The PBI output is only sorted by region, which leaves the order of practices depending on the whole 12 months,
+    so each month is ordered by practice to give the same partition when its rows haven't changed
+    """
+    return write_partitions(df, "pbi", "report_period_end", sort_by=['RegionCode', 'ICB_CODE', 'SUB_ICB_CODE', 'GPPracticeCode', 'Supplier'])
+
+
+def write_pcd_partitions(df: pd.DataFrame) -> dict:
+
+    return write_partitions(df, "pcd", "report_period_end", '%d-%b-%y')
@@ -1,81 +1,916 @@
-from pipeline.utils import params
+from pipeline.utils import params, stage_cache, dag, run_report, profiling, memory, output_selection
 from pipeline.data import input
-from pipeline.processing import mapping, aggregate, create_csv
-from pipeline.output import csv_export, excel_export
+from pipeline.processing import mapping, aggregate, aggregate_chunked, create_csv, exclude_impact, trend_monitor_history, column_plan
+from pipeline.output import csv_export, parquet_export, partition_export
 import pandas as pd
 import subprocess
+import os
+import functools
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dateutil.relativedelta import relativedelta
 
-def run(config: dict) -> None:
+def is_aggregate_by_month(config: dict = None) -> bool:
 
-    print("Getting report period")
-    rpsd = params.get_report_period_start_date()
-    rped = params.get_report_period_end_date()
+    return bool((config or {}).get("aggregate_by_month", False))
 
+
+def extract_pomi_data(config: dict, rpsd: str, rped: str, plan: dict = None) -> dict:
+    """
+    Import the POMI fact tables, field dimension and exclude lists for the report period. When aggregating by month
+    the fact tables are left out, they are read a month at a time by get_fact_months().
+
+    Args:
+        config (dict): Config file containing the connection strings
+        rpsd (str): report period start date in the format YYYY-MM-DD
+        rped (str): report period end date in the format YYYY-MM-DD
+        plan (dict): column_plan.get_plan() giving the field keys to import, all of them by default
+    Returns:
+        dict: DataFrames keyed by name
+    """
     print("Establishing SQL connection")
     pomi_connection = input.create_sql_connection(config["pomi_connection_string"])
-    mapping_connection = input.create_sql_connection(config["mapping_connection_string"])
 
     print("Importing POMI data")
-    gp_dim_sql_str, prim_pomi_sql_str, prim_pomi_inf_sql_str, prim_pomi_field_sql_str, gpes_sites_sql_str = input.get_pomi_sql_strings(rpsd, rped)
+    field_keys = column_plan.get_field_keys(plan)
+    if field_keys is not None:
+        print(f"Importing the {len(field_keys)} field keys the selected outputs use")
+    gp_dim_sql_str, prim_pomi_sql_str, prim_pomi_inf_sql_str, prim_pomi_field_sql_str, gpes_sites_sql_str = input.get_pomi_sql_strings(rpsd, rped, field_keys)
+    open_active_sql_str = input.get_mapping_sql_query_strings(rpsd, rped)[0]
 
-    print("getting gp_dim_df data")
-    gp_dim_df = input.get_sql_data(gp_dim_sql_str, pomi_connection)
+    queries = {
+        "gp_dim_df": gp_dim_sql_str,
+        "prim_pomi_df": prim_pomi_sql_str,
+        "prim_pomi_inf_df": prim_pomi_inf_sql_str,
+        "prim_pomi_field_df": prim_pomi_field_sql_str,
+        "open_active_df": open_active_sql_str,
+    }
 
-    print("getting prim_pomi_df data")
-    prim_pomi_df = input.get_sql_data(prim_pomi_sql_str, pomi_connection)
+    if is_aggregate_by_month(config):
+        del queries["prim_pomi_df"], queries["prim_pomi_inf_df"]
 
-    print("getting prim_pomi_inf_df data")
-    prim_pomi_inf_df = input.get_sql_data(prim_pomi_inf_sql_str, pomi_connection)
+    chunksize = memory.get_sql_chunksize(config)
 
-    print("getting prim_pomi_field_df data")
-    prim_pomi_field_df = input.get_sql_data(prim_pomi_field_sql_str, pomi_connection)
+    data = {}
+    for name, sql_str in queries.items():
+        print(f"getting {name} data")
+        with run_report.stage(f"extract_{name}") as record:
+            data[name] = record["output"] = input.parse_date_keys(input.get_sql_data(sql_str, pomi_connection, chunksize))
 
     print("Reading CSVs")
     print("Getting exclude_list_df")
-    exclude_list_df = input.get_exclude_list()
+    data["exclude_list_df"] = input.get_exclude_list()
     print("Getting inf_exclude_list_df")
-    inf_exclude_list_df = input.get_inf_exclude_list()
+    data["inf_exclude_list_df"] = input.get_inf_exclude_list()
+
+    return data
 
+
+def extract_geography_mappings(config: dict, rpsd: str, rped: str) -> dict:
+    """
+    Import the Sub ICB, ICB and region mappings as they stood at the end of the report period
+    """
     print("Importing mapping data")
+    mapping_connection = input.create_sql_connection(config["mapping_connection_string"])
     open_active_sql_str, sub_icb_mapping_sql_str, icb_mapping_sql_str, region_mapping_sql_str = input.get_mapping_sql_query_strings(rpsd, rped)
 
-    open_active_df = input.get_sql_data(open_active_sql_str, pomi_connection)
-    sub_icb_mapping_df = input.get_sql_data(sub_icb_mapping_sql_str, mapping_connection)
-    icb_mapping_df = input.get_sql_data(icb_mapping_sql_str, mapping_connection)
-    region_mapping_df = input.get_sql_data(region_mapping_sql_str, mapping_connection)
+    with run_report.stage("extract_geography_mappings") as record:
+        record["output"] = {
+            "sub_icb_mapping_df": input.get_sql_data(sub_icb_mapping_sql_str, mapping_connection),
+            "icb_mapping_df": input.get_sql_data(icb_mapping_sql_str, mapping_connection),
+            "region_mapping_df": input.get_sql_data(region_mapping_sql_str, mapping_connection),
+        }
+
+    return record["output"]
+
+
+def get_aggregate_backend(config: dict = None):
+    """
+    Choose the create_all_pomi implementation from "aggregate_backend" in the config, "pandas" (the default) or
+    "polars". Polars is only imported when it's selected.
+
+    Returns:
+        str: Name of the stage in the stage cache
+        function: create_all_pomi for the backend
+    """
+    backend = (config or {}).get("aggregate_backend", "pandas") or "pandas"
+
+    if backend == "pandas":
+        return "create_all_pomi", aggregate.create_all_pomi
+    if backend == "polars":
+        from pipeline.processing import aggregate_polars
+        return "create_all_pomi_polars", aggregate_polars.create_all_pomi
+
+    raise ValueError(f"Unknown aggregate_backend {backend}, expected pandas or polars")
+
+
+def get_report_months(rpsd: str, rped: str) -> list:
+    """
+    Split the report period into months
+
+    Returns:
+        list: (first day, last day) of each month of the period, both in the format YYYY-MM-DD
+    """
+    first = pd.to_datetime(rpsd).date()
+    last = pd.to_datetime(rped).date()
+    month = first.replace(day=1)
+
+    months = []
+    while month <= last:
+        month_end = month + relativedelta(months=1, days=-1)
+        months.append((str(max(month, first)), str(min(month_end, last))))
+        month = month + relativedelta(months=1)
+
+    return months
 
-    mapping_df = mapping.create_mapping_df(open_active_df, sub_icb_mapping_df, icb_mapping_df, region_mapping_df)
+
+def get_fact_months(config: dict, data: dict, rpsd: str, rped: str):
+    """
+    Yield the fact tables one month at a time. If they were already extracted, e.g. when resuming from the stage
+    cache, each month is sliced from data, otherwise each month is read from SQL only when it's needed.
+
+    Yields:
+        tuple: Month in the format YYYY-MM, prim_pomi_df and prim_pomi_inf_df for the month
+    """
+    pomi_connection = None
+    chunksize = memory.get_sql_chunksize(config)
+    field_keys = column_plan.get_field_keys(column_plan.get_plan(config))
+
+    for month_start, month_end in get_report_months(rpsd, rped):
+        name = month_start[:7]
+
+        if "prim_pomi_df" in data:
+            facts = []
+            for df in [data["prim_pomi_df"], data["prim_pomi_inf_df"]]:
+                facts.append(df.loc[df["Report_End"].between(pd.Timestamp(month_start), pd.Timestamp(month_end))])
+        else:
+            if pomi_connection is None:
+                pomi_connection = input.create_sql_connection(config["pomi_connection_string"])
+
+            print(f"getting POMI data for {name}")
+            prim_pomi_sql_str, prim_pomi_inf_sql_str = input.get_pomi_sql_strings(month_start, month_end, field_keys)[1:3]
+            facts = []
+            for sql_str in [prim_pomi_sql_str, prim_pomi_inf_sql_str]:
+                facts.append(input.parse_date_keys(input.get_sql_data(sql_str, pomi_connection, chunksize)))
+
+        yield name, facts[0], facts[1]
+        del facts
+
+
+def build_all_pomi_by_month(data: dict, rpsd: str, rped: str, config: dict, mapping_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Build all_pomi a month at a time through a wide store in a temporary folder, so only one month of the fact
+    tables is held in memory. The output is the same as building it from the full fact tables.
+    """
+    create_all_pomi = get_aggregate_backend(config)[1]
+    store_folder = tempfile.mkdtemp(prefix=f"pomi_store_{params.get_export_dates()}_")
+
+    return aggregate_chunked.create_all_pomi_by_month(
+        get_fact_months(config, data, rpsd, rped),
+        data["gp_dim_df"],
+        data["exclude_list_df"],
+        rpsd,
+        rped,
+        data["inf_exclude_list_df"],
+        data["prim_pomi_field_df"],
+        mapping_df,
+        store_folder,
+        create_all_pomi
+        )
+
+
+def get_mapping_df(data: dict) -> pd.DataFrame:
+    """
+    Practice to Sub ICB, ICB and region mapping from the extracted geography mappings
+    """
+    return mapping.create_mapping_df(
+        data["open_active_df"],
+        data["sub_icb_mapping_df"],
+        data["icb_mapping_df"],
+        data["region_mapping_df"]
+        )
+
+
+def build_all_pomi(data: dict, rpsd: str, rped: str, config: dict = None, manifest: dict = None) -> pd.DataFrame:
+    """
+    Build all_pomi from the extracted data. In low memory mode the extracted data is released from data as soon as
+    all_pomi is built.
+
+    Args:
+        data (dict): Extracted POMI data and geography mappings
+        rpsd (str): report period start date in the format YYYY-MM-DD
+        rped (str): report period end date in the format YYYY-MM-DD
+        config (dict): Config file with the stage cache, aggregate backend and memory settings
+        manifest (dict): Stage cache manifest for the run
+    Returns:
+        pd.DataFrame: all_pomi_df
+    """
+    mapping_df = get_mapping_df(data)
+
+    stage_name, create_all_pomi = get_aggregate_backend(config)
 
     print("Building base data")
-    all_pomi_df = aggregate.create_all_pomi(
+    if is_aggregate_by_month(config):
+        all_pomi_df = build_all_pomi_by_month(data, rpsd, rped, config, mapping_df)
+    else:
+        all_pomi_df = stage_cache.run_stage(
+            config,
+            manifest,
+            stage_name,
+            create_all_pomi,
+            data["prim_pomi_df"],
+            data["gp_dim_df"],
+            data["exclude_list_df"],
+            rpsd,
+            rped,
+            data["prim_pomi_inf_df"],
+            data["inf_exclude_list_df"],
+            data["prim_pomi_field_df"],
+            mapping_df
+            )
+
+    if memory.is_low_memory(config):
+        memory.release(data, list(data))
+    memory.check_memory_budget(stage_name, memory.get_memory_budget(config))
+
+    return all_pomi_df
+
+
+def get_aggregate_workers(config: dict = None) -> int:
+    """
+    Number of months aggregated and recoded at once, from "aggregate_workers" in the config. "auto" uses a process
+    per core.
+    """
+    workers = (config or {}).get("aggregate_workers", 1) or 1
+    if workers == "auto":
+        return os.cpu_count() or 1
+
+    return max(1, int(workers))
+
+
+def build_month_base_data(paths: dict, folder: str, month_start: str, month_end: str, rpsd: str, rped: str, config: dict = None) -> tuple:
+    """
+    Aggregate and recode one month of the report period in a worker process. paths holds the shared reference tables
+    and mapping_df, plus the month's slice of the fact tables if they were already extracted, otherwise the month is
+    read from SQL in the worker. The month's base data is shared back to the parent through folder.
+    """
+    from pipeline.utils import shared_frames
+
+    data = shared_frames.load_frames(paths)
+
+    name, prim_pomi_df, prim_pomi_inf_df = next(get_fact_months(config, data, month_start, month_end))
+    if prim_pomi_df.empty and prim_pomi_inf_df.empty:
+        return None
+
+    columns, all_pomi_recoded_df, all_pomi_adjusted_df = aggregate_chunked.create_month_base_data(
         prim_pomi_df,
-        gp_dim_df, 
-        exclude_list_df,
+        data["gp_dim_df"],
+        data["exclude_list_df"],
         rpsd,
         rped,
-        prim_pomi_inf_df, 
-        inf_exclude_list_df,
-        prim_pomi_field_df,
-        mapping_df
+        prim_pomi_inf_df,
+        data["inf_exclude_list_df"],
+        data["prim_pomi_field_df"],
+        data["mapping_df"],
+        get_aggregate_backend(config)[1],
+        column_plan.get_plan(config)
         )
 
-    all_pomi_recoded_df = aggregate.create_month_summary_base_data(all_pomi_df)
-    all_pomi_adjusted_df = aggregate.create_base_data(all_pomi_recoded_df)
-
-    print("Creating outputs")
-    pcd_output_df = create_csv.create_pcd_output(all_pomi_adjusted_df)
-    choices_output_df = create_csv.create_choices_output(all_pomi_adjusted_df)
-    benefits_output_df = create_csv.create_benefits_dataset(all_pomi_recoded_df)
-    pbi_output_df = create_csv.create_pbi_output(all_pomi_adjusted_df)
-
-    print("Exporting files")
-    csv_export.write_pcd_output(pcd_output_df)
-    csv_export.write_choices_output(choices_output_df)
-    csv_export.write_benefits_output(benefits_output_df)
-    csv_export.write_pbi_output(pbi_output_df)
-    excel_export.write_trend_monitor(all_pomi_adjusted_df)
-
-    print("POMI Job completed. Opening Outputs folder")
-    root = params.params["ROOT_DIR"]
-    output_folder = f"{root}\\OUTPUTS"
-    subprocess.Popen(["explorer", output_folder])
+    return columns, shared_frames.share_frame(all_pomi_recoded_df, folder), shared_frames.share_frame(all_pomi_adjusted_df, folder)
+
+
+@run_report.instrument()
+def build_base_data_by_month(data: dict, rpsd: str, rped: str, config: dict, mapping_df: pd.DataFrame) -> tuple:
+    """
+    Aggregate and recode each month of the report period in a pool of "aggregate_workers" processes. Everything up
+    to create_base_data works within a month, so the months are concatenated in order into the same base data as
+    building the whole period at once. Frames go to and from the workers through shared_frames rather than being
+    pickled.
+
+    Returns:
+        pd.DataFrame: all_pomi_recoded_df and all_pomi_adjusted_df
+    """
+    from pipeline.utils import shared_frames
+
+    reference = {name: data[name] for name in ["gp_dim_df", "exclude_list_df", "inf_exclude_list_df", "prim_pomi_field_df"]}
+    reference["mapping_df"] = mapping_df
+
+    with shared_frames.shared_folder() as folder:
+        reference_paths = shared_frames.share_frames(reference, folder)
+
+        months = []
+        for month_start, month_end in get_report_months(rpsd, rped):
+            paths = dict(reference_paths)
+            if "prim_pomi_df" in data:
+                facts = {}
+                for name in ["prim_pomi_df", "prim_pomi_inf_df"]:
+                    df = data[name]
+                    facts[name] = df.loc[df["Report_End"].between(pd.Timestamp(month_start), pd.Timestamp(month_end))]
+
+                if facts["prim_pomi_df"].empty and facts["prim_pomi_inf_df"].empty:
+                    continue
+                paths.update(shared_frames.share_frames(facts, folder))
+                del facts
+            months.append((paths, month_start, month_end))
+
+        workers = min(get_aggregate_workers(config), len(months))
+        print(f"Building base data for {len(months)} months on {workers} processes")
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(build_month_base_data, paths, folder, month_start, month_end, rpsd, rped, config)
+                for paths, month_start, month_end in months
+            ]
+            results = []
+            for future in futures:
+                result = future.result()
+                if result is not None:
+                    columns, recoded_path, adjusted_path = result
+                    results.append((
+                        columns,
+                        shared_frames.load_frame(recoded_path, memory_map=False),
+                        shared_frames.load_frame(adjusted_path, memory_map=False)
+                        ))
+
+        return aggregate_chunked.merge_month_base_data(results)
+
+
+def build_base_data(data: dict, rpsd: str, rped: str, config: dict = None, manifest: dict = None, adjusted: bool = True):
+    """
+    Build all_pomi and apply the recodes used by the outputs, only keeping the field keys they read if
+    "prune_columns" is set. Each stage is skipped if the stage cache holds its output for the same inputs and code
+    version. With more than one "aggregate_workers" the months are built in a process pool instead, without the
+    stage cache.
+
+    Args:
+        data (dict): Extracted POMI data and geography mappings
+        rpsd (str): report period start date in the format YYYY-MM-DD
+        rped (str): report period end date in the format YYYY-MM-DD
+        config (dict): Config file with the stage cache, aggregate backend and memory settings
+        manifest (dict): Stage cache manifest for the run
+        adjusted (bool): Set to False to skip create_base_data when none of the selected outputs use it
+    Returns:
+        pd.DataFrame: all_pomi_recoded_df and all_pomi_adjusted_df, which is None if it wasn't built
+    """
+    budget = memory.get_memory_budget(config)
+
+    if get_aggregate_workers(config) > 1:
+        all_pomi_recoded_df, all_pomi_adjusted_df = build_base_data_by_month(data, rpsd, rped, config, get_mapping_df(data))
+        memory.check_memory_budget("build_base_data_by_month", budget)
+
+        return all_pomi_recoded_df, all_pomi_adjusted_df
+
+    all_pomi_df = build_all_pomi(data, rpsd, rped, config, manifest)
+
+    plan = column_plan.get_plan(config) or {}
+    column_plan.set_cached_plan(manifest, "base_data", plan or None)
+
+    all_pomi_recoded_df = stage_cache.run_stage(config, manifest, "create_month_summary_base_data", aggregate.create_month_summary_base_data, all_pomi_df, plan.get("all_pomi"))
+    memory.check_memory_budget("create_month_summary_base_data", budget)
+    if not adjusted:
+        return all_pomi_recoded_df, None
+
+    all_pomi_adjusted_df = stage_cache.run_stage(config, manifest, "create_base_data", aggregate.create_base_data, all_pomi_recoded_df, plan.get("adjusted"))
+    memory.check_memory_budget("create_base_data", budget)
+
+    return all_pomi_recoded_df, all_pomi_adjusted_df
+
+
+def is_exclude_list_rerun(config: dict = None) -> bool:
+    """
+    "exclude_list_rerun" reruns only the months affected by exclude list changes, from the stage cache of the last run
+    """
+    return stage_cache.is_enabled(config) and bool(config.get("exclude_list_rerun", False))
+
+
+def rebuild_excluded_months(rpsd: str, rped: str, config: dict, manifest: dict):
+    """
+    Reuse the extraction and base data of the last run for the report month from the stage cache, and rebuild only
+    the months of all_pomi that the changes to the exclude lists since then affect. The other months are taken from
+    the cached base data, and the patched base data is cached for the current run.
+
+    Args:
+        rpsd (str): report period start date in the format YYYY-MM-DD
+        rped (str): report period end date in the format YYYY-MM-DD
+        config (dict): Config file with the stage cache settings
+        manifest (dict): Stage cache manifest for the current run
+    Returns:
+        dict: Extracted POMI data and geography mappings, with the current exclude lists
+        tuple: all_pomi_recoded_df and all_pomi_adjusted_df
+        Or None if the last run can't be reused, in which case the run is built in full
+    """
+    previous = stage_cache.load_manifest(config, manifest["run"], resume=True)
+    plan = column_plan.get_plan(config)
+    if not all(column_plan.covers(column_plan.get_cached_plan(previous, stage), plan) for stage in ["extract", "base_data"]):
+        print("The cached run doesn't have every field key the selected outputs use, building the base data in full")
+        return None
+
+    data = stage_cache.load_frames(config, previous, "extract")
+    all_pomi_recoded_df = stage_cache.load_stage(config, previous, "create_month_summary_base_data")
+    all_pomi_adjusted_df = stage_cache.load_stage(config, previous, "create_base_data")
+
+    if data is None or "prim_pomi_df" not in data or all_pomi_recoded_df is None or all_pomi_adjusted_df is None:
+        print("No cached run to rerun the exclude list changes on, building the base data in full")
+        return None
+
+    ## The rebuilt months keep the columns of the cached ones
+    plan = column_plan.get_cached_plan(previous, "base_data")
+    column_plan.set_cached_plan(manifest, "extract", column_plan.get_cached_plan(previous, "extract"))
+    column_plan.set_cached_plan(manifest, "base_data", plan)
+
+    exclude_list_df = input.get_exclude_list()
+    inf_exclude_list_df = input.get_inf_exclude_list()
+    months = exclude_impact.get_affected_months(
+        data["prim_pomi_df"],
+        data["prim_pomi_inf_df"],
+        data["gp_dim_df"],
+        exclude_impact.get_changed_rows(data["exclude_list_df"], exclude_list_df),
+        exclude_impact.get_changed_rows(data["inf_exclude_list_df"], inf_exclude_list_df)
+        )
+    print(f"Exclude list changes affect {len(months)} months{': ' + ', '.join(months) if months else ''}")
+
+    data["exclude_list_df"] = exclude_list_df
+    data["inf_exclude_list_df"] = inf_exclude_list_df
+    stage_cache.store_frames(config, manifest, "extract", data)
+
+    if months:
+        base_data = aggregate_chunked.split_base_data(all_pomi_recoded_df, all_pomi_adjusted_df)
+        mapping_df = get_mapping_df(data)
+
+        for month_start, month_end in get_report_months(rpsd, rped):
+            name, prim_pomi_df, prim_pomi_inf_df = next(get_fact_months(config, data, month_start, month_end))
+            if name not in months:
+                continue
+
+            base_data.pop(name, None)
+            if prim_pomi_df.empty and prim_pomi_inf_df.empty:
+                continue
+            with run_report.stage(f"rebuild_{name}") as record:
+                base_data[name] = record["output"] = aggregate_chunked.create_month_base_data(
+                    prim_pomi_df,
+                    data["gp_dim_df"],
+                    exclude_list_df,
+                    rpsd,
+                    rped,
+                    prim_pomi_inf_df,
+                    inf_exclude_list_df,
+                    data["prim_pomi_field_df"],
+                    mapping_df,
+                    get_aggregate_backend(config)[1],
+                    plan
+                    )
+            record.clear()
+
+        ## Rebuilt months have every field key, give the cached months the same column layout
+        layout = next((base_data[name][1].columns for name in months if name in base_data), all_pomi_recoded_df.columns)
+        all_pomi_recoded_df, all_pomi_adjusted_df = aggregate_chunked.merge_month_base_data([
+            (columns, recoded.reindex(columns=layout), adjusted)
+            for _, (columns, recoded, adjusted) in sorted(base_data.items())
+            ])
+
+    key = stage_cache.fingerprint(previous["stages"]["create_base_data"], exclude_list_df, inf_exclude_list_df)
+    stage_cache.store_stage(config, manifest, "create_month_summary_base_data", key, all_pomi_recoded_df)
+    stage_cache.store_stage(config, manifest, "create_base_data", key, all_pomi_adjusted_df)
+
+    return data, (all_pomi_recoded_df, all_pomi_adjusted_df)
+
+
+def get_output_stages(
+        pbi_filename: str = "WORK_POMI_ALL_OUT.csv",
+        create_xlsb: bool = True,
+        write_base_data: bool = True,
+        memory_budget: int = None,
+        outputs: list = None,
+        parquet_outputs: list = None,
+        partitioned_outputs: list = None,
+        trend_monitor_history: bool = False,
+        pbi_layout: str = "flat"
+        ) -> list:
+    """
+    Declare the stages of the selected outputs, all of them by default, and the inputs each one needs. Stages that
+    don't depend on each other run concurrently. The Trend Monitor's Excel dependencies are only imported when it's
+    selected. Datasets named in parquet_outputs are also written as Parquet, and those in partitioned_outputs as
+    month partitions. trend_monitor_history reuses the month on month comparisons of earlier runs. pbi_layout writes
+    the PBI output as the flat table, the star schema or both.
+    """
+    outputs = outputs or output_selection.output_names
+    stages = [
+        ("pcd", dag.Stage("pcd_output_df", create_csv.create_pcd_output, ["all_pomi_adjusted_df"])),
+        ("choices", dag.Stage("choices_output_df", create_csv.create_choices_output, ["all_pomi_adjusted_df"])),
+        ("benefits", dag.Stage("benefits_output_df", create_csv.create_benefits_dataset, ["all_pomi_recoded_df"])),
+        ("pbi", dag.Stage("pbi_star_schema", create_csv.create_pbi_star_schema, ["all_pomi_adjusted_df"])),
+        ("pbi", dag.Stage("pbi_output_df", create_csv.flatten_pbi_star_schema, ["pbi_star_schema"])),
+        ("pcd", dag.Stage("write_pcd_output", functools.partial(csv_export.write_pcd_output, create_xlsb=create_xlsb), ["pcd_output_df"])),
+        ("choices", dag.Stage("write_choices_output", csv_export.write_choices_output, ["choices_output_df"])),
+        ("benefits", dag.Stage("write_benefits_output", csv_export.write_benefits_output, ["benefits_output_df"])),
+    ]
+    if pbi_layout in ["flat", "both"]:
+        stages.append(("pbi", dag.Stage("write_pbi_output", functools.partial(csv_export.write_pbi_output, filename=pbi_filename), ["pbi_output_df"])))
+    if pbi_layout in ["star", "both"]:
+        stages.append(("pbi", dag.Stage("write_pbi_star_schema", functools.partial(csv_export.write_pbi_star_schema, filename=pbi_filename), ["pbi_star_schema"])))
+    parquet_stages = {
+        "pbi": dag.Stage("write_pbi_parquet", functools.partial(parquet_export.write_pbi_parquet, filename=f"{os.path.splitext(pbi_filename)[0]}.parquet"), ["pbi_output_df"]),
+        "pcd": dag.Stage("write_pcd_parquet", parquet_export.write_pcd_parquet, ["pcd_output_df"]),
+        "benefits": dag.Stage("write_benefits_parquet", parquet_export.write_benefits_parquet, ["benefits_output_df"]),
+    }
+    for output in parquet_outputs or []:
+        stages.append((output, parquet_stages[output]))
+    partition_stages = {
+        "pbi": dag.Stage("write_pbi_partitions", partition_export.write_pbi_partitions, ["pbi_output_df"]),
+        "pcd": dag.Stage("write_pcd_partitions", partition_export.write_pcd_partitions, ["pcd_output_df"]),
+    }
+    for output in partitioned_outputs or []:
+        stages.append((output, partition_stages[output]))
+    if "trend_monitor" in outputs:
+        from pipeline.output import excel_export
+        stages.append(("trend_monitor", dag.Stage("write_trend_monitor", functools.partial(excel_export.write_trend_monitor, history=trend_monitor_history), ["all_pomi_adjusted_df"])))
+    if write_base_data:
+        stages.append(("base_data", dag.Stage("write_recoded_base_data", functools.partial(parquet_export.write_base_data, name="recoded"), ["all_pomi_recoded_df"])))
+        stages.append(("base_data", dag.Stage("write_adjusted_base_data", functools.partial(parquet_export.write_base_data, name="adjusted"), ["all_pomi_adjusted_df"])))
+
+    stages = [stage for output, stage in stages if output in outputs]
+
+    ## The flat PBI table is only built if something writes it
+    if not any("pbi_output_df" in stage.inputs for stage in stages):
+        stages = [stage for stage in stages if stage.name != "pbi_output_df"]
+
+    return [
+        dag.Stage(
+            stage.name,
+            run_report.instrument(stage.name, profiling.profile_stage(stage.name, memory.within_budget(stage.name, stage.function, memory_budget))),
+            stage.inputs
+            )
+        for stage in stages
+    ]
+
+
+def get_stage_inputs(stages: list) -> set:
+    """
+    Inputs the stages need from outside themselves, i.e. which of the base data tables have to be built
+    """
+    names = {stage.name for stage in stages}
+
+    return {name for stage in stages for name in stage.inputs if name not in names}
+
+
+def run_output_stages(stages: list, initial: dict, max_workers: int = 4, release_inputs: bool = False) -> list:
+    """
+    Run output stages, print how each one went and return the names of any that didn't complete
+    """
+    results, report = dag.run_stages(stages, initial, max_workers, release_inputs)
+    dag.print_stage_report(stages, report)
+
+    return [name for name, r in report.items() if r["status"] != "completed"]
+
+
+def write_outputs(
+        all_pomi_recoded_df: pd.DataFrame,
+        all_pomi_adjusted_df: pd.DataFrame,
+        pbi_filename: str = "WORK_POMI_ALL_OUT.csv",
+        max_workers: int = 4,
+        create_xlsb: bool = True,
+        write_base_data: bool = True,
+        memory_budget: int = None,
+        outputs: list = None,
+        parquet_outputs: list = None,
+        partitioned_outputs: list = None,
+        trend_monitor_history: bool = False,
+        pbi_layout: str = "flat"
+        ) -> None:
+    """
+    Create and export the selected outputs, all of them by default, for the report month currently set in params.
+    Independent outputs are built on a worker pool and a failure in one output doesn't stop the others.
+    """
+    print("Creating and exporting outputs")
+    stages = get_output_stages(pbi_filename, create_xlsb, write_base_data, memory_budget, outputs, parquet_outputs, partitioned_outputs, trend_monitor_history, pbi_layout)
+    failed = run_output_stages(
+        stages,
+        {"all_pomi_recoded_df": all_pomi_recoded_df, "all_pomi_adjusted_df": all_pomi_adjusted_df},
+        max_workers
+        )
+
+    if failed:
+        raise RuntimeError(f"Outputs not completed: {', '.join(failed)}")
+
+
+def write_outputs_low_memory(
+        data: dict,
+        rpsd: str,
+        rped: str,
+        config: dict,
+        manifest: dict = None,
+        pbi_filename: str = "WORK_POMI_ALL_OUT.csv"
+        ) -> None:
+    """
+    Build and export the selected outputs holding as little as possible in memory. The extracted data is released once
+    all_pomi is built, all_pomi is recoded in place, and each DataFrame is released as soon as its last output is
+    written. Rather than keeping all_pomi_recoded_df and all_pomi_adjusted_df side by side, the outputs of the
+    recoded table are written first and the adjusted table is then recoded in place from it. Outputs run one at a time.
+
+    Args:
+        data (dict): Extracted POMI data and geography mappings, emptied as the run goes
+        rpsd (str): report period start date in the format YYYY-MM-DD
+        rped (str): report period end date in the format YYYY-MM-DD
+        config (dict): Config file with the output and memory settings
+        manifest (dict): Stage cache manifest for the run
+        pbi_filename (str): Name of the PBI output file
+    """
+    budget = memory.get_memory_budget(config)
+    stages = get_output_stages(
+        pbi_filename,
+        config.get("create_xlsb", True),
+        config.get("write_base_data", True),
+        budget,
+        output_selection.get_outputs(config),
+        parquet_export.get_parquet_outputs(config),
+        partition_export.get_partitioned_outputs(config),
+        trend_monitor_history.is_enabled(config),
+        csv_export.get_pbi_layout(config)
+        )
+    recoded_stages = dag.select_stages(stages, {"all_pomi_recoded_df"})
+    adjusted_stages = [stage for stage in stages if stage not in recoded_stages]
+    plan = column_plan.get_plan(config) or {}
+    column_plan.set_cached_plan(manifest, "base_data", plan or None)
+
+    all_pomi_recoded_df = stage_cache.run_stage(
+        config,
+        manifest,
+        "create_month_summary_base_data",
+        functools.partial(aggregate.create_month_summary_base_data, inplace=True),
+        build_all_pomi(data, rpsd, rped, config, manifest),
+        plan.get("all_pomi")
+        )
+    memory.check_memory_budget("create_month_summary_base_data", budget)
+
+    print("Creating and exporting outputs of the recoded base data")
+    failed = run_output_stages(recoded_stages, {"all_pomi_recoded_df": all_pomi_recoded_df}, 1, release_inputs=True)
+
+    if not adjusted_stages:
+        if failed:
+            raise RuntimeError(f"Outputs not completed: {', '.join(failed)}")
+        return
+
+    base_data = {
+        "all_pomi_adjusted_df": stage_cache.run_stage(
+            config,
+            manifest,
+            "create_base_data",
+            functools.partial(aggregate.create_base_data, inplace=True),
+            all_pomi_recoded_df,
+            plan.get("adjusted")
+            )
+        }
+    del all_pomi_recoded_df
+    memory.check_memory_budget("create_base_data", budget)
+
+    print("Creating and exporting outputs of the adjusted base data")
+    failed += run_output_stages(adjusted_stages, base_data, 1, release_inputs=True)
+
+    if failed:
+        raise RuntimeError(f"Outputs not completed: {', '.join(failed)}")
+
+
+def build_and_write_outputs(
+        data: dict,
+        rpsd: str,
+        rped: str,
+        config: dict = None,
+        manifest: dict = None,
+        pbi_filename: str = "WORK_POMI_ALL_OUT.csv",
+        base_data: tuple = None
+        ) -> None:
+    """
+    Build the base data and the outputs selected by "outputs" in the config for the report month currently set in
+    params, in low memory mode if "low_memory" is set in the config, then print the peak RSS of the run. If
+    base_data is given, e.g. by rebuild_excluded_months(), the outputs are written from it instead.
+    """
+    config = config or {}
+    outputs = output_selection.get_outputs(config)
+
+    if memory.is_low_memory(config) and base_data is None:
+        write_outputs_low_memory(data, rpsd, rped, config, manifest, pbi_filename)
+    else:
+        if base_data is None:
+            stages = get_output_stages(pbi_filename, write_base_data=config.get("write_base_data", True), outputs=outputs)
+            adjusted = "all_pomi_adjusted_df" in get_stage_inputs(stages)
+            base_data = build_base_data(data, rpsd, rped, config, manifest, adjusted)
+
+        write_outputs(
+            *base_data,
+            pbi_filename,
+            config.get("max_workers", 4),
+            config.get("create_xlsb", True),
+            config.get("write_base_data", True),
+            memory.get_memory_budget(config),
+            outputs,
+            parquet_export.get_parquet_outputs(config),
+            partition_export.get_partitioned_outputs(config),
+            trend_monitor_history.is_enabled(config),
+            csv_export.get_pbi_layout(config)
+            )
+
+    peak_rss = run_report.get_peak_rss()
+    if peak_rss is not None:
+        print(f"Peak RSS {peak_rss / 2**20:.0f} MB")
+
+
+def run(config: dict, resume: bool = False) -> None:
+    """
+    Run the publication for the report month in the config
+
+    Args:
+        config (dict): Loaded config file, see config.json
+        resume (bool): Resume the last run for the report month from its cached stages instead of extracting again
+    """
+    params.configure(config)
+
+    print("Getting report period")
+    rpsd = params.get_report_period_start_date()
+    rped = params.get_report_period_end_date()
+
+    manifest = stage_cache.load_manifest(config, params.get_export_dates(), resume)
+    run_report.start_run_report(params.get_export_dates(), config)
+    profiling.configure(config, csv_export.get_export_location(os.path.join("PROFILES", params.get_export_dates())))
+
+    try:
+        plan = column_plan.get_plan(config, warn=True)
+        data = stage_cache.load_frames(config, manifest, "extract")
+        if data is not None and not column_plan.covers(column_plan.get_cached_plan(manifest, "extract"), plan):
+            print("The cached extraction doesn't have every field key the selected outputs use, extracting again")
+            data = None
+        base_data = None
+        if data is None and is_exclude_list_rerun(config):
+            data, base_data = rebuild_excluded_months(rpsd, rped, config, manifest) or (None, None)
+        if data is None:
+            data = extract_pomi_data(config, rpsd, rped, plan)
+            data.update(extract_geography_mappings(config, rpsd, rped))
+            column_plan.set_cached_plan(manifest, "extract", plan)
+            stage_cache.store_frames(config, manifest, "extract", data)
+
+        build_and_write_outputs(data, rpsd, rped, config, manifest, base_data=base_data)
+        stage_cache.prune(config)
+    finally:
+        print(f"Run report written to {run_report.write_run_report(csv_export.get_export_location('RUN REPORT'))}")
+
+    if config.get("open_output_folder", True):
+        print("POMI Job completed. Opening Outputs folder")
+        root = params.params["ROOT_DIR"]
+        output_folder = os.path.join(root, "OUTPUTS")
+        subprocess.Popen(["explorer", output_folder])
+    else:
+        print("POMI Job completed")
+
+
+def get_backfill_months(start_month: str, end_month: str) -> list:
+    """
+    List each report run date from start_month to end_month inclusive, both in the format YYYY-MM-DD
+    """
+    month = pd.to_datetime(start_month).date().replace(day=1)
+    last = pd.to_datetime(end_month).date().replace(day=1)
+
+    months = []
+    while month <= last:
+        months.append(str(month))
+        month = month + relativedelta(months=1)
+
+    return months
+
+
+def slice_report_period(data: dict, rpsd: str, rped: str) -> dict:
+    """
+    Select the rows of an extraction that fall in one report period. GP_DIM has no Report_End so it is restricted to
+    the GP_Keys present in the period's fact data.
+    """
+    period = dict(data)
+
+    for name in ["prim_pomi_df", "prim_pomi_inf_df", "open_active_df"]:
+        df = data[name]
+        period[name] = df.loc[df["Report_End"].between(pd.Timestamp(rpsd), pd.Timestamp(rped))]
+
+    gp_keys = pd.concat([period["prim_pomi_df"]["GP_Key"], period["prim_pomi_inf_df"]["GP_Key"]])
+    period["gp_dim_df"] = data["gp_dim_df"].loc[data["gp_dim_df"]["GP_Key"].isin(gp_keys)]
+
+    return period
+
+
+def get_backfill_workers(config: dict, data: dict, windows: list) -> int:
+    """
+    Number of months to run at once. "auto" allows as many as fit in available memory, assuming each month needs
+    around ten times the size of its slice while it builds. A slice is estimated from the size of the extraction
+    covering every month, divided by the calendar months it covers and multiplied by the months of a report period.
+
+    Args:
+        config (dict): Config file containing backfill_max_workers
+        data (dict): Extraction for the union of the report periods
+        windows (list): Report run date, report period start and end date of each backfill month
+    """
+    workers = config.get("backfill_max_workers", 1)
+    if workers != "auto":
+        return max(1, int(workers))
+
+    try:
+        import psutil
+    except ImportError:
+        return 1
+
+    data_bytes = sum(df.memory_usage(deep=True).sum() for df in data.values() if isinstance(df, pd.DataFrame))
+    covered_months = len(get_report_months(windows[0][1], windows[-1][2]))
+    period_months = max(len(get_report_months(rpsd, rped)) for _, rpsd, rped in windows)
+    month_bytes = data_bytes * period_months / covered_months
+    by_memory = int(psutil.virtual_memory().available // max(month_bytes * 10, 1))
+
+    return max(1, min(by_memory, os.cpu_count() or 1, len(windows)))
+
+
+def get_backfill_month_data(config: dict, data: dict, rpsd: str, rped: str) -> dict:
+    """
+    Slice of the backfill extraction for one report period, with the geography mappings for it
+    """
+    period = slice_report_period(data, rpsd, rped)
+    period.update(extract_geography_mappings(config, rpsd, rped))
+
+    return period
+
+
+def run_backfill_month(report_run_date: str, data: dict, config: dict = None) -> str:
+    """
+    Build and export the selected outputs for one backfill month from its slice of the shared extraction
+    """
+    params.configure(config or {})
+    params.set_report_month(report_run_date)
+    rpsd = params.get_report_period_start_date()
+    rped = params.get_report_period_end_date()
+
+    print(f"Backfilling {params.get_export_dates()}")
+    manifest = stage_cache.load_manifest(config, params.get_export_dates())
+    run_report.start_run_report(params.get_export_dates(), config)
+    profiling.configure(config or {}, csv_export.get_export_location(os.path.join("PROFILES", params.get_export_dates())))
+
+    try:
+        build_and_write_outputs(data, rpsd, rped, config, manifest, f"WORK_POMI_ALL_OUT_{params.get_export_dates()}.csv")
+    finally:
+        run_report.write_run_report(csv_export.get_export_location("RUN REPORT"))
+
+    return report_run_date
+
+
+def run_shared_backfill_month(report_run_date: str, paths: dict, config: dict = None) -> str:
+    """
+    run_backfill_month() in a worker process, on the month's slice shared by shared_frames.share_frames()
+    """
+    from pipeline.utils import shared_frames
+
+    return run_backfill_month(report_run_date, shared_frames.load_frames(paths), config)
+
+
+def run_backfill(config: dict, start_month: str, end_month: str) -> None:
+    """
+    Rebuild the outputs for every report month from start_month to end_month. The union of the months' report
+    periods is extracted once and each month is sliced from it in memory.
+
+    Args:
+        config (dict): Config file containing the connection strings and backfill_max_workers
+        start_month (str): First report run date in the format YYYY-MM-DD
+        end_month (str): Last report run date in the format YYYY-MM-DD
+    """
+    params.configure(config)
+    months = get_backfill_months(start_month, end_month)
+
+    windows = []
+    for report_run_date in months:
+        params.set_report_month(report_run_date)
+        windows.append((report_run_date, params.get_report_period_start_date(), params.get_report_period_end_date()))
+
+    ## The fact tables are always extracted here, even with aggregate_by_month, so each month can be sliced from them.
+    ## get_fact_months() then slices the month's own report period a month at a time rather than reading SQL again
+    print(f"Extracting {windows[0][1]} to {windows[-1][2]} for {len(months)} backfill months")
+    extract_config = dict(config, aggregate_by_month=False)
+    data = extract_pomi_data(extract_config, windows[0][1], windows[-1][2], column_plan.get_plan(config, warn=True))
+
+    workers = get_backfill_workers(config, data, windows)
+    print(f"Running backfill with {workers} worker(s)")
+
+    ## Each month is sliced only when it's run or dispatched, so at most one slice per worker is held at once
+    if workers == 1:
+        for report_run_date, rpsd, rped in windows:
+            run_backfill_month(report_run_date, get_backfill_month_data(config, data, rpsd, rped), config)
+    else:
+        from pipeline.utils import shared_frames
+
+        with shared_frames.shared_folder() as folder, ProcessPoolExecutor(max_workers=workers) as executor:
+            running = {}
+            for report_run_date, rpsd, rped in windows:
+                if len(running) == workers:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        print(f"Backfill month {future.result()} completed")
+                        shared_frames.remove_frames(running.pop(future))
+
+                paths = shared_frames.share_frames(get_backfill_month_data(config, data, rpsd, rped), folder)
+                running[executor.submit(run_shared_backfill_month, report_run_date, paths, config)] = paths
+
+            for future in running:
+                print(f"Backfill month {future.result()} completed")
+
+    stage_cache.prune(config)
+    print("POMI backfill completed")
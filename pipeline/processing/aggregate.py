@@ -1,7 +1,8 @@
 import pandas as pd
 import numpy as np
-from pipeline.utils import recode
+from pipeline.utils import recode, run_report, profiling
 
+@run_report.instrument()
 def combine_pomi_datasets(prim_pomi_df: pd.DataFrame, gp_dim_df: pd.DataFrame) -> pd.DataFrame:
     """
     Join both POMI datasets together
@@ -21,6 +22,7 @@ def combine_pomi_datasets(prim_pomi_df: pd.DataFrame, gp_dim_df: pd.DataFrame) -
     )
     return df
 
+@run_report.instrument()
 def drop_exclude_list(df: pd.DataFrame, exclude_list_df: pd.DataFrame, rpsd: str, rped: str) -> pd.DataFrame:
     """
     Remove rows included in the exclude list from the data.
@@ -49,8 +51,8 @@ def drop_exclude_list(df: pd.DataFrame, exclude_list_df: pd.DataFrame, rpsd: str
     )
     
     report_period_fact = period_fact.loc[
-        (period_fact['Report_End'] >= rpsd) &
-        (period_fact['Report_End'] <= rped)
+        (period_fact['Report_End'] >= pd.Timestamp(rpsd)) &
+        (period_fact['Report_End'] <= pd.Timestamp(rped))
     ]
 
     report_period_fact = report_period_fact.loc[
@@ -61,6 +63,7 @@ def drop_exclude_list(df: pd.DataFrame, exclude_list_df: pd.DataFrame, rpsd: str
     
     return report_period_fact
 
+@run_report.instrument()
 def clean_and_join_inf_data(
     df: pd.DataFrame, 
     prim_pomi_inf_df: pd.DataFrame, 
@@ -89,9 +92,9 @@ def clean_and_join_inf_data(
     )
     
     report_period_inf_fact = period_inf_fact.loc[
-        (period_inf_fact['Report_End'] >= rpsd) &
-        (period_inf_fact['Report_End'] <= rped) &
-        (period_inf_fact['SYS_Timestamp'] >= '2017-12-19 00:00:00') &
+        (period_inf_fact['Report_End'] >= pd.Timestamp(rpsd)) &
+        (period_inf_fact['Report_End'] <= pd.Timestamp(rped)) &
+        (period_inf_fact['SYS_Timestamp'] >= pd.Timestamp('2017-12-19 00:00:00')) &
         (~period_inf_fact['SYS_Timestamp'].isin(inf_exclude_list_df['SYS_Timestamp']))
     ]
     
@@ -101,6 +104,8 @@ def clean_and_join_inf_data(
     
     return report_period_fact_all
 
+@run_report.instrument()
+@profiling.profile_stage()
 def create_metadata(df: pd.DataFrame, prim_pomi_field_df: pd.DataFrame):
     """
     POMI data with field key and column names added
@@ -125,6 +130,8 @@ def create_metadata(df: pd.DataFrame, prim_pomi_field_df: pd.DataFrame):
 
     return metadata
 
+@run_report.instrument()
+@profiling.profile_stage()
 def pivot_metadata(df: pd.DataFrame):
     """
     Pivot POMI data to make field key the columns
@@ -144,6 +151,8 @@ def pivot_metadata(df: pd.DataFrame):
     
     return metadata_wide
 
+@run_report.instrument()
+@profiling.profile_stage()
 def join_gp_dim(df: pd.DataFrame, gp_dim_df: pd.DataFrame):
     """
     Join back gp_dim_df to the pivoted data
@@ -166,6 +175,8 @@ def join_gp_dim(df: pd.DataFrame, gp_dim_df: pd.DataFrame):
     
     return wide_pracs
 
+@run_report.instrument()
+@profiling.profile_stage()
 def join_mapping(df: pd.DataFrame, mapping_df: pd.DataFrame):
     """
     Join mapping data to POMI data
@@ -185,29 +196,35 @@ def join_mapping(df: pd.DataFrame, mapping_df: pd.DataFrame):
     )
     return all_pomi
 
-def tag_duplicates(df: pd.DataFrame):
+@run_report.instrument()
+@profiling.profile_stage()
+def tag_duplicates(df: pd.DataFrame, inplace: bool = False):
     """
     If a practice appears more than once, tag with (I).
 
     Args:
         df (pd.DataFrame): Pivoted POMI data with mapping added
+        inplace (bool): Tag the Supplier column of df itself rather than of a copy, for create_all_pomi's own
+            intermediate frame
     
     Returns:   
         pd.DataFrame: Table with duplicate entries tagged
     """
-    pomi_tagged = df.copy()
-    pomi_tagged['Supplier'] = np.where(
-        pomi_tagged.duplicated(['Report_End','PRACTICE_CODE'], keep=False),
-        pomi_tagged['Supplier'].str.upper().astype(str) + ' (I)',
-        pomi_tagged['Supplier']
+    df = df if inplace else df.copy()
+    df['Supplier'] = np.where(
+        df.duplicated(['Report_End','PRACTICE_CODE'], keep=False),
+        df['Supplier'].str.upper().astype(str) + ' (I)',
+        df['Supplier']
     )
 
-    pomi_tagged = pomi_tagged.groupby(by=[
+    pomi_tagged = df.groupby(by=[
         'Report_End','PRACTICE_CODE','PRACTICE_NAME','Supplier'
         ], as_index=False).max()
     
     return pomi_tagged
 
+@run_report.instrument()
+@profiling.profile_stage()
 def create_all_pomi(
         prim_pomi_df: pd.DataFrame,
         gp_dim_df: pd.DataFrame, 
@@ -244,94 +261,134 @@ def create_all_pomi(
         .pipe(pivot_metadata)
         .pipe(join_gp_dim, gp_dim_df)
         .pipe(join_mapping, mapping_df)
-        .pipe(tag_duplicates)
+        .pipe(tag_duplicates, inplace=True)
     )
     return df 
 
-def create_month_summary_base_data(all_pomi: pd.DataFrame) -> pd.DataFrame:
-    """
-    Apply column recoding logic to the all_pomi dataset. DataFrame created for month_summary_dataset output.
+## Field keys create_all_pomi reads itself, for online_book_cancel_count in join_gp_dim
+all_pomi_field_keys = ['FIELD_KEY_49','FIELD_KEY_50','FIELD_KEY_133']
 
-    Args: 
-        all_pomi (pd.DataFrame): All_pomi dataset - all the pomi data combined with mappings
+## Recodes applied by create_month_summary_base_data, in order, as (function, column changed, other arguments)
+month_summary_recodes = [
+    (recode.replace_column_values_when_less_than, 'FIELD_KEY_21', 'FIELD_KEY_126'),
+    (recode.replace_column_values_when_less_than, 'FIELD_KEY_22', 'FIELD_KEY_127'),
+    (recode.replace_column_values_when_less_than, 'FIELD_KEY_24', 'FIELD_KEY_130'),
+    (recode.replace_column_values_when_less_than, 'FIELD_KEY_32', 'FIELD_KEY_132'),
+    (recode.replace_column_values_when_less_than, 'FIELD_KEY_34', 'FIELD_KEY_134'),
+    (recode.replace_column_values_when_less_than, 'FIELD_KEY_38', 'FIELD_KEY_140'),
 
-    Returns:
-        pd.DataFrame: all_pomi with columns recoded
-    """
-    df = all_pomi.copy()
+    (recode.replace_column_values_with_sum, 'online_book_cancel_count', ['FIELD_KEY_49','FIELD_KEY_133','FIELD_KEY_50']),
+    (recode.replace_column_values_with_sum, 'FIELD_KEY_51', ['FIELD_KEY_51','FIELD_KEY_135']),
+    (recode.replace_column_values_with_sum, 'FIELD_KEY_55', ['FIELD_KEY_55','FIELD_KEY_141']),
 
-    df = recode.replace_column_values_when_less_than(df, 'FIELD_KEY_21', 'FIELD_KEY_126')
-    df = recode.replace_column_values_when_less_than(df, 'FIELD_KEY_22', 'FIELD_KEY_127')
-    df = recode.replace_column_values_when_less_than(df, 'FIELD_KEY_24', 'FIELD_KEY_130')
-    df = recode.replace_column_values_when_less_than(df, 'FIELD_KEY_32', 'FIELD_KEY_132')
-    df = recode.replace_column_values_when_less_than(df, 'FIELD_KEY_34', 'FIELD_KEY_134')
-    df = recode.replace_column_values_when_less_than(df, 'FIELD_KEY_38', 'FIELD_KEY_140')
+    (recode.replace_column_values_with_max, 'FIELD_KEY_30', ['FIELD_KEY_30','FIELD_KEY_32','FIELD_KEY_34','FIELD_KEY_62','FIELD_KEY_132','FIELD_KEY_134']),
+]
 
-    df = recode.replace_column_values_with_sum(df, 'online_book_cancel_count', ['FIELD_KEY_49','FIELD_KEY_133','FIELD_KEY_50'])
-    df = recode.replace_column_values_with_sum(df, 'FIELD_KEY_51', ['FIELD_KEY_51','FIELD_KEY_135'])
-    df = recode.replace_column_values_with_sum(df, 'FIELD_KEY_55', ['FIELD_KEY_55','FIELD_KEY_141'])
+## Recodes applied by create_base_data, in order, as (function, column changed, other arguments)
+base_data_recodes = [
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_32', 'FIELD_KEY_21'),
+    (recode.replace_column_values_when_equal_two, 'FIELD_KEY_32', 'FIELD_KEY_21', 'FIELD_KEY_33'),
 
-    df = recode.replace_column_values_with_max(df, 'FIELD_KEY_30', ['FIELD_KEY_30','FIELD_KEY_32','FIELD_KEY_34','FIELD_KEY_62','FIELD_KEY_132','FIELD_KEY_134'])
+    (recode.replace_column_values_when_not_equal_two, 'online_book_cancel_count', 'FIELD_KEY_21'),
 
-    return df
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_34', 'FIELD_KEY_22'),
+    (recode.replace_column_values_when_equal_two, 'FIELD_KEY_34', 'FIELD_KEY_22', 'FIELD_KEY_35'),
+
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_51', 'FIELD_KEY_22'),
+
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_42', 'FIELD_KEY_26'),
+    (recode.replace_column_values_when_equal_two, 'FIELD_KEY_42', 'FIELD_KEY_26', 'FIELD_KEY_43'),
 
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_44', 'FIELD_KEY_26'),
 
-def create_base_data(all_pomi_recoded: pd.DataFrame) -> pd.DataFrame:
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_45', 'FIELD_KEY_27'),
+    (recode.replace_column_values_when_equal_two, 'FIELD_KEY_45', 'FIELD_KEY_27', 'FIELD_KEY_46'),
+
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_56', 'FIELD_KEY_27'),
+
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_36', 'FIELD_KEY_23'),
+    (recode.replace_column_values_when_equal_two, 'FIELD_KEY_36', 'FIELD_KEY_23', 'FIELD_KEY_37'),
+
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_38', 'FIELD_KEY_24'),
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_55', 'FIELD_KEY_24'),
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_40', 'FIELD_KEY_25'),
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_54', 'FIELD_KEY_25'),
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_62', 'FIELD_KEY_61'),
+    (recode.replace_column_values_when_not_equal_two, 'FIELD_KEY_63', 'FIELD_KEY_61'),
+
+    (recode.replace_column_values_when_null, 'FIELD_KEY_30', 'FIELD_KEY_28'),
+]
+
+## Columns of all_pomi_adjusted, in order
+base_data_columns = [
+    'REGION_CODE','REGION_NAME','ICB_CODE','ICB_NAME','SUB_ICB_CODE','SUB_ICB_NAME','PRACTICE_CODE','PRACTICE_NAME',
+    'Report_End','Supplier_Version','Supplier','Total_Patients','FIELD_KEY_21','FIELD_KEY_22','FIELD_KEY_26','FIELD_KEY_27',
+    'FIELD_KEY_24','FIELD_KEY_25','FIELD_KEY_61','FIELD_KEY_32','online_book_cancel_count','FIELD_KEY_34',
+    'FIELD_KEY_51','FIELD_KEY_42','FIELD_KEY_45','FIELD_KEY_56','FIELD_KEY_7','FIELD_KEY_8','FIELD_KEY_9',
+    'FIELD_KEY_10','FIELD_KEY_11','FIELD_KEY_12','FIELD_KEY_13','FIELD_KEY_14','FIELD_KEY_15','FIELD_KEY_16',
+    'FIELD_KEY_17','FIELD_KEY_18','FIELD_KEY_20','FIELD_KEY_23','FIELD_KEY_28','FIELD_KEY_29','FIELD_KEY_36',
+    'FIELD_KEY_37','FIELD_KEY_48','FIELD_KEY_52','FIELD_KEY_57','FIELD_KEY_58','FIELD_KEY_19','FIELD_KEY_64',
+    'FIELD_KEY_39','FIELD_KEY_41','FIELD_KEY_43','FIELD_KEY_46','FIELD_KEY_33','FIELD_KEY_35','FIELD_KEY_66',
+    'FIELD_KEY_67','FIELD_KEY_68','FIELD_KEY_49','FIELD_KEY_50','FIELD_KEY_55','FIELD_KEY_40','FIELD_KEY_62',
+    'FIELD_KEY_31','FIELD_KEY_30','FIELD_KEY_63','FIELD_KEY_54','FIELD_KEY_47','FIELD_KEY_38','FIELD_KEY_65',
+    'FIELD_KEY_60','FIELD_KEY_59','FIELD_KEY_44','FIELD_KEY_53'
+]
+
+def is_kept(column: str, columns: list = None) -> bool:
     """
-    Apply further column recoding logic to the all_pomi_recoded dataset. DataFrame created for all other outputs.
+    Whether a column is kept by a column plan, which only ever leaves out field keys. See column_plan.get_plan().
+    """
+    return columns is None or not column.startswith('FIELD_KEY_') or column in columns
 
-    Args: 
-        all_pomi_recoded (pd.DataFrame): All_pomi_recoded dataset - all the pomi data combined with mappings, with some columns recoded
 
-    Returns:
-        pd.DataFrame: all_pomi_recoded with further columns recoded
+def apply_recodes(df: pd.DataFrame, recodes: list, columns: list = None) -> pd.DataFrame:
     """
-    df = all_pomi_recoded.copy()
+    Apply recodes in order, skipping those that change a field key the column plan leaves out
+    """
+    for function, column, *args in recodes:
+        if is_kept(column, columns):
+            df = function(df, column, *args)
 
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_32', 'FIELD_KEY_21')
-    df = recode.replace_column_values_when_equal_two(df, 'FIELD_KEY_32', 'FIELD_KEY_21', 'FIELD_KEY_33')
+    return df
 
-    df = recode.replace_column_values_when_not_equal_two(df, 'online_book_cancel_count', 'FIELD_KEY_21')
 
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_34', 'FIELD_KEY_22')
-    df = recode.replace_column_values_when_equal_two(df, 'FIELD_KEY_34', 'FIELD_KEY_22', 'FIELD_KEY_35')
+@run_report.instrument()
+@profiling.profile_stage()
+def create_month_summary_base_data(all_pomi: pd.DataFrame, columns: list = None, inplace: bool = False) -> pd.DataFrame:
+    """
+    Apply column recoding logic to the all_pomi dataset. DataFrame created for month_summary_dataset output.
 
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_51', 'FIELD_KEY_22')
+    Args: 
+        all_pomi (pd.DataFrame): All_pomi dataset - all the pomi data combined with mappings
+        columns (list): Field keys to recode, from column_plan.get_plan(). All of them by default
+        inplace (bool): Recode all_pomi itself rather than a copy, for low memory runs that don't use all_pomi again
 
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_42', 'FIELD_KEY_26')
-    df = recode.replace_column_values_when_equal_two(df, 'FIELD_KEY_42', 'FIELD_KEY_26', 'FIELD_KEY_43')
+    Returns:
+        pd.DataFrame: all_pomi with columns recoded
+    """
+    df = all_pomi if inplace else all_pomi.copy()
 
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_44', 'FIELD_KEY_26')
+    return apply_recodes(df, month_summary_recodes, columns)
 
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_45', 'FIELD_KEY_27')
-    df = recode.replace_column_values_when_equal_two(df, 'FIELD_KEY_45', 'FIELD_KEY_27', 'FIELD_KEY_46')
 
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_56', 'FIELD_KEY_27')
+@run_report.instrument()
+@profiling.profile_stage()
+def create_base_data(all_pomi_recoded: pd.DataFrame, columns: list = None, inplace: bool = False) -> pd.DataFrame:
+    """
+    Apply further column recoding logic to the all_pomi_recoded dataset. DataFrame created for all other outputs.
 
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_36', 'FIELD_KEY_23')
-    df = recode.replace_column_values_when_equal_two(df, 'FIELD_KEY_36', 'FIELD_KEY_23', 'FIELD_KEY_37')
+    Args: 
+        all_pomi_recoded (pd.DataFrame): All_pomi_recoded dataset - all the pomi data combined with mappings, with some columns recoded
+        columns (list): Field keys to recode and keep, from column_plan.get_plan(). All of them by default
+        inplace (bool): Recode all_pomi_recoded itself rather than a copy, for low memory runs once its own outputs are written
 
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_38', 'FIELD_KEY_24')
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_55', 'FIELD_KEY_24')
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_40', 'FIELD_KEY_25')
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_54', 'FIELD_KEY_25')
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_62', 'FIELD_KEY_61')
-    df = recode.replace_column_values_when_not_equal_two(df, 'FIELD_KEY_63', 'FIELD_KEY_61')
+    Returns:
+        pd.DataFrame: all_pomi_recoded with further columns recoded
+    """
+    df = all_pomi_recoded if inplace else all_pomi_recoded.copy()
 
-    df = recode.replace_column_values_when_null(df, 'FIELD_KEY_30', 'FIELD_KEY_28')
+    df = apply_recodes(df, base_data_recodes, columns)
 
-    df = df[[
-        'REGION_CODE','REGION_NAME','ICB_CODE','ICB_NAME','SUB_ICB_CODE','SUB_ICB_NAME','PRACTICE_CODE','PRACTICE_NAME',
-        'Report_End','Supplier_Version','Supplier','Total_Patients','FIELD_KEY_21','FIELD_KEY_22','FIELD_KEY_26','FIELD_KEY_27',
-        'FIELD_KEY_24','FIELD_KEY_25','FIELD_KEY_61','FIELD_KEY_32','online_book_cancel_count','FIELD_KEY_34',
-        'FIELD_KEY_51','FIELD_KEY_42','FIELD_KEY_45','FIELD_KEY_56','FIELD_KEY_7','FIELD_KEY_8','FIELD_KEY_9',
-        'FIELD_KEY_10','FIELD_KEY_11','FIELD_KEY_12','FIELD_KEY_13','FIELD_KEY_14','FIELD_KEY_15','FIELD_KEY_16',
-        'FIELD_KEY_17','FIELD_KEY_18','FIELD_KEY_20','FIELD_KEY_23','FIELD_KEY_28','FIELD_KEY_29','FIELD_KEY_36',
-        'FIELD_KEY_37','FIELD_KEY_48','FIELD_KEY_52','FIELD_KEY_57','FIELD_KEY_58','FIELD_KEY_19','FIELD_KEY_64',
-        'FIELD_KEY_39','FIELD_KEY_41','FIELD_KEY_43','FIELD_KEY_46','FIELD_KEY_33','FIELD_KEY_35','FIELD_KEY_66',
-        'FIELD_KEY_67','FIELD_KEY_68','FIELD_KEY_49','FIELD_KEY_50','FIELD_KEY_55','FIELD_KEY_40','FIELD_KEY_62',
-        'FIELD_KEY_31','FIELD_KEY_30','FIELD_KEY_63','FIELD_KEY_54','FIELD_KEY_47','FIELD_KEY_38','FIELD_KEY_65',
-        'FIELD_KEY_60','FIELD_KEY_59','FIELD_KEY_44','FIELD_KEY_53'
-        ]].sort_values(by=['Report_End','Supplier','PRACTICE_CODE'])
+    df = df[[col for col in base_data_columns if is_kept(col, columns)]].sort_values(by=['Report_End','Supplier','PRACTICE_CODE'])
     
     return df
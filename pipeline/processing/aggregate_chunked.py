@@ -0,0 +1,214 @@
+import pandas as pd
+import numpy as np
+import glob
+import os
+import shutil
+from pipeline.utils import run_report
+from pipeline.processing import aggregate
+
+def write_chunk(df: pd.DataFrame, store_folder: str, name: str) -> str:
+    """
+    Append one chunk of all_pomi to the on-disk wide store
+    """
+    output_path = os.path.join(store_folder, f"{name}.parquet")
+    tmp_path = f"{output_path}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+
+    return output_path
+
+
+def get_column_order(columns: list) -> list:
+    """
+    Column order of the unchunked all_pomi for the union of every chunk's columns. Each chunk only pivots the field
+    keys reported that month, so the FIELD_KEY columns are merged and sorted as pivot_metadata sorts them.
+    """
+    field_keys = sorted({col for chunk_columns in columns for col in chunk_columns if col.startswith('FIELD_KEY_')})
+
+    first = columns[0]
+    field_positions = [i for i, col in enumerate(first) if col.startswith('FIELD_KEY_')]
+    before = first[:field_positions[0]] if field_positions else first
+    after = first[field_positions[-1] + 1:] if field_positions else []
+
+    return before + field_keys + after
+
+
+def read_store(store_folder: str) -> pd.DataFrame:
+    """
+    Read every chunk back from the wide store as one all_pomi DataFrame. Chunks are named by month so reading them
+    in name order gives the same row order as the unchunked groupby.
+    """
+    chunks = [pd.read_parquet(path) for path in sorted(glob.glob(os.path.join(store_folder, "*.parquet")))]
+    if not chunks:
+        raise ValueError(f"No POMI data was aggregated into {store_folder}")
+
+    columns = get_column_order([list(chunk.columns) for chunk in chunks])
+    df = pd.concat(chunks, ignore_index=True)[columns]
+
+    # Missing strings come back from Parquet as None, keep them as NaN like the in-memory aggregation
+    object_columns = df.columns[df.dtypes == object]
+    df[object_columns] = df[object_columns].where(df[object_columns].notna(), np.nan)
+
+    return df
+
+
+@run_report.instrument()
+def create_all_pomi_by_month(
+        fact_chunks,
+        gp_dim_df: pd.DataFrame,
+        exclude_list_df: pd.DataFrame,
+        rpsd: str,
+        rped: str,
+        inf_exclude_list_df: pd.DataFrame,
+        prim_pomi_field_df: pd.DataFrame,
+        mapping_df: pd.DataFrame,
+        store_folder: str,
+        create_all_pomi = aggregate.create_all_pomi
+        ) -> pd.DataFrame:
+    """
+    Build all_pomi one month at a time so only a single month of the long fact tables is in memory. Every step of
+    the aggregation is either row by row or keyed on Report_End, so each month goes through exclusion, pivot, joins
+    and duplicate tagging on its own, and is appended to a Parquet store on disk. The wide result is read back at
+    the end, which is small compared to the fact tables, and the store is removed once it's read or if a month fails.
+
+    Args:
+        fact_chunks: Iterable of (month name, prim_pomi_df, prim_pomi_inf_df) for each month of the report period
+        store_folder (str): Folder for the wide store, emptied before the first month is written and removed at the end
+        create_all_pomi: The create_all_pomi implementation to run on each month
+        See aggregate.create_all_pomi for the other arguments
+
+    Returns:
+        df (pd.DataFrame): The same all_pomi DataFrame aggregate.create_all_pomi builds from the full tables
+    """
+    if os.path.exists(store_folder):
+        shutil.rmtree(store_folder)
+    os.makedirs(store_folder)
+
+    try:
+        for name, prim_pomi_df, prim_pomi_inf_df in fact_chunks:
+            if prim_pomi_df.empty and prim_pomi_inf_df.empty:
+                continue
+
+            with run_report.stage(f"create_all_pomi_{name}") as record:
+                record["output"] = create_all_pomi(
+                    prim_pomi_df,
+                    gp_dim_df,
+                    exclude_list_df,
+                    rpsd,
+                    rped,
+                    prim_pomi_inf_df,
+                    inf_exclude_list_df,
+                    prim_pomi_field_df,
+                    mapping_df
+                    )
+                write_chunk(record["output"], store_folder, name)
+
+            del prim_pomi_df, prim_pomi_inf_df
+            record.clear()
+
+        return read_store(store_folder)
+    finally:
+        shutil.rmtree(store_folder, ignore_errors=True)
+
+
+def create_month_base_data(
+        prim_pomi_df: pd.DataFrame,
+        gp_dim_df: pd.DataFrame,
+        exclude_list_df: pd.DataFrame,
+        rpsd: str,
+        rped: str,
+        prim_pomi_inf_df: pd.DataFrame,
+        inf_exclude_list_df: pd.DataFrame,
+        prim_pomi_field_df: pd.DataFrame,
+        mapping_df: pd.DataFrame,
+        create_all_pomi = aggregate.create_all_pomi,
+        plan: dict = None
+        ) -> tuple:
+    """
+    Build all_pomi for one month and apply both recodes to it. Field keys that weren't reported in the month are
+    added as empty columns so the recodes can run on their own, merge_month_base_data() drops the ones no month had.
+    plan is the column_plan.get_plan() the base data is built with, if any.
+
+    Returns:
+        list: Columns of the month's all_pomi before the empty field keys were added
+        pd.DataFrame: all_pomi_recoded_df for the month
+        pd.DataFrame: all_pomi_adjusted_df for the month
+    """
+    all_pomi_df = create_all_pomi(
+        prim_pomi_df,
+        gp_dim_df,
+        exclude_list_df,
+        rpsd,
+        rped,
+        prim_pomi_inf_df,
+        inf_exclude_list_df,
+        prim_pomi_field_df,
+        mapping_df
+        )
+    columns = list(all_pomi_df.columns)
+
+    field_keys = 'FIELD_KEY_' + pd.to_numeric(prim_pomi_field_df['Field_Key'], downcast='integer').astype(int).astype(str)
+    all_pomi_df = all_pomi_df.reindex(columns=get_column_order([columns, list(field_keys)]))
+
+    plan = plan or {}
+    all_pomi_recoded_df = aggregate.create_month_summary_base_data(all_pomi_df, plan.get("all_pomi"), inplace=True)
+    all_pomi_adjusted_df = aggregate.create_base_data(all_pomi_recoded_df, plan.get("adjusted"))
+
+    return columns, all_pomi_recoded_df, all_pomi_adjusted_df
+
+
+def merge_month_base_data(months: list) -> tuple:
+    """
+    Concatenate the create_month_base_data() output of each month, in month order, into the all_pomi_recoded_df and
+    all_pomi_adjusted_df built from the whole report period. all_pomi_adjusted_df keeps the row labels of
+    all_pomi_recoded_df, so each month's labels are offset by the rows of the months before it.
+
+    Returns:
+        pd.DataFrame: all_pomi_recoded_df and all_pomi_adjusted_df
+    """
+    if not months:
+        raise ValueError("No POMI data was aggregated for the report period")
+
+    pivoted = {col for columns, _, _ in months for col in columns}
+    recoded = []
+    adjusted = []
+    offset = 0
+
+    for _, all_pomi_recoded_df, all_pomi_adjusted_df in months:
+        recoded.append(all_pomi_recoded_df)
+        adjusted.append(all_pomi_adjusted_df.set_axis(all_pomi_adjusted_df.index + offset))
+        offset += len(all_pomi_recoded_df)
+
+    all_pomi_recoded_df = pd.concat(recoded, ignore_index=True)
+    all_pomi_recoded_df = all_pomi_recoded_df[[col for col in all_pomi_recoded_df.columns if col in pivoted or not col.startswith('FIELD_KEY_')]]
+
+    return all_pomi_recoded_df, pd.concat(adjusted)
+
+
+def split_base_data(all_pomi_recoded_df: pd.DataFrame, all_pomi_adjusted_df: pd.DataFrame) -> dict:
+    """
+    Split base data built from the whole report period back into months, the inverse of merge_month_base_data().
+    all_pomi_recoded_df is in Report_End order, so each month is a run of rows and its all_pomi_adjusted_df labels
+    are offset back to start from 0. A month's columns are taken to be the field keys with any values in it.
+
+    Returns:
+        dict: (columns, all_pomi_recoded_df, all_pomi_adjusted_df) keyed by month in the format YYYY-MM
+    """
+    recoded_months = all_pomi_recoded_df['Report_End'].dt.strftime('%Y-%m')
+    adjusted_months = all_pomi_adjusted_df['Report_End'].dt.strftime('%Y-%m')
+
+    months = {}
+    offset = 0
+    for month, size in recoded_months.groupby(recoded_months, sort=False).size().items():
+        all_pomi_recoded_month = all_pomi_recoded_df.iloc[offset:offset + size].reset_index(drop=True)
+        all_pomi_adjusted_month = all_pomi_adjusted_df.loc[adjusted_months == month]
+        all_pomi_adjusted_month = all_pomi_adjusted_month.set_axis(all_pomi_adjusted_month.index - offset)
+
+        columns = [
+            col for col in all_pomi_recoded_month.columns
+            if not col.startswith('FIELD_KEY_') or all_pomi_recoded_month[col].notna().any()
+        ]
+        months[month] = (columns, all_pomi_recoded_month, all_pomi_adjusted_month)
+        offset += size
+
+    return months
@@ -0,0 +1,143 @@
+import pandas as pd
+import numpy as np
+import polars as pl
+from pipeline.utils import run_report, profiling
+
+def to_lazy(df: pd.DataFrame) -> pl.LazyFrame:
+    """
+    Convert a pandas DataFrame to a Polars LazyFrame. NaN becomes null, which Polars skips in the same places
+    pandas skips NaN.
+    """
+    return pl.from_pandas(df).lazy()
+
+
+def to_pandas(df: pl.DataFrame) -> pd.DataFrame:
+    """
+    Convert a Polars DataFrame back to pandas with missing strings as NaN, as the pandas backend produces them
+    """
+    df = df.to_pandas()
+    object_columns = df.columns[df.dtypes == object]
+    df[object_columns] = df[object_columns].where(df[object_columns].notna(), np.nan)
+
+    return df
+
+
+def get_report_period_fact(
+        prim_pomi_df: pd.DataFrame,
+        gp_dim_df: pd.DataFrame,
+        exclude_list_df: pd.DataFrame,
+        rpsd: str,
+        rped: str,
+        prim_pomi_inf_df: pd.DataFrame,
+        inf_exclude_list_df: pd.DataFrame
+        ) -> pl.LazyFrame:
+    """
+    Same rows as combine_pomi_datasets, drop_exclude_list and clean_and_join_inf_data. The left merges with the
+    exclude lists only ever mark rows to remove, so they are written as anti joins.
+    """
+    fact = to_lazy(prim_pomi_df).join(
+        to_lazy(gp_dim_df[['GP_Key','Supplier']]),
+        how='inner',
+        on='GP_Key'
+    )
+    exclude_list = to_lazy(exclude_list_df[['Supplier','SYS_Timestamp']])
+
+    to_drop = fact.join(exclude_list, how='semi', on=['Supplier','SYS_Timestamp']).select('FACT_Key')
+
+    report_period = pl.col('Report_End').is_between(
+        pl.lit(pd.Timestamp(rpsd).to_pydatetime()),
+        pl.lit(pd.Timestamp(rped).to_pydatetime())
+    )
+
+    report_period_fact = (
+        fact
+        .filter(report_period)
+        .join(to_drop, how='anti', on='FACT_Key')
+        .drop('Supplier')
+    )
+
+    report_period_inf_fact = (
+        to_lazy(prim_pomi_inf_df)
+        .filter(
+            report_period &
+            (pl.col('SYS_Timestamp') >= pl.lit(pd.Timestamp('2017-12-19 00:00:00').to_pydatetime()))
+        )
+        .join(to_lazy(inf_exclude_list_df[['SYS_Timestamp']]), how='anti', on='SYS_Timestamp')
+        .select(report_period_fact.collect_schema().names())
+    )
+
+    return pl.concat([report_period_fact, report_period_inf_fact]).with_columns(pl.col('Field_Key').cast(pl.Int64))
+
+
+def pivot_metadata(df: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Same as aggregate.pivot_metadata. Values are averaged per cell and cells with no value are left out before
+    pivoting, as pd.pivot_table does, with the columns sorted by name.
+    """
+    index = ['GP_Key','Report_End','SYS_Timestamp']
+
+    long = (
+        df
+        .drop_nulls(index + ['Field_Key'])
+        .group_by(index + ['Field_Key'])
+        .agg(pl.col('Field_Value').mean())
+        .drop_nulls('Field_Value')
+        .with_columns(('FIELD_KEY_' + pl.col('Field_Key').cast(pl.String)).alias('Field_Key'))
+        .collect()
+    )
+    field_keys = sorted(long['Field_Key'].unique())
+
+    return long.lazy().pivot(on='Field_Key', on_columns=field_keys, index=index, values='Field_Value').select(index + field_keys)
+
+
+@run_report.instrument()
+@profiling.profile_stage()
+def create_all_pomi(
+        prim_pomi_df: pd.DataFrame,
+        gp_dim_df: pd.DataFrame,
+        exclude_list_df: pd.DataFrame,
+        rpsd: str,
+        rped: str,
+        prim_pomi_inf_df: pd.DataFrame,
+        inf_exclude_list_df: pd.DataFrame,
+        prim_pomi_field_df: pd.DataFrame,
+        mapping_df: pd.DataFrame
+        ) -> pd.DataFrame:
+    """
+    Polars version of aggregate.create_all_pomi. The chain runs as lazy queries across all cores and the result is
+    returned as a pandas DataFrame with the same rows, columns and dtypes.
+
+    The field dim join in create_metadata only adds descriptive columns that the pivot drops, so it isn't repeated
+    here and prim_pomi_field_df is accepted to keep the signature the same.
+
+    Args:
+        See aggregate.create_all_pomi
+
+    Returns:
+        df (pd.DataFrame): With all inputs combined, aggregated and filtered.
+    """
+    keys = ['Report_End','PRACTICE_CODE','PRACTICE_NAME','Supplier']
+
+    metadata_wide = pivot_metadata(
+        get_report_period_fact(prim_pomi_df, gp_dim_df, exclude_list_df, rpsd, rped, prim_pomi_inf_df, inf_exclude_list_df)
+    )
+
+    all_pomi = (
+        metadata_wide
+        .join(to_lazy(gp_dim_df), how='left', on='GP_Key')
+        .with_columns(pl.sum_horizontal('FIELD_KEY_49','FIELD_KEY_50','FIELD_KEY_133').alias('online_book_cancel_count'))
+        .join(to_lazy(mapping_df), how='left', on=['PRACTICE_CODE','PRACTICE_NAME','Report_End'])
+        .with_columns(
+            pl.when(pl.len().over(['Report_End','PRACTICE_CODE']) > 1)
+            .then(pl.col('Supplier').str.to_uppercase() + ' (I)')
+            .otherwise(pl.col('Supplier'))
+            .alias('Supplier')
+        )
+        .drop_nulls(keys)
+        .group_by(keys)
+        .agg(pl.all().max())
+        .sort(keys)
+        .collect()
+    )
+
+    return to_pandas(all_pomi)
@@ -0,0 +1,138 @@
+"""
+Column pruning from the outputs back to the extraction. Each output declares the base data columns it reads, and
+get_plan() works back from the selected outputs through the recodes in aggregate.py to the field keys each stage
+needs. With "prune_columns" in the config only those field keys are extracted from the fact tables and FIELD_DIM, so
+the rest are never pivoted, recoded or held in memory, and the recodes of field keys no output reads are skipped.
+
+A practice is only given a row by the pivot for a load that reported at least one of the extracted field keys.
+Every load reports the status field keys the outputs read, so this doesn't change the outputs.
+"""
+from pipeline.processing import aggregate, create_csv, create_trend_monitor
+from pipeline.utils import output_selection
+
+## Base data each output reads from and the columns it reads, None where it reads every column
+output_columns = {
+    "pcd": ("adjusted", create_csv.pcd_id_columns + create_csv.pcd_value_columns),
+    "choices": ("adjusted", create_csv.choices_columns),
+    "benefits": ("recoded", create_csv.benefits_columns),
+    "pbi": ("adjusted", create_csv.pbi_columns),
+    "trend_monitor": ("adjusted", create_trend_monitor.trend_monitor_columns),
+    "base_data": None,
+}
+
+def is_enabled(config: dict) -> bool:
+    """
+    Pruning is switched on with "prune_columns" in the config file
+    """
+    return bool(config) and bool(config.get("prune_columns", False))
+
+
+def get_dependencies(columns, recodes: list) -> set:
+    """
+    Columns needed before recodes are applied to give the columns needed after them. Walking the recodes backwards,
+    a recode of a needed column makes the columns it reads needed too.
+    """
+    columns = set(columns)
+
+    for function, column, *args in reversed(recodes):
+        if column in columns:
+            for arg in args:
+                columns.update([arg] if isinstance(arg, str) else arg)
+
+    return columns
+
+
+def get_field_key_list(columns) -> list:
+    """
+    Field keys among columns, in Field_Key order
+    """
+    return sorted((col for col in columns if col.startswith('FIELD_KEY_')), key=lambda col: int(col[len('FIELD_KEY_'):]))
+
+
+def build_plan(adjusted_columns: list, recoded_columns: list = None) -> dict:
+    """
+    Field keys each stage needs to give the columns read from all_pomi_adjusted_df and all_pomi_recoded_df
+
+    Returns:
+        dict: "all_pomi", the field keys extracted, pivoted and recoded by create_month_summary_base_data,
+            "recoded", those all_pomi_recoded_df needs, and "adjusted", those recoded and kept by create_base_data
+    """
+    adjusted = get_dependencies(adjusted_columns, aggregate.base_data_recodes)
+    recoded = adjusted | set(recoded_columns or [])
+    all_pomi = get_dependencies(recoded, aggregate.month_summary_recodes) | set(aggregate.all_pomi_field_keys)
+
+    return {
+        "all_pomi": get_field_key_list(all_pomi),
+        "recoded": get_field_key_list(recoded),
+        "adjusted": get_field_key_list(adjusted),
+    }
+
+
+def get_plan(config: dict = None, outputs: list = None, warn: bool = False):
+    """
+    Column plan for the outputs selected in the config, or outputs if given. The base data output writes every
+    column, so nothing is pruned when it's selected and "write_base_data" is on.
+
+    Args:
+        warn (bool): Print a warning if pruning is on but skipped because of the base data output
+
+    Returns:
+        dict: build_plan() for the outputs, or None if pruning is off or an output reads every column
+    """
+    if not is_enabled(config):
+        return None
+
+    outputs = outputs or output_selection.get_outputs(config)
+    if any(output_columns[output] is None for output in outputs):
+        if warn:
+            print("Warning! prune_columns is skipped as the base data output writes every column. "
+                  "Set write_base_data to false or leave base_data out of outputs to prune.")
+        return None
+
+    columns = {"adjusted": [], "recoded": []}
+    for output in outputs:
+        base_data, output_cols = output_columns[output]
+        columns[base_data] += output_cols
+
+    return build_plan(columns["adjusted"], columns["recoded"])
+
+
+def get_field_keys(plan: dict = None):
+    """
+    Field_Key values to extract for a plan
+
+    Returns:
+        list: Field_Key integers, or None for every field key
+    """
+    if plan is None:
+        return None
+
+    return [int(col[len('FIELD_KEY_'):]) for col in plan["all_pomi"]]
+
+
+def covers(cached_plan: dict, plan: dict) -> bool:
+    """
+    Whether data built with cached_plan, e.g. an extraction from the stage cache, has every column plan needs
+    """
+    if cached_plan is None:
+        return True
+    if plan is None:
+        return False
+
+    return all(set(plan[stage]) <= set(cached_plan[stage]) for stage in plan)
+
+
+def get_cached_plan(manifest: dict, stage: str):
+    """
+    Column plan the "extract" or "base_data" stage cached for the run in manifest was built with. None, i.e. every
+    column, for runs cached before pruning
+    """
+    return (manifest or {}).get("column_plans", {}).get(stage)
+
+
+def set_cached_plan(manifest: dict, stage: str, plan: dict = None) -> None:
+    """
+    Record the column plan of a stage in the manifest, before the stage is cached so it's saved with it
+    """
+    if manifest is not None:
+        manifest.setdefault("column_plans", {})[stage] = plan
@@ -1,7 +1,90 @@
 import pandas as pd
 import numpy as np
-from pipeline.utils import params, rename_columns, csv_functions, recode
+from pipeline.utils import params, rename_columns, csv_functions, recode, profiling
 
+## Columns of all_pomi_adjusted each output reads, see column_plan
+pcd_id_columns = [
+    'Report_End',
+    'REGION_CODE',
+    'REGION_NAME',
+    'SUB_ICB_CODE',
+    'SUB_ICB_NAME',
+    'PRACTICE_CODE',
+    'PRACTICE_NAME',
+    'Supplier'
+    ]
+
+pcd_value_columns = [
+    'Total_Patients',
+    'FIELD_KEY_21',
+    'FIELD_KEY_32',
+    'online_book_cancel_count',
+    'FIELD_KEY_22',
+    'FIELD_KEY_34',
+    'FIELD_KEY_51',
+    'FIELD_KEY_61',
+    'FIELD_KEY_62',
+    'FIELD_KEY_63',
+    'FIELD_KEY_30',
+    'FIELD_KEY_31',
+    'FIELD_KEY_47'
+    ]
+
+choices_columns = [
+    'Report_End',
+    'PRACTICE_CODE',
+    'PRACTICE_NAME',
+    'Supplier',
+    'Total_Patients',
+    'FIELD_KEY_21',
+    'FIELD_KEY_32',
+    'online_book_cancel_count',
+    'FIELD_KEY_22',
+    'FIELD_KEY_34',
+    'FIELD_KEY_51',
+    'FIELD_KEY_61',
+    'FIELD_KEY_62',
+    'FIELD_KEY_63'
+    ]
+
+pbi_columns = [
+    'REGION_CODE','REGION_NAME','ICB_CODE','ICB_NAME','SUB_ICB_CODE','SUB_ICB_NAME','PRACTICE_CODE','PRACTICE_NAME',
+    'Supplier','Report_End','Total_Patients','FIELD_KEY_21','FIELD_KEY_22','FIELD_KEY_61','FIELD_KEY_32',
+    'online_book_cancel_count','FIELD_KEY_30','FIELD_KEY_34','FIELD_KEY_51','FIELD_KEY_62','FIELD_KEY_63'
+    ]
+
+## Columns of all_pomi_recoded the benefits output reads
+benefits_columns = [
+    'Report_End',
+    'Supplier',
+    'FIELD_KEY_8',
+    'FIELD_KEY_10',
+    'FIELD_KEY_11',
+    'FIELD_KEY_12',
+    'FIELD_KEY_13',
+    'FIELD_KEY_14',
+    'FIELD_KEY_15',
+    'FIELD_KEY_16',
+    'FIELD_KEY_17',
+    'FIELD_KEY_30',
+    'FIELD_KEY_31',
+    'FIELD_KEY_40',
+    'FIELD_KEY_42',
+    'FIELD_KEY_44',
+    'FIELD_KEY_45',
+    'FIELD_KEY_47',
+    'FIELD_KEY_48',
+    'FIELD_KEY_49',
+    'FIELD_KEY_50',
+    'FIELD_KEY_51',
+    'FIELD_KEY_52',
+    'FIELD_KEY_53',
+    'FIELD_KEY_54',
+    'FIELD_KEY_56',
+    'FIELD_KEY_57'
+    ]
+
+@profiling.profile_stage()
 def create_pcd_output(df: pd.DataFrame) -> pd.DataFrame:
     """
     Selects columns, changes dataframe to long from wide, and only includes data for the current financial year 
@@ -15,31 +98,8 @@ def create_pcd_output(df: pd.DataFrame) -> pd.DataFrame:
 
     df = pd.melt(
         df,
-        id_vars=[
-            'Report_End',
-            'REGION_CODE',
-            'REGION_NAME',
-            'SUB_ICB_CODE',
-            'SUB_ICB_NAME',
-            'PRACTICE_CODE',
-            'PRACTICE_NAME',
-            'Supplier'
-            ],
-        value_vars=[
-            'Total_Patients',
-            'FIELD_KEY_21',
-            'FIELD_KEY_32',
-            'online_book_cancel_count',
-            'FIELD_KEY_22',
-            'FIELD_KEY_34',
-            'FIELD_KEY_51',
-            'FIELD_KEY_61',
-            'FIELD_KEY_62',
-            'FIELD_KEY_63',
-            'FIELD_KEY_30',
-            'FIELD_KEY_31',
-            'FIELD_KEY_47'
-            ],
+        id_vars=pcd_id_columns,
+        value_vars=pcd_value_columns,
         var_name='field'
         )
 
@@ -60,6 +120,7 @@ def create_pcd_output(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+@profiling.profile_stage()
 def create_choices_output(df: pd.DataFrame) -> pd.DataFrame:
     """
     Selects columns for choices output, filters for current month, and recode three columns 
@@ -70,22 +131,7 @@ def create_choices_output(df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: Output to be sent to choices
     """
-    cols = [
-        'Report_End',
-        'PRACTICE_CODE',
-        'PRACTICE_NAME',
-        'Supplier',
-        'Total_Patients',
-        'FIELD_KEY_21',
-        'FIELD_KEY_32',
-        'online_book_cancel_count',
-        'FIELD_KEY_22',
-        'FIELD_KEY_34',
-        'FIELD_KEY_51',
-        'FIELD_KEY_61',
-        'FIELD_KEY_62',
-        'FIELD_KEY_63'
-        ]
+    cols = choices_columns
     
     df = df[cols]
     df = csv_functions.filter_for_report_end(df, 'Report_End')
@@ -100,6 +146,7 @@ def create_choices_output(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+@profiling.profile_stage()
 def create_benefits_dataset(df: pd.DataFrame) -> pd.DataFrame:
     """
     Select columns for the benefits export, filter for current month, and group by suppliers
@@ -110,35 +157,7 @@ def create_benefits_dataset(df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: File for the benefits export
     """
-    cols = [
-        'Report_End',
-        'Supplier',
-        'FIELD_KEY_8',
-        'FIELD_KEY_10',
-        'FIELD_KEY_11',
-        'FIELD_KEY_12',
-        'FIELD_KEY_13',
-        'FIELD_KEY_14',
-        'FIELD_KEY_15',
-        'FIELD_KEY_16',
-        'FIELD_KEY_17',
-        'FIELD_KEY_30',
-        'FIELD_KEY_31',
-        'FIELD_KEY_40',
-        'FIELD_KEY_42',
-        'FIELD_KEY_44',
-        'FIELD_KEY_45',
-        'FIELD_KEY_47',
-        'FIELD_KEY_48',
-        'FIELD_KEY_49',
-        'FIELD_KEY_50',
-        'FIELD_KEY_51',
-        'FIELD_KEY_52',
-        'FIELD_KEY_53',
-        'FIELD_KEY_54',
-        'FIELD_KEY_56',
-        'FIELD_KEY_57'
-        ]
+    cols = benefits_columns
 
     df = df[cols]
     df = csv_functions.filter_for_report_end(df, 'Report_End')
@@ -154,6 +173,7 @@ def create_benefits_dataset(df: pd.DataFrame) -> pd.DataFrame:
 
     return df
 
+@profiling.profile_stage()
 def pbi_pivot(code, prefix, pbi_fields_long):
     """
     Pivots the pbi_fields_long table, groups by a specified column and adds a prefix to column names to define whether
@@ -187,33 +207,31 @@ def pbi_pivot(code, prefix, pbi_fields_long):
 
     return data_wide
 
-def create_pbi_output(all_pomi_adjusted: pd.DataFrame) -> pd.DataFrame:
+## Geography levels of the PBI aggregate tables, as (star schema table, code column, column prefix)
+pbi_geography_levels = [
+    ('national', 'COUNTRY_CODE', 'NAT_'),
+    ('sub_icb', 'SUB_ICB_CODE', 'SUB_ICB_'),
+    ('icb', 'ICB_CODE', 'ICB_'),
+    ('region', 'RegionCode', 'REG_'),
+]
+
+@profiling.profile_stage()
+def create_pbi_star_schema(all_pomi_adjusted: pd.DataFrame) -> dict:
+    """
+    Build the PBI data as a practice fact table and one aggregate table per geography level, which join to the
+    practice table on the level's code and report_period_end. flatten_pbi_star_schema() joins them into the single
+    PBI table.
+
+    Args:
+        all_pomi_adjusted (pd.DataFrame): All POMI data
 
+    Returns:
+        dict: DataFrames keyed by "practice" and the table names in pbi_geography_levels
+    """
     ## Begin the table for PBI outputs
-    pbi_fields = all_pomi_adjusted[['REGION_CODE','REGION_NAME','ICB_CODE','ICB_NAME','SUB_ICB_CODE','SUB_ICB_NAME',
-                                    'PRACTICE_CODE','PRACTICE_NAME','Supplier','Report_End','Total_Patients','FIELD_KEY_21',
-                                    'FIELD_KEY_22','FIELD_KEY_61','FIELD_KEY_32','online_book_cancel_count','FIELD_KEY_30',
-                                    'FIELD_KEY_34','FIELD_KEY_51','FIELD_KEY_62','FIELD_KEY_63']]
+    pbi_fields = all_pomi_adjusted[pbi_columns]
     pbi_fields.insert(0,'COUNTRY_CODE','E')
-    pbi_fields = pbi_fields.rename(columns=
-                                {
-                                    'REGION_CODE':'RegionCode',
-                                    'REGION_NAME':'RegionName',
-                                    'PRACTICE_CODE':'GPPracticeCode',
-                                    'PRACTICE_NAME':'GPPracticeName',
-                                    'Report_End':'report_period_end',
-                                    'Total_Patients':'NoPatients',
-                                    'FIELD_KEY_21':'APPT_FUNC_FLAG',
-                                    'FIELD_KEY_22':'PRESC_FUNC_FLAG',
-                                    'FIELD_KEY_61':'DCR_FUNC_FLAG',
-                                    'FIELD_KEY_32':'Pat_Appts_Enbld',
-                                    'online_book_cancel_count':'Pat_Appts_Use',
-                                    'FIELD_KEY_30':'Total_Pat_Enabled',
-                                    'FIELD_KEY_34':'Pat_Presc_Enbld',
-                                    'FIELD_KEY_51':'Pat_Presc_Use',
-                                    'FIELD_KEY_62':'Pat_DetCodeRec_Enbld',
-                                    'FIELD_KEY_63':'Pat_DetCodeRec_Use'
-                                })
+    pbi_fields = pbi_fields.rename(columns=rename_columns.rename_pbi_output)
     ## Where a value is 2 set it to 1, if it is not 2 then set it to 0
     pbi_fields['APPT_FUNC_FLAG'] = np.where(pbi_fields['APPT_FUNC_FLAG'] == 2, 1, 0)
     pbi_fields['PRESC_FUNC_FLAG'] = np.where(pbi_fields['PRESC_FUNC_FLAG'] == 2, 1, 0)
@@ -229,36 +247,30 @@ def create_pbi_output(all_pomi_adjusted: pd.DataFrame) -> pd.DataFrame:
             'NoPatients','APPT_FUNC_FLAG','PRESC_FUNC_FLAG','DCR_FUNC_FLAG','Pat_Appts_Enbld','Pat_Appts_Use',
             'Total_Pat_Enabled','Pat_Presc_Enbld','Pat_Presc_Use','Pat_DetCodeRec_Enbld','Pat_DetCodeRec_Use'])
 
+    ## Change region names to commissioning regions
+    tables = {"practice": recode.change_region_names(pbi_fields, 'RegionName', 'RegionCode')}
+
+    for table, code, prefix in pbi_geography_levels:
+        tables[table] = pbi_pivot(code, prefix, pbi_fields_long)
+
+    return tables
+
 
+def flatten_pbi_star_schema(tables: dict) -> pd.DataFrame:
     """
     Joins all PBI geography tables together to produce a table with values grouped by mappings.
     
     Returns:
         pomi_all_out: Dataframe that feeds into the PBI dashboard.
     """
-    pomi_all_out = pd.merge(
-        pbi_fields,
-        pbi_pivot('COUNTRY_CODE','NAT_', pbi_fields_long),
-        how='left',
-        on=['COUNTRY_CODE','report_period_end'])
-
-    pomi_all_out = pd.merge(
-        pomi_all_out,
-        pbi_pivot('SUB_ICB_CODE','SUB_ICB_',pbi_fields_long),
-        how='left',
-        on=['SUB_ICB_CODE','report_period_end'])
-
-    pomi_all_out = pd.merge(
-        pomi_all_out,
-        pbi_pivot('ICB_CODE','ICB_',pbi_fields_long),
-        how='left',
-        on=['ICB_CODE','report_period_end'])
-
-    pomi_all_out = pd.merge(
-        pomi_all_out,
-        pbi_pivot('RegionCode','REG_',pbi_fields_long),
-        how='left',
-        on=['RegionCode','report_period_end'])
+    pomi_all_out = tables["practice"]
+
+    for table, code, prefix in pbi_geography_levels:
+        pomi_all_out = pd.merge(
+            pomi_all_out,
+            tables[table],
+            how='left',
+            on=[code,'report_period_end'])
 
     pomi_all_out = pomi_all_out[[
         'COUNTRY_CODE','RegionCode','RegionName','ICB_CODE','ICB_NAME','SUB_ICB_CODE','SUB_ICB_NAME','GPPracticeCode',
@@ -277,7 +289,9 @@ def create_pbi_output(all_pomi_adjusted: pd.DataFrame) -> pd.DataFrame:
         'ICB_PRAC_COUNT','Total_Pat_Enabled'
     ]].sort_values(by=['RegionCode'])
     
-    ## Change region names to commissioning regions
-    pomi_all_out = recode.change_region_names(pomi_all_out, 'RegionName', 'RegionCode')
-    
     return pomi_all_out
+
+@profiling.profile_stage()
+def create_pbi_output(all_pomi_adjusted: pd.DataFrame) -> pd.DataFrame:
+
+    return flatten_pbi_star_schema(create_pbi_star_schema(all_pomi_adjusted))
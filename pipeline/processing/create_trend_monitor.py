@@ -1,13 +1,13 @@
 import pandas as pd
 import numpy as np
-from pipeline.utils import rename_columns
-from datetime import datetime as ddt
+from pipeline.utils import rename_columns, profiling
 import os
 import glob
 from ..data import input
+from . import dq_rules, trend_monitor_history
 from ..utils.params import *
 
-def build_trend_monitor_time_series_comparison(df: pd.DataFrame, function, cols: list) -> pd.DataFrame:
+def build_trend_monitor_time_series_comparison(df: pd.DataFrame, function, cols: list, history_columns: list = None) -> pd.DataFrame:
     """
     Compare a month to previous month for the 12 month time series in all_pomi_adjusted_df
 
@@ -15,18 +15,27 @@ def build_trend_monitor_time_series_comparison(df: pd.DataFrame, function, cols:
         df (pd.DataFrame): Data containing all POMI data
         function: The function to be used to compare each month to previous
         cols (list): List of columns to rename the output table with
+        history_columns (list): Columns of df that function reads. If given, month pairs already compared from the
+            same rows are loaded from the Trend Monitor history rather than compared again
     
     Returns:
         pd.DataFrame: Time series for the function applied with columns renamed
     """
     output = []
     all_dates = get_list_of_months(df)
+    counts = {}
     
     for index, i in enumerate(all_dates):
         if index < (len(all_dates) - 1):
-            data = function(df, all_dates[index], all_dates[index + 1])
+            if history_columns is None:
+                data = function(df, all_dates[index], all_dates[index + 1])
+            else:
+                data = trend_monitor_history.compare_months(function, df, all_dates[index], all_dates[index + 1], history_columns, counts)
             
         output.append(data)
+
+    if counts:
+        print(f"{function.__name__}: {counts.get('computed', 0)} months compared, {counts.get('loaded', 0)} loaded from history")
         
     time_series_df = pd.DataFrame(output).head(11)
     
@@ -112,6 +121,7 @@ def create_transaction_volumes(df: pd.DataFrame) -> pd.DataFrame:
     df.columns = ['Date', 'Total online transaction count', 'Monthly change']
     return df
 
+@profiling.profile_stage()
 def compare_number_of_practices(df: pd.DataFrame, curr_date: str, prev_date: str):
     """
     Helper function to compare numbers, and lists, of practices month to month.
@@ -136,12 +146,13 @@ def compare_number_of_practices(df: pd.DataFrame, curr_date: str, prev_date: str
     
     return curr_date, difference_practices_list, ', '.join(map(str,sorted(difference_practices))), new_practices_list, ', '.join(map(str,sorted(new_practices)))
 
-def create_practices_list_change(df: pd.DataFrame) -> pd.DataFrame:
+def create_practices_list_change(df: pd.DataFrame, history: bool = False) -> pd.DataFrame:
     """
     Create the practices list change for the fourth tab of the trend monitor
     
     Args:
         df (pd.DataFrame): DataFrame containing all pomi data for last 12 months
+        history (bool): Load months already compared by earlier runs from the Trend Monitor history
         
     Returns:
         pd.DataFrame: Practices list change output for trend monitor
@@ -155,7 +166,8 @@ def create_practices_list_change(df: pd.DataFrame) -> pd.DataFrame:
             "List of practices in previous month that aren't in the current month",
             "Number of new practices",
             "List of new practices"
-        ]
+        ],
+        ['PRACTICE_CODE'] if history else None
     )
     return practices_list_change
 
@@ -168,6 +180,16 @@ def selector(row, current_month, last_month):
     else:
         return False
     
+online_enabled_columns = [
+    'PRACTICE_CODE',
+    'FIELD_KEY_21',
+    'FIELD_KEY_22',
+    'FIELD_KEY_24',
+    'FIELD_KEY_25',
+    'FIELD_KEY_61'
+]
+
+@profiling.profile_stage()
 def online_enabled(df: pd.DataFrame, curr_date: str, prev_date: str):
     """
     Compare a month to the previous month to find practics that have disabled specific services. 
@@ -182,14 +204,7 @@ def online_enabled(df: pd.DataFrame, curr_date: str, prev_date: str):
         str: curr_date
         list: Ordered lists of practices that have disabled their services for each of the field keys defined in columns  
     """
-    columns = [
-        'PRACTICE_CODE',
-        'FIELD_KEY_21',
-        'FIELD_KEY_22',
-        'FIELD_KEY_24',
-        'FIELD_KEY_25',
-        'FIELD_KEY_61'
-    ]
+    columns = online_enabled_columns
 
     current_subset = df.loc[df['Report_End'] == curr_date].loc[:, df.columns.isin(columns)]
     previous_subset = df.loc[df['Report_End'] == prev_date].loc[:, df.columns.isin(columns)]
@@ -216,10 +231,11 @@ def online_enabled(df: pd.DataFrame, curr_date: str, prev_date: str):
 
     return curr_date, ', '.join(map(str,sorted(output[0]))), ', '.join(map(str,sorted(output[1]))), ', '.join(map(str,sorted(output[2]))), ', '.join(map(str,sorted(output[3]))), ', '.join(map(str,sorted(output[4])))
 
-def create_online_services_enabled_status(df: pd.DataFrame) -> pd.DataFrame:
+def create_online_services_enabled_status(df: pd.DataFrame, history: bool = False) -> pd.DataFrame:
     """
     Using online_enabled() and build_trend_monitor_time_series_comparison(), create a time series for online enabled and stack the rows into a dataframe.
-    Rename columns to match descriptions of field keys
+    Rename columns to match descriptions of field keys. With history, months already compared by earlier runs are
+    loaded from the Trend Monitor history.
     """
     services_enabled = build_trend_monitor_time_series_comparison(
         df, 
@@ -231,50 +247,26 @@ def create_online_services_enabled_status(df: pd.DataFrame) -> pd.DataFrame:
             'Online summary record view enabled status',
             'Online record view enabled status',
             'Coded record view enabled status'
-        ]
+        ],
+        [column for column in online_enabled_columns if column in df.columns] if history else None
     )
     return services_enabled
 
-def total_transactions_counts(df: pd.DataFrame, date: str) -> pd.DataFrame:
+def create_total_transactions(df: pd.DataFrame, exceptions: pd.DataFrame = None) -> pd.DataFrame:
     """
-    Check for practices where sum of all transactions is greater than total transactions
+    Summarise the total transactions DQ exceptions for every month in all_pomi_adjusted
 
     Args:
         df (pd.DataFrame): All POMI data
-        date (str): A date within the df
+        exceptions (pd.DataFrame): Long exceptions table from dq_rules.evaluate_dq_rules(), evaluated from df if not given
 
     Returns:
-        str: date
-        list: Ordered lists of practices where sum of all transactions is greater than total transactions 
-    """
-    columns = [
-        'PRACTICE_CODE',
-        'online_book_cancel_count', 
-        'FIELD_KEY_51',
-        'FIELD_KEY_63', 
-        'FIELD_KEY_47'
-    ]
-
-    current_subset = df.loc[df['Report_End'] == date].loc[:, df.columns.isin(columns)]
-
-    current_subset['sum_transactions'] = current_subset.iloc[:, 1:4].sum(axis=1)
-
-    transactions = current_subset.query("sum_transactions > FIELD_KEY_47").iloc[:,0].tolist()
-
-    return date, len(transactions), ', '.join(map(str,sorted(transactions)))
-
-def create_total_transactions(df: pd.DataFrame) -> pd.DataFrame:
-    """
-    Loop through all months in all_pomi_adjusted to find any practices that fit criteria in total_transactions_counts()
+        pd.DataFrame: Number and list of practices where sum of all transactions is greater than total transactions
     """
-    output = []
-    all_dates = get_list_of_months(df)
-    
-    for i in all_dates:
-        data = total_transactions_counts(df, i)
-        output.append(data)
-        
-    time_series_df = pd.DataFrame(output)
+    if exceptions is None:
+        exceptions = dq_rules.evaluate_dq_rules(df)
+
+    time_series_df = dq_rules.summarise_exceptions_by_month(exceptions, 'total_transactions', get_list_of_months(df))
     time_series_df.columns = [
         'Date', 
         'Number of total transactions for appts, prescriptions and DCR views is greater than the total transactions',
@@ -283,38 +275,31 @@ def create_total_transactions(df: pd.DataFrame) -> pd.DataFrame:
     
     return time_series_df
 
-def perc_patients_enabled(df: pd.DataFrame, curr_date: str, prev_date: str):
+def perc_patients_enabled(exceptions: pd.DataFrame, curr_date: str, prev_date: str):
     """
     Find practices for most recent month with more online patients than total patients. 
     Check if they had the same issue last month
 
     Args:
-        df (pd.DataFrame): All POMI data
+        exceptions (pd.DataFrame): Long exceptions table from dq_rules.evaluate_dq_rules()
         curr_date (str): Most recent date
         prev_date (str): Previous month
     
     Returns:
         pd.DataFrame: Containing all practices with higher count of online patients than total patients
     """
-    patients_enabled = df.copy()
-    patients_enabled = patients_enabled[['Report_End', 'PRACTICE_CODE', 'FIELD_KEY_30', 'Total_Patients']]
+    patients_enabled_greater_100 = dq_rules.get_rule_exceptions(exceptions, 'percentage_patients_enabled')
 
-    patients_enabled['percentage_enabled'] = round(100*(patients_enabled['FIELD_KEY_30']/patients_enabled['Total_Patients']), 2)
-
-    patients_enabled_greater_100 = patients_enabled.loc[patients_enabled['percentage_enabled'] >= 100]
     current_patients_enabled_greater_100 = (
         patients_enabled_greater_100
         .loc[patients_enabled_greater_100['Report_End'] == curr_date]
-        [['PRACTICE_CODE', 'FIELD_KEY_30', 'Total_Patients','percentage_enabled']]
+        [['PRACTICE_CODE', 'Value', 'Threshold', 'Metric']]
     )
 
-    prev_patients_enabled_greater_100 = (
-        patients_enabled_greater_100
-        .loc[patients_enabled_greater_100['Report_End'] == prev_date]
-    )
+    prev_practices = patients_enabled_greater_100.loc[patients_enabled_greater_100['Report_End'] == prev_date, 'PRACTICE_CODE']
 
     current_patients_enabled_greater_100['Inc last month'] = np.where(
-        current_patients_enabled_greater_100['PRACTICE_CODE'].isin(list(prev_patients_enabled_greater_100['PRACTICE_CODE'].values)),
+        current_patients_enabled_greater_100['PRACTICE_CODE'].isin(prev_practices),
         'True',
         'False'
     )
@@ -329,64 +314,79 @@ def perc_patients_enabled(df: pd.DataFrame, curr_date: str, prev_date: str):
 
     return current_patients_enabled_greater_100
 
+@profiling.profile_stage()
 def check_CQRS_participation(root : str, df: pd.DataFrame):
     """
     Checks if practice codes are approved and if not, display practices in the trend monitor.
     Args:
-    status_df: The QS part status file
-    prac_df: The praticipation file
+    root: Root directory containing the participation and QS part status files
+    df: All POMI data
     """
 
     prac_df, status_df = input.get_practicipation_dataframes(root)
-    df_cols = [col for col in list(status_df.columns) if col.startswith("Unnamed") == False]
-    status_df = status_df[df_cols]
-
-    pracs = status_df[["Service\nProvider Id","Status", "Status Date"]]
-    prac_qs_status = list(status_df["Service\nProvider Id"].unique())
-    prac_check = []
-
-    for i in range(len(pracs)):
-        row = list(pracs.iloc[i])
-        prac_code, status, status_date = row
-        status_date = ddt.strptime(status_date, "%d/%m/%Y")
-        expiry_date = ddt.strptime(get_report_period_start_date(),"%Y-%m-%d")
-        
-        if status == "Approved" and status_date <= expiry_date:
-            prac_check.append(prac_code)
-        
-    prac_list = list(prac_df["PRACTICE_CODE"].unique())
-    prac_not_approved = [prac for prac in prac_list if prac not in prac_check]
 
-    report_end = df["Report_End"].sort_values(ascending=False).unique()[0]
-    df = df[df["Report_End"] == report_end]
-    
-    prac_status = []
-    prac_in_pub = list(df["PRACTICE_CODE"].unique())
+    ## Dates that don't parse are reported rather than left as NaT, which would count the practice as not approved
+    status_date = pd.to_datetime(status_df["Status Date"], format="%d/%m/%Y", errors="coerce")
+    invalid = status_df.loc[status_date.isna(), ["Service\nProvider Id", "Status Date"]]
+    if not invalid.empty:
+        rows = ", ".join(f"{prac_code} ({date})" for prac_code, date in invalid.itertuples(index=False))
+        raise ValueError(f"Status Date in the QS part status file is not in the format DD/MM/YYYY for {rows}")
 
-    for prac in prac_not_approved:
-        if prac in prac_in_pub:
-            if prac in prac_qs_status:
-                prac_status.append("Rejected")
-            else:
-                prac_status.append("In publication but not on QS status")
-        else:
-            prac_status.append("Practice not in publication")
+    expiry_date = pd.Timestamp(get_report_period_start_date())
+
+    approved = status_df.loc[
+        (status_df["Status"] == "Approved") & 
+        (status_date <= expiry_date),
+        "Service\nProvider Id"
+    ]
+
+    prac_list = pd.Series(prac_df["PRACTICE_CODE"].unique())
+    prac_not_approved = prac_list.loc[~prac_list.isin(approved)]
+
+    report_end = df["Report_End"].max()
+    prac_in_pub = df.loc[df["Report_End"] == report_end, "PRACTICE_CODE"]
+
+    prac_status = np.select(
+        [
+            ~prac_not_approved.isin(prac_in_pub),
+            prac_not_approved.isin(status_df["Service\nProvider Id"])
+        ],
+        [
+            "Practice not in publication",
+            "Rejected"
+        ],
+        default="In publication but not on QS status"
+    )
     
-    excel_df = pd.DataFrame({"Date":report_end, "Practices not approved":prac_not_approved, "Practice status":prac_status})
+    excel_df = pd.DataFrame({"Date":report_end, "Practices not approved":prac_not_approved.values, "Practice status":prac_status})
     
     return excel_df
 
-def create_percentage_patients_enabled(df: pd.DataFrame) -> pd.DataFrame:
+def create_percentage_patients_enabled(df: pd.DataFrame, exceptions: pd.DataFrame = None) -> pd.DataFrame:
     """
     Run perc_patients_enabled() for most recent month
     """
-    current_date = get_list_of_months(df)[0]
-    previous_date = get_list_of_months(df)[1]
+    if exceptions is None:
+        exceptions = dq_rules.evaluate_dq_rules(df)
+
+    current_date, previous_date = get_list_of_months(df)[0:2]
     
-    patients_enabled = perc_patients_enabled(df, current_date, previous_date)
+    patients_enabled = perc_patients_enabled(exceptions, current_date, previous_date)
 
     return patients_enabled
 
+comparison_columns = [
+    'FIELD_KEY_32',
+    'online_book_cancel_count',
+    'FIELD_KEY_34',
+    'FIELD_KEY_51',
+    'FIELD_KEY_62',
+    'FIELD_KEY_63',
+    'FIELD_KEY_30',
+    'FIELD_KEY_31',
+    'FIELD_KEY_47'
+]
+
 def trend_monitor_comparison_base_data(input_df: pd.DataFrame, supplier: str) -> pd.DataFrame:
     """
     Take all_pomi_adjusted and clean the data. Select most recent 3 months, select a single supplier, and group specified columns by practice.
@@ -398,33 +398,21 @@ def trend_monitor_comparison_base_data(input_df: pd.DataFrame, supplier: str) ->
     Returns:
         pd.DataFrame: Data ready for month by month comparisons 
     """
-    df = input_df.copy()
+    columns = comparison_columns
 
-    df['Supplier'] = np.where(df['Supplier'] == 'EMIS (I)', 'EMIS', df['Supplier'])
-    df['Supplier'] = np.where(df['Supplier'] == 'VISION (I)', 'VISION', df['Supplier'])
-    df['Supplier'] = np.where(df['Supplier'] == 'TPP (I)', 'TPP', df['Supplier'])
+    ## Untag duplicate suppliers without changing input_df, and only take the rows and columns that are summed
+    suppliers = input_df['Supplier'].replace({'EMIS (I)': 'EMIS', 'VISION (I)': 'VISION', 'TPP (I)': 'TPP'})
+    rows = input_df['Report_End'].isin(get_list_of_months(input_df)[0:3]) & (suppliers == supplier)
 
     df = (
-        df
-        .loc[df['Report_End'].isin(get_list_of_months(input_df)[0:3])]
-        .loc[df['Supplier'] == supplier]
+        input_df
+        .loc[rows, ['Report_End'] + columns]
+        .assign(Supplier=suppliers[rows])
         .groupby(['Report_End','Supplier'])
         .sum()
         .reset_index()
         .sort_values(['Report_End'], ascending=False) 
-    )[[
-        'Report_End',
-        'Supplier',
-        'FIELD_KEY_32',
-        'online_book_cancel_count',
-        'FIELD_KEY_34',
-        'FIELD_KEY_51',
-        'FIELD_KEY_62',
-        'FIELD_KEY_63',
-        'FIELD_KEY_30',
-        'FIELD_KEY_31',
-        'FIELD_KEY_47'
-    ]]
+    )[['Report_End','Supplier'] + columns]
     
     return df
 
@@ -463,6 +451,7 @@ def calculate_percentage_change(df: pd.DataFrame):
     
     return df2[:2]
 
+@profiling.profile_stage()
 def create_month_by_month_comparison(all_pomi_adjusted: pd.DataFrame):
     """
     Using table created in trend_monitor_comparison_base_data(), loop through each supplier and append to one another.
@@ -474,8 +463,6 @@ def create_month_by_month_comparison(all_pomi_adjusted: pd.DataFrame):
     Returns:
         pd.DataFrame: 3 dataframes with counts, differences, and percentages to be appended when exported
     """
-    input_df = all_pomi_adjusted.copy()
-    
     supplier_list = [
         'EMIS',
         'TPP',
@@ -487,7 +474,7 @@ def create_month_by_month_comparison(all_pomi_adjusted: pd.DataFrame):
 
     for supplier in supplier_list:
 
-        df = trend_monitor_comparison_base_data(input_df, supplier)
+        df = trend_monitor_comparison_base_data(all_pomi_adjusted, supplier)
         counts.append(df[:2])
 
         diff = calculate_differences(df)
@@ -505,3 +492,7 @@ def create_month_by_month_comparison(all_pomi_adjusted: pd.DataFrame):
     percentages.rename(columns=rename_columns.rename_pcd_output, inplace = True)
 
     return data, differences, percentages
+
+
+## Columns of all_pomi_adjusted the Trend Monitor and its DQ rules read, see column_plan
+trend_monitor_columns = ['Report_End', 'Supplier', 'Total_Patients'] + online_enabled_columns + comparison_columns
@@ -0,0 +1,112 @@
+import pandas as pd
+
+def total_transactions_rule(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Flag practices where the sum of appointment, prescription and DCR transactions is greater than total transactions
+
+    Args:
+        df (pd.DataFrame): All POMI data
+
+    Returns:
+        pd.DataFrame: Value, threshold and metric for every row in df
+    """
+    value = df[['online_book_cancel_count','FIELD_KEY_51','FIELD_KEY_63']].sum(axis=1)
+    threshold = df['FIELD_KEY_47']
+
+    return pd.DataFrame({
+        'Value': value,
+        'Threshold': threshold,
+        'Metric': value - threshold,
+        'Exception': value > threshold
+    })
+
+def percentage_patients_enabled_rule(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Flag practices with more online patients than total patients
+
+    Args:
+        df (pd.DataFrame): All POMI data
+
+    Returns:
+        pd.DataFrame: Value, threshold and metric for every row in df
+    """
+    percentage_enabled = round(100*(df['FIELD_KEY_30']/df['Total_Patients']), 2)
+
+    return pd.DataFrame({
+        'Value': df['FIELD_KEY_30'],
+        'Threshold': df['Total_Patients'],
+        'Metric': percentage_enabled,
+        'Exception': percentage_enabled >= 100
+    })
+
+dq_rules = {
+    'total_transactions': total_transactions_rule,
+    'percentage_patients_enabled': percentage_patients_enabled_rule,
+}
+
+def evaluate_dq_rules(df: pd.DataFrame, rules: dict = None) -> pd.DataFrame:
+    """
+    Evaluate every DQ rule for every month at once and stack the failing rows into a long exceptions table.
+    Each rule is a single vectorised pass over df, so adding a rule does not add a scan per month. Value, Threshold
+    and Metric are stacked as objects, so the values of a rule keep their own type rather than all becoming floats,
+    and get_rule_exceptions() gives them back their dtype.
+
+    Args:
+        df (pd.DataFrame): All POMI data for last 12 months
+        rules (dict): Rule name to rule function, defaults to dq_rules
+
+    Returns:
+        pd.DataFrame: One row per rule, month and practice that failed the rule
+    """
+    if rules is None:
+        rules = dq_rules
+
+    exceptions = []
+    for rule, function in rules.items():
+        result = function(df)
+        failed = result['Exception'].fillna(False).astype(bool)
+
+        exceptions.append(pd.DataFrame({
+            'Rule': rule,
+            'Report_End': df.loc[failed, 'Report_End'],
+            'PRACTICE_CODE': df.loc[failed, 'PRACTICE_CODE'],
+            'Value': result.loc[failed, 'Value'].astype(object),
+            'Threshold': result.loc[failed, 'Threshold'].astype(object),
+            'Metric': result.loc[failed, 'Metric'].astype(object)
+        }))
+
+    return pd.concat(exceptions, ignore_index=True)
+
+def get_rule_exceptions(exceptions: pd.DataFrame, rule: str) -> pd.DataFrame:
+    """
+    Select the exceptions raised by a single rule, with Value, Threshold and Metric in the dtypes the rule gave them
+    """
+    return exceptions.loc[exceptions['Rule'] == rule].infer_objects()
+
+def summarise_exceptions_by_month(exceptions: pd.DataFrame, rule: str, all_dates: list) -> pd.DataFrame:
+    """
+    Count and list the practices failing a rule in each month. Months with no exceptions are kept with a count of 0
+
+    Args:
+        exceptions (pd.DataFrame): Long exceptions table from evaluate_dq_rules()
+        rule (str): Name of the rule to summarise
+        all_dates (list): Months to report on, in the order they should appear
+
+    Returns:
+        pd.DataFrame: Date, number of practices and comma separated list of practices for each month
+    """
+    rule_exceptions = get_rule_exceptions(exceptions, rule)
+
+    grouped = rule_exceptions.groupby('Report_End')['PRACTICE_CODE']
+    counts = grouped.size().reindex(all_dates, fill_value=0)
+    practices = (
+        grouped
+        .agg(lambda codes: ', '.join(map(str, sorted(codes))))
+        .reindex(all_dates, fill_value='')
+    )
+
+    return pd.DataFrame({
+        'Date': all_dates,
+        'Count': counts.values,
+        'Practices': practices.values
+    })
@@ -0,0 +1,59 @@
+import pandas as pd
+
+def get_changed_rows(previous_df: pd.DataFrame, current_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rows added to or removed from an exclude list since the previous run
+
+    Args:
+        previous_df (pd.DataFrame): Exclude list the previous run used
+        current_df (pd.DataFrame): Exclude list as it is now
+
+    Returns:
+        pd.DataFrame: SYS_Timestamp and Supplier of every row in only one of the two lists
+    """
+    rows = pd.merge(
+        previous_df.drop_duplicates(),
+        current_df.drop_duplicates(),
+        how='outer',
+        on=['SYS_Timestamp', 'Supplier'],
+        indicator=True
+    )
+
+    return rows.loc[rows['_merge'] != 'both', ['SYS_Timestamp', 'Supplier']].reset_index(drop=True)
+
+
+def get_affected_months(
+        prim_pomi_df: pd.DataFrame,
+        prim_pomi_inf_df: pd.DataFrame,
+        gp_dim_df: pd.DataFrame,
+        exclude_changes: pd.DataFrame,
+        inf_exclude_changes: pd.DataFrame
+        ) -> list:
+    """
+    Months whose all_pomi rows change with the exclude lists. drop_exclude_list matches fact rows on Supplier and
+    SYS_Timestamp, and clean_and_join_inf_data matches Informatica rows on SYS_Timestamp alone, so the months are
+    those of the fact rows the changed exclude list rows match. A load can hold one supplier's rows for a practice
+    that another supplier also reports, and tag_duplicates compares the suppliers within a month, so the whole month
+    is rebuilt rather than only the supplier's rows.
+
+    Args:
+        prim_pomi_df (pd.DataFrame): Extracted EMIS, TPP and Vision fact table
+        prim_pomi_inf_df (pd.DataFrame): Extracted Informatica fact table
+        gp_dim_df (pd.DataFrame): Extracted GP_DIM, giving the supplier of each GP_Key
+        exclude_changes (pd.DataFrame): get_changed_rows() of the exclude list
+        inf_exclude_changes (pd.DataFrame): get_changed_rows() of the Informatica exclude list
+
+    Returns:
+        list: Months in the format YYYY-MM, in order
+    """
+    loads = pd.merge(
+        prim_pomi_df[['GP_Key', 'Report_End', 'SYS_Timestamp']].drop_duplicates(),
+        gp_dim_df[['GP_Key', 'Supplier']].drop_duplicates(),
+        how='inner',
+        on=['GP_Key']
+    )
+    affected = pd.merge(loads, exclude_changes, how='inner', on=['Supplier', 'SYS_Timestamp'])['Report_End']
+
+    inf_affected = prim_pomi_inf_df.loc[prim_pomi_inf_df['SYS_Timestamp'].isin(inf_exclude_changes['SYS_Timestamp']), 'Report_End']
+
+    return sorted(set(pd.concat([affected, inf_affected]).dt.strftime('%Y-%m')))
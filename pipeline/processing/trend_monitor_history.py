@@ -0,0 +1,113 @@
+"""
+Persisted history of the month on month Trend Monitor comparisons. Each comparison of a month with the month before
+is saved under {root_directory}\\OUTPUTS\\TREND MONITOR HISTORY\\{comparison}\\YYYY-MM_{key}.parquet, where the key is
+a fingerprint of the rows of the two months the comparison reads and of the code that compares them. A later run
+loads every month pair whose rows haven't changed and only compares the newest month, or months that were revised.
+"""
+import functools
+import inspect
+import os
+import sys
+import pandas as pd
+from pathlib import Path
+from pipeline.utils import params, stage_cache
+
+def is_enabled(config: dict) -> bool:
+    """
+    The history is switched on with "trend_monitor_history" in the config file
+    """
+    return bool(config) and bool(config.get("trend_monitor_history", False))
+
+
+def get_history_location(name: str) -> str:
+
+    return os.path.join(params.params["ROOT_DIR"], "OUTPUTS", "TREND MONITOR HISTORY", name)
+
+
+def get_month_rows(df: pd.DataFrame, date, columns: list) -> pd.DataFrame:
+    """
+    Rows of one month in a canonical order, so the fingerprint doesn't depend on the row labels or on where the
+    month sits in the 12 month window
+    """
+    rows = df.loc[df['Report_End'] == date, columns]
+
+    return rows.sort_values(by=columns, kind='mergesort').reset_index(drop=True)
+
+
+def get_code_names(code) -> set:
+    """
+    Global names read by a code object and the functions and lambdas defined inside it
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= get_code_names(const)
+
+    return names
+
+
+@functools.lru_cache(maxsize=None)
+def get_code_version(function) -> str:
+    """
+    Fingerprint of the source of a comparison function and of what it uses from its module, i.e. the source of the
+    functions it calls, such as selector() for online_enabled(), and the values of constants such as
+    online_enabled_columns. Edits elsewhere in the module don't invalidate the history.
+    """
+    function = inspect.unwrap(function)
+    module = sys.modules[function.__module__]
+    code = [inspect.getsource(function)]
+
+    for name in sorted(get_code_names(function.__code__)):
+        value = getattr(module, name, None)
+        if inspect.isfunction(value) and value.__module__ == module.__name__ and inspect.unwrap(value) is not function:
+            code.append(inspect.getsource(value))
+        elif isinstance(value, (list, tuple, dict, str, int, float)):
+            code.append((name, value))
+
+    return stage_cache.fingerprint(*code)
+
+
+def get_key(function, df: pd.DataFrame, curr_date, prev_date, columns: list) -> str:
+    """
+    Fingerprint of a comparison's inputs, the rows of both months and get_code_version() of function
+    """
+    return stage_cache.fingerprint(
+        function.__name__,
+        get_code_version(function),
+        get_month_rows(df, curr_date, columns),
+        get_month_rows(df, prev_date, columns)
+        )
+
+
+def compare_months(function, df: pd.DataFrame, curr_date, prev_date, columns: list, counts: dict = None) -> tuple:
+    """
+    Run function(df, curr_date, prev_date), or load its result from the history if the same comparison has been
+    made before from the same rows.
+
+    Args:
+        function: Month on month comparison returning a tuple, e.g. create_trend_monitor.online_enabled
+        df (pd.DataFrame): All POMI data
+        curr_date: A month in df
+        prev_date: The month before curr_date
+        columns (list): Columns of df that function reads, besides Report_End
+        counts (dict): Updated with the number of comparisons "loaded" and "computed"
+
+    Returns:
+        tuple: The result of function
+    """
+    key = get_key(function, df, curr_date, prev_date, columns)
+    path = os.path.join(get_history_location(function.__name__), f"{pd.Timestamp(curr_date):%Y-%m}_{key[:16]}.parquet")
+    counts = counts if counts is not None else {}
+
+    if os.path.exists(path):
+        counts["loaded"] = counts.get("loaded", 0) + 1
+        return tuple(pd.read_parquet(path).iloc[0])
+
+    data = function(df, curr_date, prev_date)
+    counts["computed"] = counts.get("computed", 0) + 1
+    try:
+        stage_cache.write_frame(pd.DataFrame([data], columns=[f"value_{i}" for i in range(len(data))]), Path(path))
+    except Exception as e:
+        print(f"Could not save the {function.__name__} history, continuing without it.", e)
+
+    return data
@@ -0,0 +1,80 @@
+"""
+Ad hoc SQL over the base data saved by each run, using an embedded DuckDB database. Every run's files are exposed
+as two views, adjusted (all_pomi_adjusted_df) and recoded (all_pomi_recoded_df), with a run column holding the
+report month e.g. DEC2023.
+
+From the command line, in the repository root:
+
+    python -m main query "SELECT ICB_NAME, SUM(Total_Patients) FROM adjusted WHERE run = 'DEC2023' GROUP BY 1"
+"""
+import argparse
+import glob
+import os
+import pandas as pd
+from pipeline.output import csv_export
+
+base_data_views = ["adjusted", "recoded"]
+
+def connect(base_data_folder: str = None) -> "duckdb.DuckDBPyConnection":
+    """
+    Open an in-memory DuckDB connection with a view over the base data files of every run. The files are read in
+    place when a query runs, nothing is loaded up front.
+
+    Args:
+        base_data_folder (str): Folder holding the run=MMMYYYY folders, defaults to {root_directory}/OUTPUTS/BASE DATA
+    Returns:
+        duckdb.DuckDBPyConnection: Connection with the adjusted and recoded views
+    """
+    base_data_folder = base_data_folder or csv_export.get_export_location("BASE DATA")
+    import duckdb
+
+    connection = duckdb.connect()
+
+    for view in base_data_views:
+        pattern = os.path.join(base_data_folder, "run=*", f"{view}.parquet")
+        if not glob.glob(pattern):
+            continue
+
+        path = pattern.replace("'", "''")
+        connection.execute(
+            f"CREATE VIEW {view} AS SELECT * FROM read_parquet('{path}', hive_partitioning = true, union_by_name = true)"
+        )
+
+    return connection
+
+
+def query_base_data(sql: str, base_data_folder: str = None) -> pd.DataFrame:
+    """
+    Run a query against the adjusted and recoded views of the saved base data
+
+    Args:
+        sql (str): DuckDB SQL query
+        base_data_folder (str): Folder holding the run=MMMYYYY folders, defaults to {root_directory}/OUTPUTS/BASE DATA
+    Returns:
+        pd.DataFrame: Result of the query
+    """
+    connection = connect(base_data_folder)
+    try:
+        return connection.execute(sql).df()
+    finally:
+        connection.close()
+
+
+def print_result(df: pd.DataFrame, output: str = None) -> None:
+    """
+    Print a query result in full, or write it to a csv if output is given
+    """
+    if output:
+        df.to_csv(output, index=False)
+        print(f"{len(df)} rows written to {output}")
+    else:
+        with pd.option_context("display.max_rows", 500, "display.max_columns", None, "display.width", None):
+            print(df.to_string(index=False))
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+
+    parser.add_argument("sql", help="Query to run against the adjusted and recoded views")
+    parser.add_argument("--base-data-folder", default=None, help="Defaults to {root_directory}/OUTPUTS/BASE DATA")
+    parser.add_argument("--output", default=None, help="Write the result to this csv instead of printing it")
+
@@ -0,0 +1,232 @@
+"""
+Evaluate candidate exclude lists against one extraction before agreeing an exclusion with a supplier. Each scenario
+is a folder holding a "Fact Table Exclude List.csv" and/or a "Fact Table Exclude List INF.csv", a list that isn't
+there is left as it was in the last run. The extraction and base data of the last run for the report month are
+taken from the stage cache (or built if they aren't cached), and each scenario only rebuilds the months its changes
+to the exclude lists affect. The result is the change in the national, regional and supplier totals of the headline
+measures for every month that moved.
+
+    python -m main scenario candidates\\drop_tpp_nov candidates\\drop_inf_oct --output scenarios.csv
+"""
+import os
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from pipeline import pipeline_wrapper
+from pipeline.data import input
+from pipeline.processing import aggregate_chunked, exclude_impact, column_plan
+from pipeline.utils import params, stage_cache, rename_columns
+
+headline_measures = ['Total_Patients', 'FIELD_KEY_30', 'online_book_cancel_count', 'FIELD_KEY_51', 'FIELD_KEY_63', 'FIELD_KEY_47']
+
+def get_headline_totals(all_pomi_adjusted_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    National, regional and supplier totals of the headline measures for each month, named as in the PCD output
+
+    Returns:
+        pd.DataFrame: Report_End, Level, Name, Measure and Value
+    """
+    levels = {"National": None, "Region": "REGION_NAME", "Supplier": "Supplier"}
+
+    totals = []
+    for level, column in levels.items():
+        if column is None:
+            df = all_pomi_adjusted_df.groupby(['Report_End'])[headline_measures].sum().reset_index()
+            df['Name'] = 'ENGLAND'
+        else:
+            df = all_pomi_adjusted_df.groupby(['Report_End', column], dropna=False)[headline_measures].sum().reset_index()
+            df['Name'] = df.pop(column).fillna('Unknown')
+        df['Level'] = level
+        totals.append(df.melt(id_vars=['Report_End', 'Level', 'Name'], var_name='Measure', value_name='Value'))
+
+    totals = pd.concat(totals, ignore_index=True)
+    totals['Measure'] = totals['Measure'].replace(rename_columns.rename_pcd_output)
+
+    return totals
+
+
+def compare_totals(baseline_totals: pd.DataFrame, scenario_totals: pd.DataFrame) -> pd.DataFrame:
+    """
+    Totals that differ between the baseline and a scenario, for the months the scenario rebuilt
+
+    Returns:
+        pd.DataFrame: Report_End, Level, Name, Measure, Baseline, Candidate and Change
+    """
+    keys = ['Report_End', 'Level', 'Name', 'Measure']
+    months = scenario_totals['Report_End'].unique()
+
+    df = pd.merge(
+        baseline_totals.loc[baseline_totals['Report_End'].isin(months)].rename(columns={'Value': 'Baseline'}),
+        scenario_totals.rename(columns={'Value': 'Candidate'}),
+        how='outer',
+        on=keys
+    )
+    df[['Baseline', 'Candidate']] = df[['Baseline', 'Candidate']].fillna(0)
+    df['Change'] = df['Candidate'] - df['Baseline']
+
+    return df.loc[df['Change'] != 0].sort_values(keys).reset_index(drop=True)
+
+
+def evaluate_scenario(data: dict, months: list, exclude_list_df: pd.DataFrame, inf_exclude_list_df: pd.DataFrame, rpsd: str, rped: str, config: dict = None, plan: dict = None) -> pd.DataFrame:
+    """
+    Rebuild the months a scenario's exclude lists affect and total the headline measures for them. data holds the
+    extracted tables and mapping_df, and plan is the column plan of the baseline's base data.
+
+    Returns:
+        pd.DataFrame: get_headline_totals() of the rebuilt months, with no rows for months left empty
+    """
+    adjusted = []
+    for month_start, month_end in pipeline_wrapper.get_report_months(rpsd, rped):
+        name, prim_pomi_df, prim_pomi_inf_df = next(pipeline_wrapper.get_fact_months(config, data, month_start, month_end))
+        if name not in months or (prim_pomi_df.empty and prim_pomi_inf_df.empty):
+            continue
+
+        adjusted.append(aggregate_chunked.create_month_base_data(
+            prim_pomi_df,
+            data["gp_dim_df"],
+            exclude_list_df,
+            rpsd,
+            rped,
+            prim_pomi_inf_df,
+            inf_exclude_list_df,
+            data["prim_pomi_field_df"],
+            data["mapping_df"],
+            pipeline_wrapper.get_aggregate_backend(config)[1],
+            plan
+            )[2])
+
+    if not adjusted:
+        return pd.DataFrame(columns=['Report_End', 'Level', 'Name', 'Measure', 'Value'])
+
+    return get_headline_totals(pd.concat(adjusted))
+
+
+def evaluate_shared_scenario(paths: dict, months: list, exclude_list_df: pd.DataFrame, inf_exclude_list_df: pd.DataFrame, rpsd: str, rped: str, config: dict = None, plan: dict = None) -> pd.DataFrame:
+    """
+    evaluate_scenario() in a worker process, on the tables shared by shared_frames.share_frames()
+    """
+    from pipeline.utils import shared_frames
+
+    return evaluate_scenario(shared_frames.load_frames(paths), months, exclude_list_df, inf_exclude_list_df, rpsd, rped, config, plan)
+
+
+def load_baseline(config: dict, rpsd: str, rped: str) -> tuple:
+    """
+    Extraction and all_pomi_adjusted_df of the last run for the report month from the stage cache, extracting and
+    building them in full if they aren't cached or the last run pruned the headline measures' field keys
+
+    Returns:
+        dict: Extracted POMI data and geography mappings
+        pd.DataFrame: all_pomi_adjusted_df
+        dict: Column plan all_pomi_adjusted_df was built with, None for every column
+    """
+    manifest = stage_cache.load_manifest(config, params.get_export_dates(), resume=True)
+    headline_plan = column_plan.build_plan(['Report_End', 'REGION_NAME', 'Supplier'] + headline_measures)
+    config = dict(config, aggregate_by_month=False, prune_columns=False)
+
+    data = stage_cache.load_frames(config, manifest, "extract")
+    all_pomi_adjusted_df = None
+    plan = None
+    if data is None or "prim_pomi_df" not in data:
+        data = None
+    elif all(column_plan.covers(column_plan.get_cached_plan(manifest, stage), headline_plan) for stage in ["extract", "base_data"]):
+        all_pomi_adjusted_df = stage_cache.load_stage(config, manifest, "create_base_data")
+        plan = column_plan.get_cached_plan(manifest, "base_data")
+        ## A pruned extraction can only be used with the base data built from it
+        if all_pomi_adjusted_df is None and column_plan.get_cached_plan(manifest, "extract") is not None:
+            data = None
+    else:
+        data = None
+
+    if data is None:
+        data = pipeline_wrapper.extract_pomi_data(config, rpsd, rped)
+        data.update(pipeline_wrapper.extract_geography_mappings(config, rpsd, rped))
+    else:
+        print("Using the cached extraction")
+
+    if all_pomi_adjusted_df is None:
+        all_pomi_adjusted_df = pipeline_wrapper.build_base_data(data, rpsd, rped, dict(config, use_stage_cache=False))[1]
+        plan = None
+
+    return data, all_pomi_adjusted_df, plan
+
+
+def run_scenarios(config: dict, scenarios: dict) -> pd.DataFrame:
+    """
+    Evaluate candidate exclude lists against the last run for the report month in the config. Scenarios run in a
+    pool of "aggregate_workers" processes, which memory map one shared copy of the extraction.
+
+    Args:
+        config (dict): Loaded config file
+        scenarios (dict): (exclude_list_df, inf_exclude_list_df) keyed by scenario name, None for a list to keep as
+            it was in the last run
+
+    Returns:
+        pd.DataFrame: compare_totals() of each scenario, with a Scenario column
+    """
+    params.configure(config)
+    rpsd = params.get_report_period_start_date()
+    rped = params.get_report_period_end_date()
+
+    data, all_pomi_adjusted_df, plan = load_baseline(config, rpsd, rped)
+    baseline_totals = get_headline_totals(all_pomi_adjusted_df)
+
+    tables = {name: data[name] for name in ["prim_pomi_df", "prim_pomi_inf_df", "gp_dim_df", "prim_pomi_field_df"]}
+    tables["mapping_df"] = pipeline_wrapper.get_mapping_df(data)
+
+    candidates = {}
+    for name, (exclude_list_df, inf_exclude_list_df) in scenarios.items():
+        exclude_list_df = data["exclude_list_df"] if exclude_list_df is None else exclude_list_df
+        inf_exclude_list_df = data["inf_exclude_list_df"] if inf_exclude_list_df is None else inf_exclude_list_df
+        months = exclude_impact.get_affected_months(
+            data["prim_pomi_df"],
+            data["prim_pomi_inf_df"],
+            data["gp_dim_df"],
+            exclude_impact.get_changed_rows(data["exclude_list_df"], exclude_list_df),
+            exclude_impact.get_changed_rows(data["inf_exclude_list_df"], inf_exclude_list_df)
+            )
+        print(f"Scenario {name} affects {len(months)} months{': ' + ', '.join(months) if months else ''}")
+        if months:
+            candidates[name] = (months, exclude_list_df, inf_exclude_list_df)
+
+    workers = min(pipeline_wrapper.get_aggregate_workers(config), len(candidates)) if candidates else 1
+    if workers == 1:
+        results = {
+            name: evaluate_scenario(tables, *candidate, rpsd, rped, config, plan)
+            for name, candidate in candidates.items()
+        }
+    else:
+        from pipeline.utils import shared_frames
+
+        print(f"Evaluating {len(candidates)} scenarios on {workers} processes")
+        with shared_frames.shared_folder() as folder:
+            paths = shared_frames.share_frames(tables, folder)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    name: executor.submit(evaluate_shared_scenario, paths, *candidate, rpsd, rped, config, plan)
+                    for name, candidate in candidates.items()
+                }
+                results = {name: future.result() for name, future in futures.items()}
+
+    diffs = [compare_totals(baseline_totals, totals).assign(Scenario=name) for name, totals in results.items()]
+    if not diffs:
+        return pd.DataFrame(columns=['Scenario', 'Report_End', 'Level', 'Name', 'Measure', 'Baseline', 'Candidate', 'Change'])
+
+    diff = pd.concat(diffs, ignore_index=True)
+
+    return diff[['Scenario'] + [col for col in diff.columns if col != 'Scenario']]
+
+
+def read_scenarios(folders: list) -> dict:
+    """
+    Read the candidate exclude lists in each scenario folder, named after the folder
+
+    Returns:
+        dict: (exclude_list_df, inf_exclude_list_df) keyed by scenario name, None where the folder has no list
+    """
+    scenarios = {}
+    for folder in folders:
+        exclude_list_df = input.get_exclude_list(folder) if os.path.exists(os.path.join(folder, "Fact Table Exclude List.csv")) else None
+        inf_exclude_list_df = input.get_inf_exclude_list(folder) if os.path.exists(os.path.join(folder, "Fact Table Exclude List INF.csv")) else None
+        scenarios[os.path.basename(os.path.normpath(folder))] = (exclude_list_df, inf_exclude_list_df)
+
+    return scenarios
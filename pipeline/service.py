@@ -0,0 +1,206 @@
+"""
+Long running local POMI service. The extracted data for the report month, i.e. the fact tables, FIELD_DIM, GP_DIM
+and the geography mappings, and the base data built from it are kept in memory between requests, so regenerating
+one output, e.g. re-issuing Choices after an exclude list tweak, doesn't start a new process, reconnect or extract
+again. The exclude lists are read from INPUTS on every request, and the base data is only rebuilt when they have
+changed. The service only listens on localhost by default.
+
+    python -m main serve --port 8765
+    curl -X POST localhost:8765/run -d '{"outputs": "choices"}'
+
+Endpoints:
+    GET /status: The report month and DataFrames held in memory
+    POST /run: Regenerate outputs. The JSON body may give "outputs" (as for --outputs, all by default),
+        "report_run_date" (the config's by default) and "refresh": true to extract again
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pipeline import pipeline_wrapper
+from pipeline.data import input
+from pipeline.output import csv_export, parquet_export, partition_export
+from pipeline.processing import trend_monitor_history
+from pipeline.utils import params, stage_cache, run_report, memory, output_selection
+
+state = {
+    "config": {},
+    "report_run_date": None,
+    "data": None,
+    "base_data_key": None,
+    "base_data": None,
+}
+lock = threading.Lock()
+
+def get_extraction(config: dict, rpsd: str, rped: str, refresh: bool = False) -> tuple:
+    """
+    Extracted data for the report period, kept from the last request for the same report month unless refresh is
+    set. The exclude lists are always read again from INPUTS.
+
+    Returns:
+        dict: Extracted POMI data and geography mappings
+        bool: Whether the data was extracted for this request
+    """
+    if refresh or state["data"] is None or state["report_run_date"] != config["report_run_date"]:
+        state["data"] = state["base_data"] = state["base_data_key"] = None
+        data = pipeline_wrapper.extract_pomi_data(config, rpsd, rped)
+        data.update(pipeline_wrapper.extract_geography_mappings(config, rpsd, rped))
+        state["data"] = data
+        state["report_run_date"] = config["report_run_date"]
+        return data, True
+
+    print("Using the extracted data held by the service")
+    state["data"]["exclude_list_df"] = input.get_exclude_list()
+    state["data"]["inf_exclude_list_df"] = input.get_inf_exclude_list()
+
+    return state["data"], False
+
+
+def get_base_data(data: dict, rpsd: str, rped: str, config: dict) -> tuple:
+    """
+    all_pomi_recoded_df and all_pomi_adjusted_df for data, rebuilt only if the exclude lists have changed since
+    they were last built
+
+    Returns:
+        tuple: The base data
+        bool: Whether it was rebuilt for this request
+    """
+    key = stage_cache.fingerprint(config["report_run_date"], data["exclude_list_df"], data["inf_exclude_list_df"])
+    if state["base_data"] is not None and state["base_data_key"] == key:
+        print("Using the base data held by the service")
+        return state["base_data"], False
+
+    state["base_data"] = None
+    state["base_data"] = pipeline_wrapper.build_base_data(data, rpsd, rped, config)
+    state["base_data_key"] = key
+
+    return state["base_data"], True
+
+
+def regenerate(outputs=None, report_run_date: str = None, refresh: bool = False) -> dict:
+    """
+    Write the selected outputs from the data and base data held in memory, extracting and building them first if
+    needed. Requests are handled one at a time. Low memory mode doesn't apply, the point of the service is to hold
+    the base data.
+
+    Args:
+        outputs: Outputs to write, a list or comma separated string as for "outputs" in the config, all by default
+        report_run_date (str): Report run date in the format YYYY-MM-DD, the config's by default
+        refresh (bool): Extract the data again even if it's held for the report month
+
+    Returns:
+        dict: Report month, outputs written, whether the data was extracted and the base data rebuilt, and seconds
+    """
+    with lock:
+        start = time.perf_counter()
+        config = dict(state["config"])
+        if outputs:
+            config["outputs"] = outputs
+        if report_run_date:
+            config["report_run_date"] = report_run_date
+        params.configure(config)
+
+        rpsd = params.get_report_period_start_date()
+        rped = params.get_report_period_end_date()
+        selected = output_selection.get_outputs(config)
+
+        run_report.start_run_report(params.get_export_dates(), config)
+        try:
+            data, extracted = get_extraction(config, rpsd, rped, refresh)
+            (all_pomi_recoded_df, all_pomi_adjusted_df), rebuilt = get_base_data(data, rpsd, rped, config)
+
+            pipeline_wrapper.write_outputs(
+                all_pomi_recoded_df,
+                all_pomi_adjusted_df,
+                max_workers=config.get("max_workers", 4),
+                create_xlsb=config.get("create_xlsb", True),
+                write_base_data=config.get("write_base_data", True),
+                memory_budget=memory.get_memory_budget(config),
+                outputs=selected,
+                parquet_outputs=parquet_export.get_parquet_outputs(config),
+                partitioned_outputs=partition_export.get_partitioned_outputs(config),
+                trend_monitor_history=trend_monitor_history.is_enabled(config),
+                pbi_layout=csv_export.get_pbi_layout(config)
+                )
+        finally:
+            run_report.write_run_report(csv_export.get_export_location("RUN REPORT"))
+
+        return {
+            "report_month": params.get_export_dates(),
+            "outputs": selected,
+            "extracted": extracted,
+            "base_data_rebuilt": rebuilt,
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+
+
+def get_status() -> dict:
+
+    frames = dict(state["data"] or {})
+    if state["base_data"] is not None:
+        frames["all_pomi_recoded_df"], frames["all_pomi_adjusted_df"] = state["base_data"]
+
+    return {
+        "report_run_date": state["report_run_date"],
+        "frames": {name: list(df.shape) for name, df in frames.items()},
+    }
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status: int, body: dict) -> None:
+
+        response = json.dumps(body, indent=4).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_GET(self) -> None:
+
+        if self.path == "/status":
+            self.send_json(200, get_status())
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self) -> None:
+
+        if self.path != "/run":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            output_selection.get_outputs({"outputs": body.get("outputs")})
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        try:
+            self.send_json(200, regenerate(body.get("outputs"), body.get("report_run_date"), bool(body.get("refresh", False))))
+        except Exception as e:
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+
+def create_server(config: dict, host: str = "127.0.0.1", port: int = 8765) -> HTTPServer:
+    """
+    Create the service for a loaded config file, without starting it. Port 0 picks a free port. "prune_columns" is
+    turned off, the data held is used for whichever outputs are requested.
+    """
+    state.update({"config": dict(config, prune_columns=False), "report_run_date": None, "data": None, "base_data_key": None, "base_data": None})
+
+    return HTTPServer((host, port), ServiceHandler)
+
+
+def serve(config: dict, host: str = "127.0.0.1", port: int = 8765) -> None:
+
+    server = create_server(config, host, port)
+    print(f"POMI service listening on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
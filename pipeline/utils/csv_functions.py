@@ -4,12 +4,12 @@ from pipeline.utils import params
 
 def filter_for_report_end(df: pd.DataFrame, col: str) -> pd.DataFrame:
 
-    return df.loc[df[col] == params.get_report_period_end_date()]
+    return df.loc[df[col] == pd.Timestamp(params.get_report_period_end_date())]
 
 
 def filter_for_financial_year(df: pd.DataFrame, col: str) -> pd.DataFrame:
 
-    return df.loc[df[col] >= params.get_financial_year_start()]
+    return df.loc[df[col] >= pd.Timestamp(params.get_financial_year_start())]
 
 
 def change_values_to_integer(df: pd.DataFrame, cols: list) -> pd.DataFrame:
@@ -21,11 +21,32 @@ def change_values_to_integer(df: pd.DataFrame, cols: list) -> pd.DataFrame:
     return df
 
 
-def convert_column_datetype(df: pd.DataFrame, col: str, datetype: str, upper = False) -> pd.DataFrame:
+def format_dates(dates: pd.Series, datetype: str, upper = False) -> pd.Series:
+    """
+    Format dates as strings once per distinct date and look the result up for every row. Outputs only hold a few
+    distinct months, so this is much cheaper than formatting each row.
+    """
+    distinct = dates.drop_duplicates()
+    labels = pd.to_datetime(distinct).dt.strftime(datetype)
     if upper == True:
-        df[col] = pd.to_datetime(df[col]).dt.strftime(datetype).str.upper()
-    else:
-        df[col] = pd.to_datetime(df[col]).dt.strftime(datetype)
+        labels = labels.str.upper()
+
+    return dates.map(pd.Series(labels.values, index=distinct.values))
+
+
+def format_date_columns(df: pd.DataFrame, datetype: str = '%Y-%m-%d') -> pd.DataFrame:
+    """
+    Copy of df with every datetime column formatted as strings, for writing to outputs that don't take dates
+    """
+    date_columns = df.select_dtypes(include='datetime').columns
+    if len(date_columns) == 0:
+        return df
+
+    return df.assign(**{col: format_dates(df[col], datetype) for col in date_columns})
+
+
+def convert_column_datetype(df: pd.DataFrame, col: str, datetype: str, upper = False) -> pd.DataFrame:
+    df[col] = format_dates(df[col], datetype, upper)
     return df
 
 
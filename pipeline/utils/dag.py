@@ -0,0 +1,164 @@
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+Stage = namedtuple("Stage", ["name", "function", "inputs"])
+Stage.__doc__ = """
+A pipeline step. function is called with the outputs of the named inputs, in order, and its return value is stored
+under name for later stages to use.
+"""
+
+def validate_stages(stages: list, available: set) -> None:
+    """
+    Check every stage input is either already available or produced by another stage, and stage names are unique
+    """
+    names = [stage.name for stage in stages]
+    duplicated = {name for name in names if names.count(name) > 1}
+    if duplicated:
+        raise ValueError(f"Stages declared more than once: {sorted(duplicated)}")
+
+    for stage in stages:
+        missing = [i for i in stage.inputs if i not in available and i not in names]
+        if missing:
+            raise ValueError(f"Stage {stage.name} has unknown inputs: {missing}")
+
+
+def select_stages(stages: list, available: set) -> list:
+    """
+    Stages that can run from the available inputs alone, directly or through other selected stages
+    """
+    available = set(available)
+    selected = []
+    remaining = list(stages)
+
+    while True:
+        ready = [stage for stage in remaining if all(i in available for i in stage.inputs)]
+        if not ready:
+            return selected
+        for stage in ready:
+            remaining.remove(stage)
+            selected.append(stage)
+            available.add(stage.name)
+
+
+def get_critical_path(stages: list, durations: dict) -> list:
+    """
+    Find the chain of dependent stages with the longest total duration, which bounds the run time however many
+    workers are used
+
+    Args:
+        stages (list): Stage definitions
+        durations (dict): Seconds taken by each completed stage
+
+    Returns:
+        list: Stage names on the critical path, in run order
+    """
+    by_name = {stage.name: stage for stage in stages}
+    path_lengths = {}
+    previous = {}
+
+    def path_length(name):
+        if name not in path_lengths:
+            upstream = [i for i in by_name[name].inputs if i in durations]
+            longest = max(upstream, key=path_length, default=None)
+            previous[name] = longest
+            path_lengths[name] = durations[name] + (path_length(longest) if longest else 0)
+        return path_lengths[name]
+
+    completed = [name for name in durations if name in by_name]
+    if not completed:
+        return []
+
+    name = max(completed, key=path_length)
+    path = []
+    while name:
+        path.append(name)
+        name = previous[name]
+
+    return path[::-1]
+
+
+def run_stages(stages: list, initial: dict, max_workers: int = 4, release_inputs: bool = False):
+    """
+    Run stages on a thread pool as soon as their inputs are ready, so independent branches run at the same time.
+    A failed stage only stops the stages that depend on it.
+
+    Args:
+        stages (list): Stage definitions
+        initial (dict): Inputs that already exist before any stage runs
+        max_workers (int): Number of stages to run at once
+        release_inputs (bool): Drop each input and stage output as soon as the last stage using it has finished, so
+            it can be freed if the caller holds no other reference. Released outputs are left out of the results.
+
+    Returns:
+        dict: Outputs of initial and every completed stage
+        dict: Status, duration and error of every stage
+    """
+    validate_stages(stages, set(initial))
+
+    results = dict(initial)
+    report = {stage.name: {"status": "pending"} for stage in stages}
+    pending = {stage.name: stage for stage in stages}
+    running = {}
+
+    def skip_dependents(failed):
+        for stage in list(pending.values()):
+            if failed in stage.inputs:
+                del pending[stage.name]
+                report[stage.name] = {"status": "skipped", "error": f"Upstream stage {failed} did not complete"}
+                skip_dependents(stage.name)
+
+    def release(stage):
+        waiting = list(pending.values()) + list(running.values())
+        for name in stage.inputs:
+            if not any(name in s.inputs for s in waiting):
+                results.pop(name, None)
+
+    def timed(stage, *args):
+        start = time.perf_counter()
+        output = stage.function(*args)
+        return output, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while pending or running:
+            for stage in [s for s in pending.values() if all(i in results for i in s.inputs)]:
+                del pending[stage.name]
+                report[stage.name]["status"] = "running"
+                future = executor.submit(timed, stage, *[results[i] for i in stage.inputs])
+                running[future] = stage
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name], duration = future.result()
+                    report[stage.name] = {"status": "completed", "seconds": round(duration, 3)}
+                except Exception as e:
+                    report[stage.name] = {"status": "failed", "error": "".join(traceback.format_exception_only(type(e), e)).strip()}
+                    print(f"Stage {stage.name} failed:")
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                    skip_dependents(stage.name)
+
+                if release_inputs:
+                    release(stage)
+
+    return results, report
+
+
+def print_stage_report(stages: list, report: dict) -> None:
+    """
+    Print each stage's status and the critical path of the run
+    """
+    durations = {name: r["seconds"] for name, r in report.items() if r["status"] == "completed"}
+
+    for name, r in report.items():
+        detail = f"{r['seconds']}s" if "seconds" in r else r.get("error", "")
+        print(f"  {name}: {r['status']} {detail}")
+
+    critical_path = get_critical_path(stages, durations)
+    total = round(sum(durations[name] for name in critical_path), 3)
+    print(f"Critical path ({total}s): {' -> '.join(critical_path)}")
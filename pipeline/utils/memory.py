@@ -0,0 +1,70 @@
+import functools
+import gc
+from pipeline.utils import run_report
+
+def is_low_memory(config: dict = None) -> bool:
+
+    return bool((config or {}).get("low_memory", False))
+
+
+def get_memory_budget(config: dict = None) -> int:
+    """
+    Memory budget in bytes from "memory_budget_mb" in the config, or None if there isn't one
+    """
+    budget = (config or {}).get("memory_budget_mb")
+    if not budget:
+        return None
+
+    return int(float(budget) * 2**20)
+
+
+def get_sql_chunksize(config: dict = None) -> int:
+    """
+    Rows fetched at a time when extracting, from "sql_chunksize" in the config. Low memory runs default to 500,000
+    rows and other runs fetch everything at once unless it's set.
+    """
+    chunksize = (config or {}).get("sql_chunksize")
+    if chunksize:
+        return int(chunksize)
+
+    return 500000 if is_low_memory(config) else None
+
+
+def check_memory_budget(stage_name: str, budget: int) -> None:
+    """
+    Stop the run with a MemoryError if the process RSS is over the budget after a stage. Does nothing without a
+    budget or without psutil.
+    """
+    if budget is None:
+        return
+
+    rss = run_report.get_rss()
+    if rss is not None and rss > budget:
+        raise MemoryError(
+            f"RSS of {rss / 2**20:.0f} MB after {stage_name} is over the memory budget of {budget / 2**20:.0f} MB"
+        )
+
+
+def within_budget(name: str, function, budget: int):
+    """
+    Wrap a stage function so the memory budget is checked each time it finishes
+    """
+    if budget is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        output = function(*args, **kwargs)
+        check_memory_budget(name, budget)
+        return output
+
+    return wrapper
+
+
+def release(data: dict, names: list) -> None:
+    """
+    Remove DataFrames from a dict once nothing else needs them and return the memory straight away
+    """
+    for name in names:
+        data.pop(name, None)
+    gc.collect()
@@ -0,0 +1,20 @@
+output_names = ["pcd", "choices", "benefits", "pbi", "trend_monitor", "base_data"]
+
+def get_outputs(config: dict = None) -> list:
+    """
+    Outputs to build, from "outputs" in the config as a list or a comma separated string. Empty means all of them.
+    base_data is left out when "write_base_data" is false, as it isn't written then.
+    """
+    config = config or {}
+    outputs = config.get("outputs") or output_names
+    if isinstance(outputs, str):
+        outputs = [output.strip() for output in outputs.split(",") if output.strip()]
+
+    unknown = [output for output in outputs if output not in output_names]
+    if unknown:
+        raise ValueError(f"Unknown outputs {', '.join(unknown)}, expected some of {', '.join(output_names)}")
+
+    if not config.get("write_base_data", True):
+        outputs = [output for output in outputs if output != "base_data"]
+
+    return [output for output in output_names if output in outputs]
@@ -8,21 +8,33 @@ def load_json_config_file(path):
     with open(path) as f:
         file = json.load(f)
     return file
-config = load_json_config_file(".\\config.json")
-
-if config["root_directory"] == "":
-    current_dir = os.getcwd()
-    config["root_directory"] = os.path.dirname(current_dir)
-
-report_month = datetime.datetime.strptime(config["report_run_date"], "%Y-%m-%d")
-report_month = report_month.date()
 
+## Set from the config file by configure(), nothing is read when this module is imported
 params = {
-    "report_month": report_month,
-    "ROOT_DIR": config["root_directory"],
+    "report_month": None,
+    "ROOT_DIR": None,
     "DATA_FOLDER" : "INPUTS",
 }
 
+def configure(config: dict) -> None:
+    """
+    Set the root directory and report month from a loaded config file. An empty root_directory means the folder
+    above the current directory. Entry points call this once with the config they were given.
+    """
+    root = config.get("root_directory", "")
+    if root == "":
+        root = os.path.dirname(os.getcwd())
+    params["ROOT_DIR"] = root
+
+    if config.get("report_run_date"):
+        set_report_month(config["report_run_date"])
+
+def set_report_month(report_run_date: str) -> None:
+    """
+    Change the report month used by the get_ functions below, e.g. when backfilling several months in one session
+    """
+    params["report_month"] = datetime.datetime.strptime(report_run_date, "%Y-%m-%d").date()
+
 def get_root() -> str:
     
     return str(params["ROOT_DIR"])
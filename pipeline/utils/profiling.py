@@ -0,0 +1,107 @@
+import cProfile
+import functools
+import os
+import sys
+import threading
+from collections import Counter
+
+_enabled_stages = set()
+_output_folder = None
+_call_counts = Counter()
+_lock = threading.Lock()
+_active = threading.local()
+
+def configure(config: dict, output_folder: str) -> None:
+    """
+    Choose which stages to profile. The POMI_PROFILE environment variable takes priority over "profile_stages" in
+    the config file. Both take a comma separated list of stage names, or "all".
+
+    Args:
+        config (dict): Config file
+        output_folder (str): Folder the profile files are written to
+    """
+    global _enabled_stages, _output_folder
+
+    stages = os.environ.get("POMI_PROFILE", config.get("profile_stages", ""))
+    if isinstance(stages, str):
+        stages = stages.split(",")
+
+    _enabled_stages = {stage.strip() for stage in stages if stage.strip()}
+    _output_folder = output_folder
+    _call_counts.clear()
+
+
+def is_profiled(name: str) -> bool:
+
+    return name in _enabled_stages or "all" in _enabled_stages
+
+
+def sample_stacks(thread_id: int, stop: threading.Event, stacks: Counter, interval: float = 0.005) -> None:
+    """
+    Sample the call stack of a thread until stop is set, counting each stack in collapsed form
+    """
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}")
+            frame = frame.f_back
+        if stack:
+            stacks[";".join(reversed(stack))] += 1
+
+
+def write_profiles(name: str, profiler: cProfile.Profile, stacks: Counter) -> None:
+    """
+    Write the deterministic profile as a .prof file (for pstats or snakeviz) and the sampled stacks as a .collapsed
+    file (for flamegraph.pl or speedscope)
+    """
+    with _lock:
+        _call_counts[name] += 1
+        call = _call_counts[name]
+
+    os.makedirs(_output_folder, exist_ok=True)
+    output_path = os.path.join(_output_folder, f"{name}_{call}")
+
+    profiler.dump_stats(f"{output_path}.prof")
+    with open(f"{output_path}.collapsed", "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def profile_stage(name: str = None, function=None):
+    """
+    Decorate a function so calls are profiled when its stage is selected. When it isn't selected the only cost is a
+    set lookup. Stages called from inside a profiled stage are covered by the outer profile.
+    Can be used as @profile_stage() or wrapped = profile_stage("name", function).
+    """
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not is_profiled(stage_name) or getattr(_active, "profiling", False):
+                return function(*args, **kwargs)
+
+            stacks = Counter()
+            stop = threading.Event()
+            sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), stop, stacks), daemon=True)
+            profiler = cProfile.Profile()
+
+            _active.profiling = True
+            sampler.start()
+            profiler.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.disable()
+                stop.set()
+                sampler.join()
+                _active.profiling = False
+                write_profiles(stage_name, profiler, stacks)
+
+        return wrapper
+
+    if function is not None:
+        return decorator(function)
+    return decorator
@@ -14,20 +14,21 @@ def replace_column_values_when_less_than(df: pd.DataFrame, change_col: str, by_c
     Returns:
         pd.DataFrame: The same Dataframe with the amended column values
     """
-    ## Change null values to -1 to satisfy the greater than statement
-    df = df.fillna({change_col:-1,
-                    by_col:-1})
+    ## Change null values to -1 to satisfy the greater than statement. Only the two columns are filled, filling the
+    ## whole DataFrame would copy every column.
+    change_values = df[change_col].fillna(-1)
+    by_values = df[by_col].fillna(-1)
     
     ## If by_col is greater than change_col, make change_col equal to by_col, otherwise do nothing
     df[change_col] = np.where(
-        df[change_col] < df[by_col],
-        df[by_col],
-        df[change_col]
+        change_values < by_values,
+        by_values,
+        change_values
         )
     
     ## Replace -1 back to null to remove any DQ issues
     df[change_col] = df[change_col].replace(-1,np.nan)
-    df[by_col] = df[by_col].replace(-1,np.nan)
+    df[by_col] = by_values.replace(-1,np.nan)
     
     return df
 
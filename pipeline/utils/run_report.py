@@ -0,0 +1,248 @@
+import pandas as pd
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_report = None
+_lock = threading.Lock()
+_open_stages = []
+_sampler = None
+
+def start_run_report(run_name: str, config: dict = None) -> None:
+    """
+    Start recording stages for a run. Until this is called instrumented functions run without any measurement.
+
+    Args:
+        run_name (str): Name of the run, normally the report month e.g. DEC2023
+        config (dict): Config file, "run_report_tracemalloc" also records python allocation peaks, which is slower
+    """
+    global _report, _sampler
+    config = config or {}
+
+    stop_sampler()
+    _open_stages.clear()
+    _report = {
+        "run": run_name,
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "tracemalloc": bool(config.get("run_report_tracemalloc", False)),
+        "stages": []
+    }
+
+    if _report["tracemalloc"] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    if get_rss() is not None:
+        stop = threading.Event()
+        _sampler = (stop, threading.Thread(target=sample_peak_rss, args=(stop,), daemon=True))
+        _sampler[1].start()
+
+
+def is_active() -> bool:
+
+    return _report is not None
+
+
+def get_rss() -> int:
+    """
+    Resident set size of the process in bytes, or None if psutil isn't installed
+    """
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    return psutil.Process().memory_info().rss
+
+
+def get_cpu_time() -> float:
+    """
+    CPU seconds used by every thread of the process and by child processes that have finished, e.g. the workers of a
+    process pool once it has shut down. Child processes aren't counted on Windows, where resource isn't available.
+    """
+    cpu = time.process_time()
+
+    try:
+        import resource
+    except ImportError:
+        return cpu
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return cpu + children.ru_utime + children.ru_stime
+
+
+def sample_peak_rss(stop: threading.Event, interval: float = 0.05) -> None:
+    """
+    Poll the process RSS until stop is set, keeping the largest value seen by each open stage in its "rss_peak".
+    One sampler runs for the whole run rather than one per stage.
+    """
+    while not stop.wait(interval):
+        rss = get_rss()
+        with _lock:
+            for running in _open_stages:
+                running["rss_peak"] = max(running["rss_peak"], rss)
+
+
+def stop_sampler() -> None:
+
+    global _sampler
+    if _sampler is not None:
+        _sampler[0].set()
+        _sampler[1].join()
+        _sampler = None
+
+
+def describe_frames(output) -> list:
+    """
+    Rows, columns and bytes of each DataFrame in a stage output
+    """
+    if isinstance(output, pd.DataFrame):
+        frames = {"output": output}
+    elif isinstance(output, dict):
+        frames = output
+    elif isinstance(output, (tuple, list)):
+        frames = {f"output_{i}": item for i, item in enumerate(output)}
+    else:
+        return []
+
+    return [
+        {
+            "name": name,
+            "rows": int(df.shape[0]),
+            "columns": int(df.shape[1]),
+            "bytes": int(df.memory_usage(deep=True).sum())
+        }
+        for name, df in frames.items() if isinstance(df, pd.DataFrame)
+    ]
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Record wall time, CPU time and peak memory for the block. The yielded dict can be given an "output" to record
+    the shape and size of the DataFrames the block produced.
+
+    CPU time and peak memory are measured for the whole process, so a stage that ran at the same time as a stage in
+    another thread, e.g. outputs built with max_workers above 1, is marked "concurrent" and its CPU time and peak RSS
+    are shared with those stages. Its tracemalloc peak isn't recorded, as each stage resets the one peak. A stage
+    nested in another, e.g. create_all_pomi_by_month's months, hands the peak so far to the stages enclosing it
+    before resetting it, so theirs still cover the whole block.
+    """
+    record = {"stage": name}
+    if not is_active():
+        yield record
+        return
+
+    rss_start = get_rss()
+    running = {"thread": threading.get_ident(), "concurrent": False, "rss_peak": rss_start or 0, "tracemalloc_peak": 0}
+    with _lock:
+        for other in _open_stages:
+            if other["thread"] != running["thread"]:
+                other["concurrent"] = running["concurrent"] = True
+        if _report["tracemalloc"]:
+            for other in _open_stages:
+                other["tracemalloc_peak"] = max(other["tracemalloc_peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        _open_stages.append(running)
+
+    wall_start = time.perf_counter()
+    cpu_start = get_cpu_time()
+    status = "failed"
+    try:
+        yield record
+        status = "completed"
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = get_cpu_time() - cpu_start
+
+        with _lock:
+            _open_stages[:] = [other for other in _open_stages if other is not running]
+        if _report["tracemalloc"] and not running["concurrent"]:
+            tracemalloc_peak = max(running["tracemalloc_peak"], tracemalloc.get_traced_memory()[1])
+        else:
+            tracemalloc_peak = None
+
+        rss_end = get_rss()
+        entry = {
+            "stage": name,
+            "status": status,
+            "thread": threading.current_thread().name,
+            "concurrent": running["concurrent"],
+            "wall_seconds": round(wall, 3),
+            "cpu_seconds": round(cpu, 3),
+            "rss_start_bytes": rss_start,
+            "rss_end_bytes": rss_end,
+            "rss_peak_bytes": max(running["rss_peak"], rss_end or 0) if rss_start is not None else None,
+            "tracemalloc_peak_bytes": tracemalloc_peak,
+            "frames": describe_frames(record.get("output"))
+        }
+        with _lock:
+            _report["stages"].append(entry)
+
+
+def instrument(name: str = None, function=None):
+    """
+    Decorate a function so each call is recorded as a stage in the run report, with the DataFrames it returns.
+    Can be used as @instrument() or wrapped = instrument("name", function).
+    """
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not is_active():
+                return function(*args, **kwargs)
+
+            with stage(stage_name) as record:
+                record["output"] = function(*args, **kwargs)
+            return record["output"]
+
+        return wrapper
+
+    if function is not None:
+        return decorator(function)
+    return decorator
+
+
+def get_peak_rss() -> int:
+    """
+    Largest RSS recorded by any stage of the current run so far, or None if nothing has been recorded
+    """
+    if not is_active():
+        return None
+
+    with _lock:
+        peaks = [s["rss_peak_bytes"] for s in _report["stages"] if s["rss_peak_bytes"] is not None]
+
+    return max(peaks, default=None)
+
+
+def write_run_report(output_folder: str) -> str:
+    """
+    Write the run report as JSON to the output folder and stop recording
+
+    Returns:
+        str: Path of the run report
+    """
+    global _report
+    if not is_active():
+        return None
+
+    stop_sampler()
+    _report["finished"] = datetime.datetime.now().isoformat(timespec="seconds")
+    _report["peak_rss_bytes"] = get_peak_rss()
+
+    os.makedirs(output_folder, exist_ok=True)
+    output_path = os.path.join(output_folder, f"run_report_{_report['run']}.json")
+    with open(output_path, "w") as f:
+        json.dump(_report, f, indent=4)
+
+    if _report["tracemalloc"]:
+        tracemalloc.stop()
+    _report = None
+
+    return output_path
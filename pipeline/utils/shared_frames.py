@@ -0,0 +1,106 @@
+"""
+Hand DataFrames to worker processes as Arrow IPC files instead of pickling them. The parent writes each frame once
+to a folder in shared memory (/dev/shm where it exists, the temp folder otherwise) and passes the file path, and each
+worker memory maps the file. Numeric and date columns are used straight from the mapped pages without a copy, so
+they're read only in the worker.
+"""
+import contextlib
+import gc
+import os
+import shutil
+import tempfile
+import uuid
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+def get_shared_memory_dir() -> str:
+
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+@contextlib.contextmanager
+def shared_folder():
+    """
+    Folder for the shared frames of one pool, removed with everything in it when the block exits. Files still
+    memory mapped can't be deleted on Windows, so frames the parent keeps after the block should be loaded with
+    memory_map=False, and any file that can't be deleted is reported rather than silently left behind.
+    """
+    folder = tempfile.mkdtemp(prefix="pomi_frames_", dir=get_shared_memory_dir())
+    try:
+        yield folder
+    finally:
+        ## Frames dropped by the block may only be freed by the cycle collector, which releases their maps
+        gc.collect()
+        failed = []
+        shutil.rmtree(folder, onerror=lambda function, path, exc_info: failed.append((path, exc_info[1])))
+        for path, error in failed:
+            print(f"Could not remove shared frame {path}, it may still be open.", error)
+
+
+def remove_frames(paths: dict) -> None:
+    """
+    Delete the files of frames shared with share_frames() once no worker needs them, before the folder is removed.
+    A file that's still mapped can't be deleted on Windows, it's then left for shared_folder() to remove.
+    """
+    for path in paths.values():
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Could not remove shared frame {path} yet, it will be removed with its folder.", e)
+
+
+def share_frame(df: pd.DataFrame, folder: str) -> str:
+    """
+    Write a DataFrame, with its index, to an Arrow IPC file in folder
+
+    Returns:
+        str: Path to pass to load_frame() in the worker
+    """
+    table = pa.Table.from_pandas(df, preserve_index=True)
+
+    # Arrow stores NaN as null, keep floats as NaN so the worker can map them without filling a copy
+    for i, field in enumerate(table.schema):
+        if pa.types.is_floating(field.type) and table.column(i).null_count:
+            table = table.set_column(i, field, table.column(i).fill_null(np.nan))
+
+    path = os.path.join(folder, f"{uuid.uuid4().hex}.arrow")
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    return path
+
+
+def load_frame(path: str, memory_map: bool = True) -> pd.DataFrame:
+    """
+    Memory map a DataFrame written by share_frame(), or with memory_map=False read it into memory and close the file,
+    for frames kept after the shared folder is removed. Missing strings come back as NaN, as they were shared.
+    """
+    if memory_map:
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    else:
+        with pa.OSFile(path, "rb") as source:
+            table = pa.ipc.open_file(source).read_all()
+    df = table.to_pandas(split_blocks=True)
+
+    object_columns = df.columns[df.dtypes == object]
+    if len(object_columns):
+        df[object_columns] = df[object_columns].where(df[object_columns].notna(), np.nan)
+
+    return df
+
+
+def share_frames(frames: dict, folder: str) -> dict:
+    """
+    share_frame() every DataFrame in a dict
+
+    Returns:
+        dict: Paths keyed by the same names, to pass to load_frames() in the worker
+    """
+    return {name: share_frame(df, folder) for name, df in frames.items()}
+
+
+def load_frames(paths: dict) -> dict:
+
+    return {name: load_frame(path) for name, path in paths.items()}
@@ -0,0 +1,258 @@
+import pandas as pd
+import hashlib
+import functools
+import json
+import os
+import shutil
+from pathlib import Path
+from pipeline.utils import params
+
+def is_enabled(config: dict) -> bool:
+    """
+    Stage caching is switched on with "use_stage_cache" in the config file
+    """
+    return bool(config) and bool(config.get("use_stage_cache", False))
+
+
+def get_cache_dir(config: dict) -> Path:
+    """
+    Folder holding the cached stage outputs and run manifests, defaults to OUTPUTS\\CACHE under the root directory
+    """
+    if config.get("stage_cache_dir"):
+        return Path(config["stage_cache_dir"])
+
+    return Path(params.get_root()) / "OUTPUTS" / "CACHE"
+
+
+@functools.lru_cache(maxsize=None)
+def get_code_version() -> str:
+    """
+    Hash of every python file in the pipeline package, so a code change invalidates all cached stages
+    """
+    package_dir = Path(__file__).resolve().parents[1]
+    digest = hashlib.sha256()
+
+    for path in sorted(package_dir.rglob("*.py")):
+        digest.update(str(path.relative_to(package_dir)).encode())
+        digest.update(path.read_bytes())
+
+    return digest.hexdigest()
+
+
+def fingerprint(*inputs) -> str:
+    """
+    Hash stage inputs. DataFrames are hashed on their columns, dtypes and row values, dicts on their sorted items
+    and anything else on its repr.
+    """
+    digest = hashlib.sha256()
+
+    for item in inputs:
+        if isinstance(item, pd.DataFrame):
+            digest.update(repr(list(zip(item.columns, item.dtypes.astype(str)))).encode())
+            digest.update(pd.util.hash_pandas_object(item, index=True).values.tobytes())
+        elif isinstance(item, dict):
+            for key in sorted(item):
+                digest.update(str(key).encode())
+                digest.update(fingerprint(item[key]).encode())
+        else:
+            digest.update(repr(item).encode())
+
+    return digest.hexdigest()
+
+
+def get_manifest_path(config: dict, run_name: str) -> Path:
+
+    return get_cache_dir(config) / f"manifest_{run_name}.json"
+
+
+def load_manifest(config: dict, run_name: str, resume: bool = False) -> dict:
+    """
+    Load the manifest of the last run for run_name when resuming, otherwise start a new one
+
+    Returns:
+        dict: Run name and the cache key of each completed stage, in the order they completed
+    """
+    path = get_manifest_path(config, run_name)
+
+    if resume and is_enabled(config) and path.exists():
+        with open(path) as f:
+            return json.load(f)
+
+    return {"run": run_name, "stages": {}}
+
+
+def save_manifest(config: dict, manifest: dict) -> None:
+
+    path = get_manifest_path(config, manifest["run"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=4)
+
+
+def get_stage_path(config: dict, name: str, key: str) -> Path:
+
+    return get_cache_dir(config) / name / f"{key}.parquet"
+
+
+def write_frame(df: pd.DataFrame, path: Path) -> None:
+    """
+    Write a DataFrame to Parquet via a temporary file, so an interrupted write never leaves a partial cache entry
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def run_stage(config: dict, manifest: dict, name: str, function, *args):
+    """
+    Run a stage returning a DataFrame, or load its output from the cache if the stage has already run with the same
+    inputs and code version.
+
+    Args:
+        config (dict): Config file, the stage is run uncached unless "use_stage_cache" is set
+        manifest (dict): Manifest of the current run from load_manifest()
+        name (str): Stage name, used as the cache sub folder
+        function: The stage function
+        *args: Inputs passed to function and fingerprinted
+
+    Returns:
+        pd.DataFrame: Output of the stage
+    """
+    if not is_enabled(config):
+        return function(*args)
+
+    key = fingerprint(name, get_code_version(), *args)
+    path = get_stage_path(config, name, key)
+
+    if path.exists():
+        print(f"Using cached {name}")
+        df = pd.read_parquet(path)
+    else:
+        df = function(*args)
+        try:
+            write_frame(df, path)
+        except Exception as e:
+            print(f"Could not cache {name}, continuing without it.", e)
+            return df
+
+    manifest["stages"][name] = key
+    save_manifest(config, manifest)
+
+    return df
+
+
+def store_frames(config: dict, manifest: dict, name: str, frames: dict) -> None:
+    """
+    Cache a dict of DataFrames, e.g. the extracted inputs, under a key made from their contents so a failed run can
+    resume without extracting again
+    """
+    if not is_enabled(config):
+        return
+
+    key = fingerprint(name, frames)
+    try:
+        for frame_name, df in frames.items():
+            write_frame(df, get_cache_dir(config) / name / key / f"{frame_name}.parquet")
+    except Exception as e:
+        print(f"Could not cache {name}, continuing without it.", e)
+        return
+
+    manifest["stages"][name] = key
+    save_manifest(config, manifest)
+
+
+def load_frames(config: dict, manifest: dict, name: str):
+    """
+    Load a dict of DataFrames cached by store_frames() for the run in manifest
+
+    Returns:
+        dict: Cached DataFrames keyed by name, or None if the stage did not complete in that run
+    """
+    if not is_enabled(config) or name not in manifest["stages"]:
+        return None
+
+    stage_path = get_cache_dir(config) / name / manifest["stages"][name]
+    if not stage_path.exists():
+        return None
+
+    print(f"Resuming from cached {name}")
+    return {path.stem: pd.read_parquet(path) for path in sorted(stage_path.glob("*.parquet"))}
+
+
+def load_stage(config: dict, manifest: dict, name: str):
+    """
+    Load the output of a stage that completed in the run of manifest
+
+    Returns:
+        pd.DataFrame: Cached output of the stage, or None if the stage did not complete in that run
+    """
+    if not is_enabled(config) or name not in manifest["stages"]:
+        return None
+
+    path = get_stage_path(config, name, manifest["stages"][name])
+    if not path.exists():
+        return None
+
+    return pd.read_parquet(path)
+
+
+def store_stage(config: dict, manifest: dict, name: str, key: str, df: pd.DataFrame) -> None:
+    """
+    Cache the output of a stage that was built some other way than run_stage(), e.g. by patching an earlier run's
+    output, under a key made by the caller
+    """
+    if not is_enabled(config):
+        return
+
+    try:
+        write_frame(df, get_stage_path(config, name, key))
+    except Exception as e:
+        print(f"Could not cache {name}, continuing without it.", e)
+        return
+
+    manifest["stages"][name] = key
+    save_manifest(config, manifest)
+
+
+def is_cache_entry(path: Path) -> bool:
+    """
+    Whether path is named like an entry written by the cache, a fingerprint() key as a folder, .parquet or .tmp file
+    """
+    key = path.stem if path.suffix in [".parquet", ".tmp"] else path.name
+
+    return len(key) == 64 and all(c in "0123456789abcdef" for c in key)
+
+
+def prune(config: dict) -> None:
+    """
+    Delete cached stage outputs that no manifest refers to. Each run replaces the manifest of its report month, so
+    without this the stages of every earlier run would be kept. Only the folders of stages named in a manifest are
+    looked in, and only entries named like cache keys are deleted, so other files in "stage_cache_dir" are left alone.
+    """
+    cache_dir = get_cache_dir(config) if is_enabled(config) else None
+    if cache_dir is None or not cache_dir.exists():
+        return
+
+    referenced = set()
+    for path in cache_dir.glob("manifest_*.json"):
+        with open(path) as f:
+            referenced.update(json.load(f).get("stages", {}).items())
+
+    removed = 0
+    for stage_name in sorted({name for name, _ in referenced}):
+        stage_dir = cache_dir / stage_name
+        if not stage_dir.is_dir():
+            continue
+
+        for path in stage_dir.iterdir():
+            if not is_cache_entry(path) or (stage_name, path.stem) in referenced:
+                continue
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+            removed += 1
+
+    if removed:
+        print(f"Removed {removed} unused entries from the stage cache")